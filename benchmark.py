@@ -0,0 +1,623 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the mantis2trac, trac2mantis and mantis2mantis converters.
+
+Requires:  Trac 1.0.1 or newer from http://trac.edgewall.com/
+           Python 2.6 from http://www.python.org/
+           MySQL >= 5.0 or MariaDB from http://www.mysql.org/
+
+The benchmark fills a MySQL database with synthetic Mantis 1.2 data
+(bugs, notes, history, tags and attachments), creates a throwaway Trac
+environment and runs:
+
+  - mantis2trac:   the synthetic Mantis database -> the Trac environment
+  - trac2mantis:   the Trac environment -> <db>_trac2mantis
+  - mantis2mantis: the synthetic Mantis database -> <db>_mantis2mantis
+
+Each converter runs in its own process.  The wall time of every phase
+(the numbered or 'Importing ...' headings a converter prints), bugs per
+second and the peak RSS are written as JSON, so runs of different
+releases can be compared.  For converters that write a metrics report
+(METRICS_REPORT), it is included with its query, row, commit and byte
+counters.
+
+WARNING: the database <db> and the two output databases are dropped and
+recreated.  Use a MySQL server and database names reserved for testing.
+
+Example use:
+  python benchmark.py --db mantis_bench --user root --passwd secret \
+    --bugs 10000 --output results.json
+"""
+import os
+import re
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+import resource
+import Queue
+import StringIO
+import multiprocessing
+
+###
+### Benchmark Settings -- edit these before running if desired
+###
+
+# MySQL connection parameters.  These can also be specified on the
+# command line.
+MYSQL_DB = 'mantis_bench'
+MYSQL_HOST = 'localhost'
+MYSQL_USER = 'mantis_user'
+MYSQL_PASSWORD = 'passphrase'
+
+# Size of the synthetic Mantis database
+BUGS = 1000
+NOTES_PER_BUG = 3
+HISTORY_PER_BUG = 6
+TAGS = 50
+TAGS_PER_BUG = 2
+ATTACHMENTS = 100
+ATTACHMENT_SIZE = 64 * 1024
+USERS = 50
+CATEGORIES = 10
+VERSIONS = 5
+
+# Converters to run, in this order (trac2mantis reads the Trac environment
+# written by mantis2trac)
+CONVERTERS = ['mantis2trac', 'trac2mantis', 'mantis2mantis']
+
+# Rows inserted per executemany() while generating data
+INSERT_BATCH_SIZE = 1000
+
+# Seed of the data generator, the same seed gives the same data
+SEED = 1
+
+###
+### Script begins here
+###
+
+import MySQLdb
+from trac.env import Environment
+
+# The tables of the Mantis 1.2 schema read or written by the converters
+MANTIS_SCHEMA = [
+    """CREATE TABLE mantis_project_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        name VARCHAR(128) NOT NULL DEFAULT '',
+        status SMALLINT NOT NULL DEFAULT 10,
+        enabled TINYINT NOT NULL DEFAULT 1,
+        view_state SMALLINT NOT NULL DEFAULT 10,
+        access_min SMALLINT NOT NULL DEFAULT 10,
+        file_path VARCHAR(250) NOT NULL DEFAULT '',
+        description LONGTEXT,
+        category_id INT NOT NULL DEFAULT 1,
+        inherit_global INT NOT NULL DEFAULT 0)""",
+    """CREATE TABLE mantis_user_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        username VARCHAR(32) NOT NULL DEFAULT '',
+        realname VARCHAR(64) NOT NULL DEFAULT '',
+        email VARCHAR(64) NOT NULL DEFAULT '',
+        password VARCHAR(32) NOT NULL DEFAULT '',
+        enabled TINYINT NOT NULL DEFAULT 1,
+        protected TINYINT NOT NULL DEFAULT 0,
+        access_level SMALLINT NOT NULL DEFAULT 10,
+        login_count INT NOT NULL DEFAULT 0,
+        lost_password_request_count SMALLINT NOT NULL DEFAULT 0,
+        failed_login_count SMALLINT NOT NULL DEFAULT 0,
+        cookie_string VARCHAR(64) NOT NULL DEFAULT '',
+        last_visit INT UNSIGNED NOT NULL DEFAULT 1,
+        date_created INT UNSIGNED NOT NULL DEFAULT 1)""",
+    """CREATE TABLE mantis_user_profile_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        user_id INT NOT NULL DEFAULT 0,
+        platform VARCHAR(32) NOT NULL DEFAULT '',
+        os VARCHAR(32) NOT NULL DEFAULT '',
+        os_build VARCHAR(32) NOT NULL DEFAULT '',
+        description LONGTEXT)""",
+    """CREATE TABLE mantis_category_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        project_id INT NOT NULL DEFAULT 0,
+        user_id INT NOT NULL DEFAULT 0,
+        name VARCHAR(128) NOT NULL DEFAULT '',
+        status INT NOT NULL DEFAULT 0)""",
+    """CREATE TABLE mantis_project_version_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        project_id INT NOT NULL DEFAULT 0,
+        version VARCHAR(64) NOT NULL DEFAULT '',
+        description LONGTEXT,
+        released TINYINT NOT NULL DEFAULT 1,
+        obsolete TINYINT NOT NULL DEFAULT 0,
+        date_order INT UNSIGNED NOT NULL DEFAULT 1)""",
+    """CREATE TABLE mantis_bug_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        project_id INT NOT NULL DEFAULT 0,
+        reporter_id INT NOT NULL DEFAULT 0,
+        handler_id INT NOT NULL DEFAULT 0,
+        duplicate_id INT NOT NULL DEFAULT 0,
+        priority SMALLINT NOT NULL DEFAULT 30,
+        severity SMALLINT NOT NULL DEFAULT 50,
+        reproducibility SMALLINT NOT NULL DEFAULT 10,
+        status SMALLINT NOT NULL DEFAULT 10,
+        resolution SMALLINT NOT NULL DEFAULT 10,
+        projection SMALLINT NOT NULL DEFAULT 10,
+        eta SMALLINT NOT NULL DEFAULT 10,
+        bug_text_id INT NOT NULL DEFAULT 0,
+        os VARCHAR(32) NOT NULL DEFAULT '',
+        os_build VARCHAR(32) NOT NULL DEFAULT '',
+        platform VARCHAR(32) NOT NULL DEFAULT '',
+        version VARCHAR(64) NOT NULL DEFAULT '',
+        fixed_in_version VARCHAR(64) NOT NULL DEFAULT '',
+        build VARCHAR(32) NOT NULL DEFAULT '',
+        profile_id INT NOT NULL DEFAULT 0,
+        view_state SMALLINT NOT NULL DEFAULT 10,
+        summary VARCHAR(128) NOT NULL DEFAULT '',
+        sponsorship_total INT NOT NULL DEFAULT 0,
+        sticky TINYINT NOT NULL DEFAULT 0,
+        target_version VARCHAR(64) NOT NULL DEFAULT '',
+        category_id INT NOT NULL DEFAULT 1,
+        date_submitted INT UNSIGNED NOT NULL DEFAULT 1,
+        due_date INT UNSIGNED NOT NULL DEFAULT 1,
+        last_updated INT UNSIGNED NOT NULL DEFAULT 1)""",
+    """CREATE TABLE mantis_bug_text_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        description LONGTEXT NOT NULL,
+        steps_to_reproduce LONGTEXT NOT NULL,
+        additional_information LONGTEXT NOT NULL)""",
+    """CREATE TABLE mantis_bugnote_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        bug_id INT NOT NULL DEFAULT 0,
+        reporter_id INT NOT NULL DEFAULT 0,
+        bugnote_text_id INT NOT NULL DEFAULT 0,
+        view_state SMALLINT NOT NULL DEFAULT 10,
+        note_type INT DEFAULT 0,
+        note_attr VARCHAR(250) DEFAULT '',
+        time_tracking INT NOT NULL DEFAULT 0,
+        last_modified INT UNSIGNED NOT NULL DEFAULT 1,
+        date_submitted INT UNSIGNED NOT NULL DEFAULT 1,
+        KEY idx_bug (bug_id))""",
+    """CREATE TABLE mantis_bugnote_text_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        note LONGTEXT NOT NULL)""",
+    """CREATE TABLE mantis_bug_history_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        user_id INT NOT NULL DEFAULT 0,
+        bug_id INT NOT NULL DEFAULT 0,
+        field_name VARCHAR(64) NOT NULL DEFAULT '',
+        old_value VARCHAR(255) NOT NULL DEFAULT '',
+        new_value VARCHAR(255) NOT NULL DEFAULT '',
+        type SMALLINT NOT NULL DEFAULT 0,
+        date_modified INT UNSIGNED NOT NULL DEFAULT 1,
+        KEY idx_bug (bug_id))""",
+    """CREATE TABLE mantis_bug_file_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        bug_id INT NOT NULL DEFAULT 0,
+        title VARCHAR(250) NOT NULL DEFAULT '',
+        description VARCHAR(250) NOT NULL DEFAULT '',
+        diskfile VARCHAR(250) NOT NULL DEFAULT '',
+        filename VARCHAR(250) NOT NULL DEFAULT '',
+        folder VARCHAR(250) NOT NULL DEFAULT '',
+        filesize INT NOT NULL DEFAULT 0,
+        file_type VARCHAR(250) NOT NULL DEFAULT '',
+        content LONGBLOB,
+        date_added INT UNSIGNED NOT NULL DEFAULT 1,
+        user_id INT UNSIGNED NOT NULL DEFAULT 0,
+        KEY idx_bug (bug_id))""",
+    """CREATE TABLE mantis_bug_monitor_table (
+        user_id INT NOT NULL DEFAULT 0,
+        bug_id INT NOT NULL DEFAULT 0)""",
+    """CREATE TABLE mantis_bug_relationship_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        source_bug_id INT NOT NULL DEFAULT 0,
+        destination_bug_id INT NOT NULL DEFAULT 0,
+        relationship_type SMALLINT NOT NULL DEFAULT 0)""",
+    """CREATE TABLE mantis_bug_revision_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        bug_id INT NOT NULL,
+        bugnote_id INT NOT NULL DEFAULT 0,
+        user_id INT NOT NULL,
+        type INT NOT NULL,
+        value LONGTEXT NOT NULL,
+        timestamp INT UNSIGNED NOT NULL DEFAULT 1)""",
+    """CREATE TABLE mantis_tag_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        user_id INT NOT NULL DEFAULT 0,
+        name VARCHAR(100) NOT NULL DEFAULT '',
+        description LONGTEXT,
+        date_created INT UNSIGNED NOT NULL DEFAULT 1,
+        date_updated INT UNSIGNED NOT NULL DEFAULT 1)""",
+    """CREATE TABLE mantis_bug_tag_table (
+        bug_id INT NOT NULL DEFAULT 0,
+        tag_id INT NOT NULL DEFAULT 0,
+        user_id INT NOT NULL DEFAULT 0,
+        date_attached INT UNSIGNED NOT NULL DEFAULT 1,
+        PRIMARY KEY (bug_id, tag_id))""",
+    """CREATE TABLE mantis_custom_field_table (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        name VARCHAR(64) NOT NULL DEFAULT '',
+        type SMALLINT NOT NULL DEFAULT 0,
+        possible_values TEXT,
+        default_value VARCHAR(255) NOT NULL DEFAULT '',
+        valid_regexp VARCHAR(255) NOT NULL DEFAULT '',
+        access_level_r SMALLINT NOT NULL DEFAULT 0,
+        access_level_rw SMALLINT NOT NULL DEFAULT 0,
+        length_min INT NOT NULL DEFAULT 0,
+        length_max INT NOT NULL DEFAULT 0)""",
+    """CREATE TABLE mantis_custom_field_project_table (
+        field_id INT NOT NULL DEFAULT 0,
+        project_id INT UNSIGNED NOT NULL DEFAULT 0,
+        sequence SMALLINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (field_id, project_id))""",
+    """CREATE TABLE mantis_custom_field_string_table (
+        field_id INT NOT NULL DEFAULT 0,
+        bug_id INT NOT NULL DEFAULT 0,
+        value VARCHAR(255) NOT NULL DEFAULT '',
+        PRIMARY KEY (field_id, bug_id))""",
+]
+
+# a line starting a new phase in the output of a converter
+PHASE_PATTERN = re.compile(r'^(\d+(\.-\d+)?\. |Importing |Updating )')
+
+def connect(db=None):
+    args = dict(host=MYSQL_HOST, user=MYSQL_USER, passwd=MYSQL_PASSWORD, use_unicode=1)
+    if db:
+        args['db'] = db
+    return MySQLdb.connect(**args)
+
+def createDatabase(name):
+    """Drop and recreate database `name` with the Mantis schema"""
+    con = connect()
+    cursor = con.cursor()
+    cursor.execute("DROP DATABASE IF EXISTS `%s`" % name)
+    cursor.execute("CREATE DATABASE `%s` DEFAULT CHARACTER SET utf8" % name)
+    cursor.execute("USE `%s`" % name)
+    for sql in MANTIS_SCHEMA:
+        cursor.execute(sql + " ENGINE=InnoDB DEFAULT CHARSET=utf8")
+    con.commit()
+    return con
+
+def insertRows(cursor, table, columns, rows):
+    """Insert `rows` (an iterable of tuples) in batches"""
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+    batch = []
+    count = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= INSERT_BATCH_SIZE:
+            cursor.executemany(sql, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+        count += len(batch)
+    return count
+
+def generateMantisData(con):
+    """Fill the Mantis database behind `con` with synthetic data, returns
+    the number of rows per table"""
+    rand = random.Random(SEED)
+    cursor = con.cursor()
+    start = 1300000000
+    counts = {}
+
+    counts['mantis_project_table'] = insertRows(cursor, 'mantis_project_table', ['id', 'name', 'description'],
+        [(1, 'Benchmark', '')])
+    counts['mantis_user_table'] = insertRows(cursor, 'mantis_user_table',
+        ['id', 'username', 'realname', 'email', 'password', 'cookie_string', 'last_visit', 'date_created'],
+        ((u, 'user%d' % u, 'User %d' % u, 'user%d@example.com' % u, '', 'cookie%d' % u, start, start)
+         for u in range(1, USERS + 1)))
+    counts['mantis_category_table'] = insertRows(cursor, 'mantis_category_table', ['id', 'project_id', 'user_id', 'name'],
+        ((c, 1, 1 + c % USERS, 'category %d' % c) for c in range(1, CATEGORIES + 1)))
+    counts['mantis_project_version_table'] = insertRows(cursor, 'mantis_project_version_table',
+        ['project_id', 'version', 'description', 'released', 'obsolete', 'date_order'],
+        ((1, '1.%d' % v, '', v % 2, 0, start + v * 86400) for v in range(VERSIONS)))
+    counts['mantis_tag_table'] = insertRows(cursor, 'mantis_tag_table',
+        ['id', 'user_id', 'name', 'description', 'date_created', 'date_updated'],
+        ((t, 1 + t % USERS, 'tag%d' % t, '', start, start) for t in range(1, TAGS + 1)))
+
+    def bugTime(bug):
+        return start + bug * 600
+
+    counts['mantis_bug_text_table'] = insertRows(cursor, 'mantis_bug_text_table',
+        ['id', 'description', 'steps_to_reproduce', 'additional_information'],
+        ((b, 'Description of bug %d. ' % b * 5, b % 2 and 'Steps to reproduce bug %d' % b or '', '')
+         for b in range(1, BUGS + 1)))
+    counts['mantis_bug_table'] = insertRows(cursor, 'mantis_bug_table',
+        ['id', 'project_id', 'reporter_id', 'handler_id', 'priority', 'severity', 'status', 'resolution',
+         'bug_text_id', 'version', 'target_version', 'summary', 'category_id', 'date_submitted', 'last_updated'],
+        ((b, 1, rand.randint(1, USERS), rand.randint(0, USERS), rand.choice([10, 20, 30, 40, 50, 60]),
+          rand.choice([10, 20, 30, 40, 50, 60, 70, 80]), rand.choice([10, 20, 30, 40, 50, 80, 90]),
+          rand.choice([10, 20, 30, 40, 50, 60, 70, 80, 90]), b, '1.%d' % (b % VERSIONS),
+          b % 3 and '1.%d' % ((b + 1) % VERSIONS) or '', 'Summary of bug %d' % b,
+          1 + b % CATEGORIES, bugTime(b), bugTime(b) + 3600)
+         for b in range(1, BUGS + 1)))
+
+    notes = BUGS * NOTES_PER_BUG
+    counts['mantis_bugnote_text_table'] = insertRows(cursor, 'mantis_bugnote_text_table', ['id', 'note'],
+        ((n, 'Note %d. ' % n * 10) for n in range(1, notes + 1)))
+    counts['mantis_bugnote_table'] = insertRows(cursor, 'mantis_bugnote_table',
+        ['bug_id', 'reporter_id', 'bugnote_text_id', 'last_modified', 'date_submitted'],
+        ((1 + (n - 1) // NOTES_PER_BUG, rand.randint(1, USERS), n,
+          bugTime(1 + (n - 1) // NOTES_PER_BUG) + 60 * (n % NOTES_PER_BUG) + 1,
+          bugTime(1 + (n - 1) // NOTES_PER_BUG) + 60 * (n % NOTES_PER_BUG) + 1)
+         for n in range(1, notes + 1)))
+
+    def history():
+        changes = [('status', lambda: str(rand.choice([10, 20, 30, 40, 50, 80, 90]))),
+                   ('priority', lambda: str(rand.choice([10, 20, 30, 40, 50, 60]))),
+                   ('severity', lambda: str(rand.choice([10, 20, 30, 40, 50, 60, 70, 80]))),
+                   ('resolution', lambda: str(rand.choice([10, 20, 30, 40, 50, 60, 70, 80, 90]))),
+                   ('handler_id', lambda: str(rand.randint(0, USERS))),
+                   ('summary', lambda: 'Summary %d' % rand.randint(0, 1000)),
+                   ('os', lambda: 'os %d' % rand.randint(0, 10))]
+        for b in range(1, BUGS + 1):
+            yield (rand.randint(1, USERS), b, '', '', '', 1, bugTime(b))
+            for h in range(HISTORY_PER_BUG):
+                field, value = changes[h % len(changes)]
+                yield (rand.randint(1, USERS), b, field, value(), value(), 0, bugTime(b) + 10 * h + 5)
+    counts['mantis_bug_history_table'] = insertRows(cursor, 'mantis_bug_history_table',
+        ['user_id', 'bug_id', 'field_name', 'old_value', 'new_value', 'type', 'date_modified'], history())
+
+    counts['mantis_bug_tag_table'] = insertRows(cursor, 'mantis_bug_tag_table',
+        ['bug_id', 'tag_id', 'user_id', 'date_attached'],
+        ((b, t, 1, bugTime(b))
+         for b in range(1, BUGS + 1)
+         for t in sorted(set([1 + (b * 7 + i * 13) % max(1, TAGS) for i in range(min(TAGS_PER_BUG, TAGS))]))))
+
+    # attachments are spread over the bugs, every fourth one repeats an
+    # earlier content
+    payloads = [''.join([chr(rand.randint(0, 255)) for i in range(256)]) for p in range(4)]
+    def attachments():
+        for a in range(ATTACHMENTS):
+            b = 1 + (a * 7919) % BUGS
+            content = (payloads[a % 4] * (ATTACHMENT_SIZE // 256 + 1))[:ATTACHMENT_SIZE]
+            if a % 4:
+                content = ('%08d' % a) + content[8:]
+            yield (b, '', 'attachment %d' % a, 'file%d.bin' % a, len(content), 'application/octet-stream',
+                   MySQLdb.Binary(content), bugTime(b) + 30, rand.randint(1, USERS))
+    counts['mantis_bug_file_table'] = insertRows(cursor, 'mantis_bug_file_table',
+        ['bug_id', 'title', 'description', 'filename', 'filesize', 'file_type', 'content', 'date_added', 'user_id'],
+        attachments())
+    counts['mantis_bug_history_table'] += insertRows(cursor, 'mantis_bug_history_table',
+        ['user_id', 'bug_id', 'field_name', 'old_value', 'new_value', 'type', 'date_modified'],
+        ((1, 1 + (a * 7919) % BUGS, '', 'file%d.bin' % a, '', 9, bugTime(1 + (a * 7919) % BUGS) + 30)
+         for a in range(ATTACHMENTS)))
+
+    con.commit()
+    return counts
+
+def createTracEnv(path):
+    Environment(path, create=True, options=[('trac', 'database', 'sqlite:db/trac.db')])
+
+# stdout replacement recording the time of each phase heading
+class PhaseTimer(object):
+    def __init__(self):
+        self.phases = []
+        self._line = ''
+        self._started = None
+        self._name = 'setup'
+        self._start = time.time()
+
+    def write(self, text):
+        lines = (self._line + text).split('\n')
+        self._line = lines.pop()
+        for line in lines:
+            if PHASE_PATTERN.match(line):
+                self._next(line.strip())
+
+    def flush(self):
+        pass
+
+    def _next(self, name):
+        now = time.time()
+        self.phases.append({'name': self._name, 'seconds': round(now - self._start, 3)})
+        self._name = name
+        self._start = now
+
+    def close(self):
+        self._next(None)
+
+def _runConverter(name, function, results):
+    # the converters reload sys when imported, which resets sys.stdout
+    module = __import__(name)
+    reportPath = None
+    if hasattr(module, 'METRICS_REPORT'):
+        fd, reportPath = tempfile.mkstemp(prefix=name, suffix='.json')
+        os.close(fd)
+        module.METRICS_REPORT = reportPath
+    timer = PhaseTimer()
+    stdout = sys.stdout
+    sys.stdout = timer
+    started = time.time()
+    error = None
+    try:
+        try:
+            function()
+        # the converters call sys.exit() on some errors
+        except BaseException, e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        sys.stdout = stdout
+    seconds = time.time() - started
+    timer.close()
+    metrics = None
+    if reportPath is not None:
+        if os.path.getsize(reportPath):
+            metrics = json.load(open(reportPath))
+        os.remove(reportPath)
+    results.put({
+        'seconds': round(seconds, 3),
+        'bugs_per_second': seconds and round(BUGS / seconds, 1) or None,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_rss_children_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'phases': timer.phases,
+        'metrics': metrics,
+        'error': error,
+    })
+
+def runConverter(name, function):
+    """Run `function` in a new process, returns its measurements"""
+    print "running %s..." % name
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_runConverter, args=(name, function, results))
+    process.start()
+    # a converter that crashes the process never sends its result
+    result = None
+    while result is None and (process.is_alive() or not results.empty()):
+        try:
+            result = results.get(timeout=1)
+        except Queue.Empty:
+            pass
+    process.join()
+    if result is None:
+        result = {'seconds': None, 'bugs_per_second': None, 'peak_rss_kb': None, 'peak_rss_children_kb': None,
+                  'phases': [], 'metrics': None, 'error': 'the process exited with code %s' % process.exitcode}
+        print "  %s: failed: %s" % (name, result['error'])
+        return result
+    print "  %s: %.1f seconds, %s bugs/second%s" % (name, result['seconds'], result['bugs_per_second'],
+                                                     result['error'] and ', failed: %s' % result['error'] or '')
+    return result
+
+def runMantis2Trac(env):
+    import mantis2trac
+    mantis2trac.TRAC_ENV = env
+    mantis2trac.convert(MYSQL_DB, MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, env, 1, True)
+
+def runTrac2Mantis(env):
+    import trac2mantis
+    trac2mantis.convert(trac2mantis.PROJECT, MYSQL_DB + '_trac2mantis', MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, env, 0, False)
+
+def runMantis2Mantis():
+    import mantis2mantis
+    mantis2mantis.convert(mantis2mantis.OUT_PROJECT, MYSQL_DB, MYSQL_DB + '_mantis2mantis', MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, 0, False)
+
+def benchmark(workdir):
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': {
+            'bugs': BUGS, 'notes_per_bug': NOTES_PER_BUG, 'history_per_bug': HISTORY_PER_BUG,
+            'tags': TAGS, 'tags_per_bug': TAGS_PER_BUG, 'attachments': ATTACHMENTS,
+            'attachment_size': ATTACHMENT_SIZE, 'users': USERS, 'seed': SEED,
+        },
+        'results': {},
+    }
+
+    print "generating the Mantis database %s..." % MYSQL_DB
+    started = time.time()
+    con = createDatabase(MYSQL_DB)
+    report['rows'] = generateMantisData(con)
+    con.close()
+    report['generate_seconds'] = round(time.time() - started, 3)
+
+    env = os.path.join(workdir, 'trac')
+    print "creating the Trac environment %s..." % env
+    createTracEnv(env)
+
+    for name in CONVERTERS:
+        if name == 'mantis2trac':
+            function = lambda: runMantis2Trac(env)
+        elif name == 'trac2mantis':
+            createDatabase(MYSQL_DB + '_trac2mantis').close()
+            function = lambda: runTrac2Mantis(env)
+        elif name == 'mantis2mantis':
+            createDatabase(MYSQL_DB + '_mantis2mantis').close()
+            function = runMantis2Mantis
+        else:
+            raise ValueError("unknown converter '%s'" % name)
+        report['results'][name] = runConverter(name, function)
+    return report
+
+def usage():
+    print "benchmark - Times the converters on a synthetic Mantis database."
+    print
+    print "Usage: benchmark.py [options]"
+    print
+    print "Available Options:"
+    print "  --db <MySQL dbname>              - Benchmark database, DROPPED and recreated (default %s)" % MYSQL_DB
+    print "  -h | --host <MySQL hostname>     - MySQL host name"
+    print "  -u | --user <MySQL username>     - MySQL user, needs to create databases"
+    print "  -p | --passwd <MySQL password>   - MySQL user password"
+    print "  --bugs <n>                       - Number of bugs (default %d)" % BUGS
+    print "  --notes <n>                      - Notes per bug (default %d)" % NOTES_PER_BUG
+    print "  --history <n>                    - History rows per bug (default %d)" % HISTORY_PER_BUG
+    print "  --tags <n>                       - Number of tags (default %d)" % TAGS
+    print "  --attachments <n>                - Number of attachments (default %d)" % ATTACHMENTS
+    print "  --attachment-size <bytes>        - Size of each attachment (default %d)" % ATTACHMENT_SIZE
+    print "  --converters <name1,name2>       - Converters to run (default %s)" % ','.join(CONVERTERS)
+    print "  --workdir <path>                 - Keep the Trac environment in path"
+    print "  --output <file>                  - Write the JSON report to file instead of stdout"
+    print "  --help | help                    - This help info"
+    print
+    sys.exit(0)
+
+def main():
+    global MYSQL_DB, MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, BUGS, NOTES_PER_BUG, HISTORY_PER_BUG
+    global TAGS, ATTACHMENTS, ATTACHMENT_SIZE, CONVERTERS
+    workdir = None
+    output = None
+    if len(sys.argv) > 1 and sys.argv[1] in ['--help', 'help']:
+        usage()
+    iter = 1
+    while iter < len(sys.argv):
+        option = sys.argv[iter]
+        if iter + 1 >= len(sys.argv):
+            usage()
+        value = sys.argv[iter + 1]
+        if option in ['--db']:
+            MYSQL_DB = value
+        elif option in ['-h', '--host']:
+            MYSQL_HOST = value
+        elif option in ['-u', '--user']:
+            MYSQL_USER = value
+        elif option in ['-p', '--passwd']:
+            MYSQL_PASSWORD = value
+        elif option in ['--bugs']:
+            BUGS = int(value)
+        elif option in ['--notes']:
+            NOTES_PER_BUG = int(value)
+        elif option in ['--history']:
+            HISTORY_PER_BUG = int(value)
+        elif option in ['--tags']:
+            TAGS = int(value)
+        elif option in ['--attachments']:
+            ATTACHMENTS = int(value)
+        elif option in ['--attachment-size']:
+            ATTACHMENT_SIZE = int(value)
+        elif option in ['--converters']:
+            CONVERTERS = value.split(',')
+        elif option in ['--workdir']:
+            workdir = value
+        elif option in ['--output']:
+            output = value
+        else:
+            usage()
+        iter = iter + 2
+
+    # the converters are imported from the directory of this script
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    keep = workdir is not None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='mantis2trac-benchmark-')
+    elif not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    try:
+        report = benchmark(workdir)
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, True)
+
+    if output:
+        f = open(output, 'w')
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        print "report written to %s" % output
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@
 Import Mantis bugs into a Mantis database.
 
 Requires:  Mantis 1.2.18 from http://www.mantisbt.org/
-           Python 2.4 from http://www.python.org/
+           Python 2.6 from http://www.python.org/
            MySQL >= 3.23 from http://www.mysql.org/
 
 Steffen Mecke <stm2@users.sourceforge.net>
@@ -51,6 +51,34 @@ MANTIS_CLEAN = False
 # If TRAC_CLEAN is true and this is true, tickets will be appended
 MANTIS_APPEND = False
 
+# Number of rows read per page when copying a table.  Tables are paged
+# by id (or streamed from the server if they have no id column), so memory
+# use does not grow with the size of the input database.
+STREAM_CHUNK_SIZE = 1000
+# Page size for tables holding file contents
+BLOB_CHUNK_SIZE = 20
+
+# Seconds between two progress lines (with an ETA) while a table is
+# copied, 0 disables them
+PROGRESS_INTERVAL = 10
+
+# If set, a JSON report with the wall time of every table and counters of
+# the queries, rows, commits and bytes is written to this file (--report)
+METRICS_REPORT = None
+
+# Time every statement on the input and output databases and list the
+# PROFILE_TOP statements taking the most time at the end (--profile).
+# Statements slower than SLOW_QUERY_SECONDS are printed when they finish.
+PROFILE_QUERIES = False
+PROFILE_TOP = 20
+SLOW_QUERY_SECONDS = 1.0
+
+# Read and map all tables, but do not write anything to the output
+# database (--dry-run).  Queries on the output database are still run, all
+# other statements are discarded and only counted; inserted rows get made
+# up ids.
+DRY_RUN = False
+
 
 ###########################################################################
 ### You probably don't need to change any configuration past this line. ###
@@ -71,24 +99,38 @@ import StringIO
 import MySQLdb
 import MySQLdb.cursors
 
+from metrics import Metrics, QueryProfile, CountingConnection, NullConnection
+
 if not hasattr(sys, 'setdefaultencoding'):
     reload(sys)
 
 sys.setdefaultencoding('utf-8')
 
 class MantisDatabase(object):
-    def __init__(self, out_project_name, _in_db, _out_db, _host, _user, _password, _append):
+    def __init__(self, out_project_name, _in_db, _out_db, _host, _user, _password, _append, metrics=None, dryRun=False):
         self._append = _append
-        self._in_con = MySQLdb.connect(host=_host, 
+        if metrics is None:
+            metrics = Metrics('mantis2mantis', 0)
+        self.metrics = metrics
+        self.dryRun = dryRun
+        self._in_con = CountingConnection(MySQLdb.connect(host=_host, 
                 user=_user, passwd=_password, db=_in_db, compress=1, 
-                cursorclass=MySQLdb.cursors.DictCursor, use_unicode=1)
+                cursorclass=MySQLdb.cursors.DictCursor, use_unicode=1), metrics, 'in')
         self._in_cursor = self._in_con.cursor()
 
         self._out_con = MySQLdb.connect(host=_host, 
                 user=_user, passwd=_password, db=_out_db, compress=1, 
                 cursorclass=MySQLdb.cursors.DictCursor, use_unicode=1)
+        if dryRun:
+            self._out_con = NullConnection(self._out_con, metrics, 'out')
+        self._out_con = CountingConnection(self._out_con, metrics, 'out')
         self._out_cursor = self._out_con.cursor()
 
+        # unbuffered connection for streaming tables without an id column
+        self._stream_con = CountingConnection(MySQLdb.connect(host=_host, 
+                user=_user, passwd=_password, db=_in_db, compress=1, 
+                cursorclass=MySQLdb.cursors.SSDictCursor, use_unicode=1), metrics, 'in')
+
         # create project if it doesn't exist
         sql = "SELECT id FROM mantis_project_table WHERE name = %s" % (out_project_name)
         if DEBUG:
@@ -196,6 +238,41 @@ class MantisDatabase(object):
     def inCursor(self):
         return self._in_cursor
 
+    # yield all rows of sql, paging by idname (which must be a column of
+    # the selected table); sql must end in a WHERE clause
+    def pagedRows(self, sql, idname, chunkSize=STREAM_CHUNK_SIZE):
+        lastId = None
+        while True:
+            page = sql
+            if lastId is not None:
+                page += " AND %s > %d" % (idname, lastId)
+            page += " ORDER BY %s LIMIT %d" % (idname, chunkSize)
+            if DEBUG:
+                print page
+            self.inCursor().execute(page)
+            rows = self.inCursor().fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < chunkSize:
+                return
+            lastId = int(rows[-1][idname])
+
+    # yield all rows of sql from a server side cursor
+    def streamRows(self, sql, chunkSize=STREAM_CHUNK_SIZE):
+        if DEBUG:
+            print sql
+        cursor = self._stream_con.cursor()
+        try:
+            cursor.execute(sql)
+            while True:
+                rows = cursor.fetchmany(chunkSize)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
     # database cursor for output database
     def outCursor(self):
         return self._out_cursor
@@ -210,6 +287,8 @@ class MantisDatabase(object):
         return int(c.fetchall()[0]['count(*)']) > 0
 
     def assertNoTickets(self):
+        if self.dryRun:
+            return
         if not self._append and self.hasTickets():
           raise Exception("Will not modify database with existing tickets!")
           return
@@ -255,7 +334,7 @@ class MantisDatabase(object):
             return self.userId(key)
 
         if key == 0:
-            if key in self._id_map[mapName]:
+            if key in self._id_map.get(mapName, {}):
                 return self._id_map[mapName][key]
             else:
                 return 0
@@ -370,6 +449,7 @@ class MantisDatabase(object):
             print sql % values
         self.outCursor().execute(sql, (values))
         self.outCommit()
+        self.metrics.count('bytes', sum([len(value) for value in values if isinstance(value, basestring)]))
 
         if idname is not None:
             self.newIdMapping(tablename, row[idname],  self.outCursor().lastrowid)
@@ -379,13 +459,17 @@ class MantisDatabase(object):
     # idMaps: keys are foreign keys to table given as value
     # checkDuplicateClause: checks if row might exist in output table
     # checkFields: fields that replace wildcards in checkDuplicateClause
-    def mapTable(self, tablename, idname, idMaps, checkDuplicateClause = "", checkFields = ()):
-        sql = "SELECT * FROM %s" % tablename
-        if DEBUG:
-            print sql
-        self.inCursor().execute(sql)
+    # chunkSize: number of rows read from the input database at once
+    def mapTable(self, tablename, idname, idMaps, checkDuplicateClause = "", checkFields = (), chunkSize = STREAM_CHUNK_SIZE):
+        self.metrics.phase(tablename)
+        self.inCursor().execute("SELECT COUNT(*) AS count FROM %s" % tablename)
+        self.metrics.expect(int(self.inCursor().fetchall()[0]['count']))
+        if idname is not None:
+            rows = self.pagedRows("SELECT * FROM %s WHERE 1" % tablename, idname, chunkSize)
+        else:
+            rows = self.streamRows("SELECT * FROM %s" % tablename, chunkSize)
 
-        for row in self.inCursor().fetchall():
+        for row in rows:
 
             if checkDuplicateClause != "":
                 checkValues = ()
@@ -406,15 +490,24 @@ class MantisDatabase(object):
                     print existing
                     print "map %s:%s => %s" % (tablename, row[idname], existing[0]['id'])
                 self.newIdMapping(tablename, row[idname], existing[0]['id'])
+            self.metrics.progress()
+        self.metrics.endPhase()
 
 def convert(_project_name, _in_db, _out_db, _host, _user, _password, _force, _append):
     global DEBUG
+    metrics = Metrics('mantis2mantis', PROGRESS_INTERVAL)
+    if PROFILE_QUERIES:
+        metrics.profile = QueryProfile(SLOW_QUERY_SECONDS, PROFILE_TOP)
+    metrics.phase('connect')
     print "Mantis MySQL('%s':'%s':'%s':'%s':'%s'): connecting..." % (_in_db, _out_db, _host, _user, _password)
-    db = MantisDatabase(_project_name, _in_db, _out_db, _host, _user, _password, _append)
+    db = MantisDatabase(_project_name, _in_db, _out_db, _host, _user, _password, _append, metrics, DRY_RUN)
+    if DRY_RUN:
+        print "Dry run: nothing is written to %s" % _out_db
 
 
     if _force == 1:
         print "cleaning all tickets..."
+        metrics.phase('clean')
         db.clean('mantis_bugnote_table')
         db.clean('mantis_bugnote_text_table')
         db.clean('mantis_bug_file_table')
@@ -491,7 +584,7 @@ def convert(_project_name, _in_db, _out_db, _host, _user, _password, _force, _ap
         'bugnote_text_id' : 'mantis_bugnote_text_table'})
     db.mapTable('mantis_bug_file_table', 'id', {
         'bug_id' : 'mantis_bug_table',
-        'user_id' : 'mantis_user_table' })
+        'user_id' : 'mantis_user_table' }, chunkSize = BLOB_CHUNK_SIZE)
     print "Importing bug history..."
     db.mapTable('mantis_bug_history_table', 'id', {
         'user_id' : 'mantis_user_table',
@@ -533,12 +626,10 @@ def convert(_project_name, _in_db, _out_db, _host, _user, _password, _force, _ap
 
 
     print "Updating duplicates and project..."
+    metrics.phase('duplicates and project')
     # update duplicate_id in bugs
-    sql = """SELECT id, duplicate_id, project_id FROM mantis_bug_table"""
-    if DEBUG:
-        print sql
-    db.inCursor().execute(sql)
-    for bug in db.inCursor().fetchall():
+    sql = """SELECT id, duplicate_id, project_id FROM mantis_bug_table WHERE 1"""
+    for bug in db.pagedRows(sql, 'id'):
         if _project_name and PROJECT_TO_TAGS:
             # map project to tag
             sql = """INSERT INTO mantis_bug_tag_table (bug_id, tag_id, user_id, date_attached)
@@ -565,7 +656,23 @@ def convert(_project_name, _in_db, _out_db, _host, _user, _password, _force, _ap
                 print sql
             db.outCursor().execute("""UPDATE mantis_bug_table SET duplicate_id = %s""" , (db.bugId(bug['duplicate_id'])))
             db.outCommit()
-                                                       
+        metrics.progress()
+    metrics.endPhase()
+
+    print
+    if DRY_RUN:
+        print "Dry run, discarded %d rows, %d bytes" % (metrics.counters.get('out.rows_written', 0), metrics.counters.get('out.bytes_discarded', 0))
+    print "Wall time per table:"
+    for line in metrics.summary():
+        print line
+    if metrics.profile is not None:
+        print
+        print "Statements taking the most time (%d slower than %s seconds):" % (metrics.profile.slowQueries, SLOW_QUERY_SECONDS)
+        for line in metrics.profile.summary():
+            print line
+    if METRICS_REPORT:
+        metrics.writeReport(METRICS_REPORT)
+        print "Metrics report written to %s" % METRICS_REPORT
     
 def usage():
     print "trac2mantis - Imports a bug database from Trac into Mantis."
@@ -580,6 +687,10 @@ def usage():
     print "  -u | --user <MySQL username>     - Effective Mantis database user"
     print "  -p | --passwd <MySQL password>   - Mantis database user password"
     print "  -c | --clean                     - Remove current Trac tickets before importing"
+    print "  --report <file>                  - Write table times and counters as JSON to file"
+    print "  --profile                        - Time every statement and list the slowest ones"
+    print "  --dry-run                        - Read and map all tables without writing to outdb"
+    print "  -v | --verbose                   - Print every statement"
     print "  --help | help                    - This help info"
     print
     print "Additional configuration options can be defined directly in the script."
@@ -591,6 +702,7 @@ def usage():
 
 def main():
     global MANTIS_IN_DB, MANTIS_OUT_DB, MANTIS_HOST, MANTIS_USER, MANTIS_PASSWORD, TRAC_ENV, MANTIS_CLEAN, MANTIS_APPEND, OUT_PROJECT
+    global METRICS_REPORT, DEBUG, PROFILE_QUERIES, DRY_RUN
     if len (sys.argv) > 1:
         if sys.argv[1] in ['--help','help'] or len(sys.argv) < 4:
             usage()
@@ -618,6 +730,15 @@ def main():
                 MANTIS_CLEAN = 1
             elif sys.argv[iter] in ['-a', '--append']:
                 MANTIS_APPEND = 1
+            elif sys.argv[iter] in ['--report'] and iter+1 < len(sys.argv):
+                METRICS_REPORT = sys.argv[iter+1]
+                iter = iter + 1
+            elif sys.argv[iter] in ['--profile']:
+                PROFILE_QUERIES = True
+            elif sys.argv[iter] in ['--dry-run']:
+                DRY_RUN = True
+            elif sys.argv[iter] in ['-v', '--verbose']:
+                DEBUG = True
             else:
                 print "Error: unknown parameter: " + sys.argv[iter]
                 sys.exit(0)
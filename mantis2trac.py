@@ -4,7 +4,7 @@
 Import Mantis bugs into a Trac database.
 
 Requires:  Trac 0.9.X or newer from http://trac.edgewall.com/
-           Python 2.4 from http://www.python.org/
+           Python 2.6 from http://www.python.org/
            MySQL >= 3.23 from http://www.mysql.org/
 
 Example use:
@@ -38,6 +38,51 @@ Dmitry Yusupov <dmitry_yus@yahoo.com> - bugzilla2trac.py
 Mark Rowe <mrowe@bluewire.net.nz> - original TracDatabase class
 Bill Soudan <bill@soudan.net> - Many enhancements 
 
+Changes in version 1.7:
+  - bug texts, notes, history and attachments are prefetched in chunks
+    of PREFETCH_CHUNK_SIZE bugs instead of being queried bug by bug
+  - bugs are streamed from Mantis in id-ordered pages instead of being
+    loaded all at once
+  - the Trac database is committed in batches (--commit-every,
+    --commit-seconds); a failing ticket is rolled back on its own
+  - ticket comments and changes are written with one executemany() per
+    ticket; unique (ticket, time, field) keys are assigned in memory, colliding changes
+    are moved by one microsecond instead of one second
+  - tickets are inserted with the final state of their change history
+    instead of being updated once per change
+  - bugs can be prefetched and translated by several processes (--jobs)
+  - the Mantis bug id of every ticket is stored in the custom field
+    MANTIS_ID_FIELD, in the same transaction as the ticket; an interrupted
+    import can be continued with --resume
+  - delta synchronization of bugs updated since a given time or the last
+    import (--since), existing tickets are updated in place and only the
+    comments, changes and attachments they do not have yet are added
+  - Mantis users and Trac sessions are preloaded, new sessions are written
+    in batches
+  - attachments are copied from the database straight to the Trac
+    attachment directory, without the importfiles staging directory;
+    files up to ATTACHMENT_CHUNK_SIZE are read with a single query
+  - attachments are written by background threads, duplicate files are
+    hard linked
+  - attachments stored on disk or on an FTP server (through a local
+    mirror) can be converted, see ATTACHMENT_SOURCE
+  - bug history is translated through a table of per-field translators,
+    which can be extended with ACTIVITY_TRANSLATORS
+  - changesets are matched to bugnotes with a sorted index instead of a
+    query per note
+  - the wall time of every phase and counters of the queries, rows,
+    commits and bytes are recorded; a progress line with an ETA is printed
+    while the bugs are imported and a JSON report can be written
+    (--report).  Per-ticket output is only printed with --verbose
+  - statements can be profiled (--profile): the total time, count and rows
+    of every statement and the statements slower than SLOW_QUERY_SECONDS
+    are reported
+  - --dry-run reads and translates all bugs but discards everything that
+    would be written to Trac, counting the rows and bytes instead
+  - the Mantis data can be extracted to a directory (--extract) and
+    loaded into Trac from there (--load), so the extraction runs once and
+    the load can be repeated without the Mantis database
+
 Changes in version 1.6:
   - allow to append to an existing project (with correct id mapping)
   - fixed to work with mysql by removing INSERT OR REPLACE syntax
@@ -107,7 +152,6 @@ Notes:
     #tktlist tr.color2-even { background: #FFE59F; border-color: #e99; color: #a22 }
     
 """
-from urllib import quote
 from datetime import datetime, date
 import time
 import hashlib
@@ -140,6 +184,13 @@ TRAC_ENV = '/var/www/trac/projectname/'
 TRAC_CLEAN = False
 # If TRAC_CLEAN is true and this is true, tickets will be appended
 TRAC_APPEND = True
+# If true, continue an interrupted import after the last committed bug
+# (see MANTIS_ID_FIELD below)
+TRAC_RESUME = False
+# If set, only bugs updated at or after this unix time are imported and
+# tickets imported before are updated (see --since).  'last' uses the
+# start time of the last successful import.
+SINCE = None
 
 # Enclose imported ticket description and comments in a {{{ }}} 
 # preformat block?  This formats the text in a fixed-point font.
@@ -169,8 +220,8 @@ IGNORE_COMMENTS = [
 # changes table.
 # Mantis, for unknown reasons, has fields that can change two states 
 # in under a second (e.g. "milestone":""->"1.0", "milestone":"1.0"->"2.0").
-# Setting this to true will attempt to fix these cases by adjusting the 
-# time for the 2nd change to be one second more than the original time.
+# Setting this to true will attempt to fix these cases by moving the
+# 2nd change to the next free microsecond after the original time.
 # I dont know why you'd want to turn this off, but I give you the option 
 # anyhow. :)
 TIME_ADJUSTMENT_HACK = True
@@ -178,6 +229,99 @@ TIME_ADJUSTMENT_HACK = True
 # If set to true, version numbers wont be assigned to tickets (just milestones)
 IGNORE_VERSION = False
 
+# Number of bugs whose texts, notes, history and attachments are loaded
+# from Mantis together.  Each chunk costs one query per table instead of
+# one query per bug (and per note).
+PREFETCH_CHUNK_SIZE = 500
+
+# The Trac database is committed after this many imported tickets, or
+# after COMMIT_EVERY_SECONDS seconds, whichever comes first.  Each ticket
+# is imported on its own savepoint, so a failing ticket is rolled back
+# without losing the rest of the batch.  Set COMMIT_EVERY_SECONDS to 0 to
+# only commit by ticket count.  Both can be set on the command line.
+COMMIT_EVERY_TICKETS = 100
+COMMIT_EVERY_SECONDS = 30
+
+# Attachments are copied from the Mantis database to the Trac attachment
+# directory in windows of this many bytes, so larger files are never held
+# in memory as a whole.  MySQL reads the whole BLOB for every window, so
+# this is also the size up to which a file is read only once, see
+# copyAttachment.
+ATTACHMENT_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Where Mantis stores the attachment contents ($g_file_upload_method):
+#  - 'database': in mantis_bug_file_table.content
+#  - 'disk':     in the file 'folder'/'diskfile' on this machine
+#  - 'ftp':      on the FTP server; the files are read from a local mirror
+#                of the upload directory in ATTACHMENT_FTP_MIRROR
+ATTACHMENT_SOURCE = 'database'
+ATTACHMENT_FTP_MIRROR = '/var/mirror/mantis-uploads/'
+
+# Hard link disk and FTP mirror files into the Trac environment instead of
+# copying them (falls back to copying across file systems)
+ATTACHMENT_LINK_FILES = True
+
+# Number of threads writing attachments while the tickets are converted.
+# Attachments with identical content are replaced by hard links to the
+# first copy.
+ATTACHMENT_THREADS = 4
+
+# Custom ticket field holding the Mantis bug id of every imported ticket.
+# It is written in the same transaction as the ticket, so it always
+# matches the committed tickets.  It is used to resume an import that was
+# interrupted (--resume) and to find the tickets to update (--since).  Add
+# "mantis_id = text" to the [ticket-custom] section of trac.ini to show it.
+MANTIS_ID_FIELD = 'mantis_id'
+
+# File holding the time of the last successful import, used by
+# '--since last'.  None puts it into the Trac environment as
+# 'mantis2trac.lastsync'.
+LAST_SYNC_FILE = None
+
+# Number of worker processes that prefetch and translate bugs.  Tickets
+# are still written by a single process, in bug id order.  Can also be
+# set on the command line.
+JOBS = 1
+
+# Number of bugs read per page while walking mantis_bug_table.  Bugs are
+# paged by id, so memory use does not grow with the size of the database.
+STREAM_CHUNK_SIZE = 1000
+
+# Print every imported ticket, comment, change and attachment.  A line per
+# row slows down large imports noticeably.  Can also be set on the command
+# line (--verbose).
+VERBOSE = False
+
+# Seconds between two progress lines (with an ETA) while the bugs are
+# imported, 0 disables them
+PROGRESS_INTERVAL = 10
+
+# If set, a JSON report with the wall time of every phase and counters of
+# the queries, rows, commits and bytes is written to this file (--report)
+METRICS_REPORT = None
+
+# Time every statement on the Mantis and Trac databases and list the
+# PROFILE_TOP statements taking the most time at the end (--profile).
+# Statements slower than SLOW_QUERY_SECONDS are printed when they finish.
+PROFILE_QUERIES = False
+PROFILE_TOP = 20
+SLOW_QUERY_SECONDS = 1.0
+
+# Read and translate all bugs, but do not write anything to the Trac
+# environment (--dry-run).  Queries on the Trac database are still run,
+# all other statements, the attachment files and the last import time are
+# discarded and only counted.  Useful to size an import and to tune the
+# chunk and batch sizes against a production database.
+DRY_RUN = False
+
+# Instead of importing directly, the Mantis data can be extracted into a
+# directory once (--extract <dir>, needs no Trac environment except for
+# '--since last') and loaded into Trac from there as often as needed
+# (--load <dir>, needs no Mantis database).  Bugs, notes and history are
+# stored as newline-delimited JSON, attachments by their sha1.
+EXTRACT_DIR = None
+LOAD_DIR = None
+
 ###########################################################################
 ### You probably don't need to change any configuration past this line. ###
 ###########################################################################
@@ -291,6 +435,15 @@ PRIORITY_TRANSLATE = {
 # otherwise you'd see changes for fields that don't exist in Trac.
 IGNORED_ACTIVITY_FIELDS = ['', 'project_id', 'reproducibility', 'view_state', 'os', 'os_build', 'duplicate_id']
 
+# Additional translations of Mantis history fields (lower case), which
+# override the built-in ones.  A string value renames the field, e.g.
+# 'fixed_in_version' : 'milestone'.  A function is called with the ticket
+# change (a dict with the 'field', 'oldvalue', 'newvalue', 'time' and
+# 'author' keys) and the BugHistory of the bug, and returns the change or
+# None to drop it.
+ACTIVITY_TRANSLATORS = {
+}
+
 ###
 ### Script begins here
 ###
@@ -300,11 +453,20 @@ import re
 import sys
 import string
 import StringIO
+import collections
+import multiprocessing
+import threading
+import Queue
+import shutil
+import bisect
+import json
 
 import MySQLdb
 import MySQLdb.cursors
 from trac.env import Environment
 
+from metrics import Metrics, QueryProfile, CountingConnection, NullConnection
+
 if not hasattr(sys, 'setdefaultencoding'):
     reload(sys)
 
@@ -328,17 +490,376 @@ class FieldTranslator(dict):
 
 statusXlator = FieldTranslator(STATUS_TRANSLATE)
 
+def intValue(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+# state of the history translation of a bug
+class BugHistory(object):
+    def __init__(self, loginName, comments):
+        self.loginName = loginName
+        self.comments = comments
+        self.changes = []
+        self.keywords = []
+        # problems to report, the history is translated without them
+        self.errors = []
+
+    def updateKeywords(self, ticketChange, add_keywords, remove_keywords):
+        """Add a keywords change along with `ticketChange`"""
+        # ensure removed ones are in old
+        old_keywords = self.keywords + [kw for kw in remove_keywords if kw not in self.keywords]
+        # remove from new
+        keywords = [kw for kw in self.keywords if kw not in remove_keywords]
+        # add to new
+        keywords += [kw for kw in add_keywords if kw not in keywords]
+        self.keywords = keywords
+        if old_keywords != keywords:
+            ticketChangeKw = ticketChange.copy()
+            ticketChangeKw['field'] = "keywords"
+            ticketChangeKw['oldvalue'] = ' '.join(old_keywords)
+            ticketChangeKw['newvalue'] = ' '.join(keywords)
+            self.changes.append(ticketChangeKw)
+
+def renameField(field):
+    def translate(ticketChange, history):
+        ticketChange['field'] = field
+        return ticketChange
+    return translate
+
+def enumField(translation):
+    # a change to or from a value missing from `translation` is reported
+    # and skipped, the rest of the bug is imported
+    def translate(ticketChange, history):
+        try:
+            old = translation[int(ticketChange['oldvalue'])]
+            new = translation[int(ticketChange['newvalue'])]
+        except (KeyError, ValueError):
+            history.errors.append("unknown %s value in change \"%s\" -> \"%s\" (%s), the change was skipped"
+                                  % (ticketChange['field'], ticketChange['oldvalue'], ticketChange['newvalue'], ticketChange['time']))
+            return None
+        ticketChange['oldvalue'] = old
+        ticketChange['newvalue'] = new
+        return ticketChange
+    return translate
+
+class ActivityTranslator(object):
+    """Translate Mantis history rows into Trac ticket changes.
+
+    The translator of each field is looked up in a table built once from
+    the translation maps and ACTIVITY_TRANSLATORS.  Fields without a
+    translator are copied as they are, ignored fields are dropped before
+    their values are looked at.
+    """
+    def __init__(self, ignored=IGNORED_ACTIVITY_FIELDS, extra=ACTIVITY_TRANSLATORS):
+        self.ignored = frozenset(ignored)
+        self.table = {
+            'handler_id' : self.owner,
+            'name' : renameField('component'),
+            'version' : renameField('milestone'),
+            'status' : self.status,
+            'priority' : enumField(PRIORITY_TRANSLATE),
+            'resolution' : enumField(RESOLUTION_TRANSLATE),
+            'severity' : enumField(SEVERITY_TRANSLATE),
+            'source_changeset_attached' : self.changeset,
+        }
+        for field, translator in extra.iteritems():
+            if isinstance(translator, basestring):
+                translator = renameField(translator)
+            self.table[field.lower()] = translator
+
+    def translate(self, activity, history):
+        field_name = activity['field_name'].lower()
+        if field_name in self.ignored:
+            return
+        ticketChange = {
+            'field' : field_name,
+            'oldvalue' : activity['old_value'],
+            'newvalue' : activity['new_value'],
+            'time' : activity['date_modified'],
+            'author' : history.loginName(activity['user_id']),
+        }
+        translator = self.table.get(field_name)
+        if translator is not None:
+            ticketChange = translator(ticketChange, history)
+        # skip changes that have no effect (think translation!)
+        if ticketChange is None or ticketChange['oldvalue'] == ticketChange['newvalue']:
+            return
+        history.changes.append(ticketChange)
+
+    def owner(self, ticketChange, history):
+        ticketChange['field'] = 'owner'
+        ticketChange['oldvalue'] = history.loginName(intValue(ticketChange['oldvalue']))
+        ticketChange['newvalue'] = history.loginName(intValue(ticketChange['newvalue']))
+        return ticketChange
+
+    def status(self, ticketChange, history):
+        old = intValue(ticketChange['oldvalue'])
+        new = intValue(ticketChange['newvalue'])
+        ticketChange['oldvalue'] = STATUS_TRANSLATE.get(old, ticketChange['oldvalue'])
+        ticketChange['newvalue'] = STATUS_TRANSLATE.get(new, ticketChange['newvalue'])
+        remove_keywords = [STATUS_KEYWORDS[old]] if old in STATUS_KEYWORDS else []
+        add_keywords = [STATUS_KEYWORDS[new]] if new in STATUS_KEYWORDS else []
+        if add_keywords or remove_keywords:
+            history.updateKeywords(ticketChange, add_keywords, remove_keywords)
+        return ticketChange
+
+    def changeset(self, ticketChange, history):
+        # also add a comment linking to the changeset
+        try:
+            project, branch, commit = ticketChange['newvalue'].split()
+        except ValueError:
+            history.errors.append("unable to link changeset \"%s\", expected \"<project> <branch> <commit>\"" % ticketChange['newvalue'])
+        else:
+            wikivalue = '%s [/browser/?rev=%s %s] [%s]' % (project, commit, branch, commit)
+            history.comments.append((ticketChange['time'], ticketChange['author'], wikivalue))
+        return ticketChange
+
+activityTranslator = ActivityTranslator()
+
+# login names of the Mantis users preloaded by TracDatabase.preloadUsers.
+# Unknown users map to '' (anonymous).
+class UserNames(object):
+    def __init__(self, users):
+        self._names = dict([(userid, user['username']) for userid, user in users.iteritems()])
+
+    def __call__(self, userid):
+        try:
+            return self._names.get(int(userid), '')
+        except (TypeError, ValueError):
+            return ''
+
+# ticket fields (see TracDatabase.addTicket) that ticket changes are
+# applied to
+TICKET_COLUMNS = ['component', 'severity', 'priority', 'owner', 'reporter',
+                  'cc', 'version', 'milestone', 'status', 'resolution',
+                  'summary', 'description', 'keywords']
+
+# columns of the ticket table written by TracDatabase.addTicket
+TICKET_SQL_COLUMNS = ['type', 'time', 'changetime', 'component',
+                      'severity', 'priority', 'owner', 'reporter', 'cc',
+                      'version', 'milestone', 'status', 'resolution',
+                      'summary', 'description', 'keywords']
+
+# ticket changes that are stored under a different field name in Trac
+CHANGE_FIELD_RENAMES = {
+    'milestone' : 'product_version'
+}
+
+# (field, time) keys already used in ticket_change, per ticket.  Trac
+# stores times in microseconds, so colliding changes are moved to the
+# next free microsecond, which keeps them in their original order.
+class ChangeTimeIndex(object):
+    def __init__(self):
+        self._used = {}
+
+    def clear(self):
+        self._used = {}
+
+    def assign(self, ticket, field, time, adjust=True):
+        """Return a unique time for the change, or None if `time` is
+        taken and `adjust` is false"""
+        used = self._used.setdefault(ticket, set())
+        while (field, time) in used:
+            if not adjust:
+                return None
+            time += 1
+        used.add((field, time))
+        return time
+
 class TracDatabase(object):
-    def __init__(self, path, append):
-        self.append = _append
+    def __init__(self, path, append, commitTickets=COMMIT_EVERY_TICKETS, commitSeconds=COMMIT_EVERY_SECONDS, metrics=None, dryRun=False):
+        self._append = append
         self.env = Environment(path)
         self._db = self.env.get_db_cnx()
         self._db.autocommit = False
+        # a dry run needs the metrics to count what it discards
+        self.dryRun = dryRun
+        if dryRun:
+            self._db = NullConnection(self._db, metrics, 'trac')
+        if metrics is not None:
+            self._db = CountingConnection(self._db, metrics, 'trac')
         self.loginNameCache = {}
         self.fieldNameCache = {}
+
+        # Mantis users by id, the sids of the authenticated Trac sessions
+        # and their (sid, name) attributes, see preloadUsers
+        self.mantisUsers = None
+        self._sessionSids = set()
+        self._sessionAttributes = set()
+        self._sessionRows = []
+        self._sessionAttributeRows = []
+        # sids and attributes added by the current ticket
+        self._ticketSessions = []
+
+        self.commitTickets = max(1, int(commitTickets))
+        self.commitSeconds = commitSeconds
+        self.commitCount = 0
+        self._pendingTickets = 0
+        self._lastCommit = time.time()
+        # Trac's sqlite backend runs pysqlite in implicit transaction mode,
+        # which commits before every SAVEPOINT statement.  There, the
+        # statements of the current batch are journaled instead; a failing
+        # ticket rolls back the whole transaction and replays the journal of
+        # the tickets before it, see abortTicket.
+        self._savepoints = not self.env.config.get('trac', 'database').startswith('sqlite:')
+        self._batchJournal = []
+        self._ticketJournal = []
+
+        # pending ticket_change rows and the keys used by the current ticket
+        self._changeRows = []
+        self._changeTimes = ChangeTimeIndex()
+        # (field, time) keys and attachment names the current ticket had
+        # before, see skipImported
+        self._importedChanges = set()
+        self._importedAttachments = set()
+
+        # AttachmentWriter that has to finish before every commit, so the
+        # files of committed tickets exist, and the writes queued for the
+        # current ticket
+        self.attachmentWriter = None
+        self._ticketAttachments = []
     
     def db(self):
         return self._db
+
+    def execute(self, sql, params=None):
+        """Execute `sql` as part of the current batch, returns the cursor"""
+        c = self.db().cursor()
+        c.execute(sql, params)
+        if not self._savepoints and not sql.lstrip().upper().startswith('SELECT'):
+            self._ticketJournal.append((sql, params, False))
+        return c
+
+    def executemany(self, sql, seq):
+        """Execute `sql` for each parameter tuple in `seq`"""
+        c = self.db().cursor()
+        c.executemany(sql, seq)
+        if not self._savepoints:
+            self._ticketJournal.append((sql, seq, True))
+        return c
+
+    def _replay(self, journal):
+        c = self.db().cursor()
+        for sql, params, many in journal:
+            if many:
+                c.executemany(sql, params)
+            else:
+                c.execute(sql, params)
+
+    def beginTicket(self):
+        """Start importing a ticket, see `endTicket` and `abortTicket`"""
+        # rows and statements queued outside of a ticket belong to the batch
+        self.flushSessions()
+        self.flushChanges()
+        self._batchJournal.extend(self._ticketJournal)
+        self._ticketJournal = []
+        self._ticketSessions = []
+        self._ticketAttachments = []
+        self._changeTimes.clear()
+        self._importedChanges = set()
+        self._importedAttachments = set()
+        if self._savepoints:
+            self.db().cursor().execute("SAVEPOINT mantis_ticket")
+
+    def endTicket(self):
+        """Keep the current ticket, see `commitIfDue`.
+
+        The sessions and ticket changes queued for the ticket are written
+        first, so a failing row rolls back only this ticket."""
+        self.flushSessions()
+        self.flushChanges()
+        if self._savepoints:
+            self.db().cursor().execute("RELEASE SAVEPOINT mantis_ticket")
+        self._batchJournal.extend(self._ticketJournal)
+        self._ticketJournal = []
+        self._ticketSessions = []
+        self._ticketAttachments = []
+        self._pendingTickets += 1
+
+    def commitIfDue(self):
+        """Commit if the batch is complete"""
+        if self._pendingTickets >= self.commitTickets or \
+                (self.commitSeconds and time.time() - self._lastCommit >= self.commitSeconds):
+            self.commit()
+
+    def abortTicket(self):
+        """Roll back the current ticket, keeping the rest of the batch"""
+        self._ticketJournal = []
+        self._changeRows = []
+        self._sessionRows = []
+        self._sessionAttributeRows = []
+        # the sessions of the ticket are queued again by the next ticket
+        # of their users
+        for userid, sid, attributes in self._ticketSessions:
+            self._sessionSids.discard(sid)
+            self._sessionAttributes -= attributes
+            self.loginNameCache.pop(userid, None)
+        self._ticketSessions = []
+        # the ticket id is used again by the next ticket, so its files must
+        # be gone before that one is written
+        if self._ticketAttachments:
+            self.attachmentWriter.discard(self._ticketAttachments)
+            self._ticketAttachments = []
+        if self._savepoints:
+            self.db().cursor().execute("ROLLBACK TO SAVEPOINT mantis_ticket")
+            self.db().cursor().execute("RELEASE SAVEPOINT mantis_ticket")
+        else:
+            self.db().rollback()
+            self._replay(self._batchJournal)
+
+    def commit(self):
+        if self.attachmentWriter is not None:
+            # an attachment whose file could not be written is not imported
+            for task in self.attachmentWriter.wait():
+                self.execute("DELETE FROM attachment WHERE type = 'ticket' AND id = %s AND filename = %s",
+                             (str(task.ticket), task.attachment['filename'].encode('utf-8')))
+        self.flushSessions()
+        self.flushChanges()
+        self.db().commit()
+        self.commitCount += 1
+        self._pendingTickets = 0
+        self._lastCommit = time.time()
+        self._batchJournal = []
+        self._ticketJournal = []
+
+    def flushChanges(self):
+        """Write all pending ticket_change rows"""
+        if self._changeRows:
+            self.executemany("""INSERT INTO ticket_change (ticket, time, author, field, oldvalue, newvalue)
+                                 VALUES        (%s, %s, %s, %s, %s, %s)""", self._changeRows)
+            self._changeRows = []
+
+    def _queueChange(self, ticket, time, author, field, oldvalue, newvalue, adjust=True):
+        # returns the time (in microseconds) the change was stored with,
+        # None if the time was already taken
+        time = self._changeTimes.assign(ticket, field, self.convertTime(time), adjust)
+        if time is not None and (field, time) not in self._importedChanges:
+            self._changeRows.append((ticket, time, author, field, oldvalue, newvalue))
+        return time
+
+    def skipImported(self, ticketId):
+        """Skip the comments, changes and attachments that ticket
+        `ticketId` got from an earlier import, until the next ticket.
+
+        The bug is translated from its full history again, so its changes
+        are assigned the same (field, time) keys as before.
+        """
+        c = self.db().cursor()
+        c.execute("SELECT field, time FROM ticket_change WHERE ticket = %s", (ticketId,))
+        self._importedChanges = set([(row[0], row[1]) for row in c.fetchall()])
+        c.execute("SELECT filename FROM attachment WHERE type = 'ticket' AND id = %s", (str(ticketId),))
+        self._importedAttachments = set([row[0] for row in c.fetchall()])
+
+    def attachmentImported(self, filename):
+        return filename in self._importedAttachments
+
+    def commitPolicy(self):
+        policy = "every %d tickets" % self.commitTickets
+        if self.commitSeconds:
+            policy += " or %s seconds" % self.commitSeconds
+        return policy
     
     def hasTickets(self):
         c = self.db().cursor()
@@ -346,6 +867,8 @@ class TracDatabase(object):
         return int(c.fetchall()[0][0]) > 0
 
     def assertNoTickets(self):
+        if self.dryRun:
+            return
         if not self._append or self.hasTickets():
           raise Exception("Will not modify database with existing tickets!")
           return
@@ -357,10 +880,11 @@ class TracDatabase(object):
         c = self.db().cursor()
         c.execute("""DELETE FROM enum WHERE type='severity'""")
         for value, i in s:
-            print "inserting severity ", value, " ", i
+            if VERBOSE:
+                print "inserting severity ", value, " ", i
             c.execute("""INSERT INTO enum (type, name, value) VALUES (%s, %s, %s)""",
                       ("severity", value.encode('utf-8'), i,))
-        self.db().commit()
+        self.commit()
     
     def setPriorityList(self, s):
         """Remove all priorities, set them to `s`"""
@@ -369,10 +893,11 @@ class TracDatabase(object):
         c = self.db().cursor()
         c.execute("""DELETE FROM enum WHERE type='priority'""")
         for value, i in s:
-            print "inserting priority ", value, " ", i
+            if VERBOSE:
+                print "inserting priority ", value, " ", i
             c.execute("""INSERT INTO enum (type, name, value) VALUES (%s, %s, %s)""",
                       ("priority", value.encode('utf-8'), i,))
-        self.db().commit()
+        self.commit()
     
     def setComponentList(self, l, key):
         """Remove all components, set them to `l`"""
@@ -381,10 +906,11 @@ class TracDatabase(object):
         c = self.db().cursor()
         c.execute("""DELETE FROM component""")
         for comp in l:
-            print "inserting component '",comp[key],"', owner",  comp['owner']
+            if VERBOSE:
+                print "inserting component '",comp[key],"', owner",  comp['owner']
             c.execute("""INSERT INTO component (name, owner) VALUES (%s, %s)""",
                       (comp[key].encode('utf-8'), comp['owner'].encode('utf-8'),))
-        self.db().commit()
+        self.commit()
     
     def setVersionList(self, v, key):
         """Remove all versions, set them to `v`"""
@@ -393,10 +919,11 @@ class TracDatabase(object):
         c = self.db().cursor()
         c.execute("""DELETE FROM version""")
         for vers in v:
-            print "inserting version ", vers[key]
+            if VERBOSE:
+                print "inserting version ", vers[key]
             c.execute("""INSERT INTO version (name) VALUES (%s)""",
                       (vers[key].encode('utf-8'),))
-        self.db().commit()
+        self.commit()
         
     def setMilestoneList(self, m, key):
         """Remove all milestones, set them to `m`"""
@@ -405,39 +932,37 @@ class TracDatabase(object):
         c = self.db().cursor()
         c.execute("""DELETE FROM milestone""")
         for ms in m:
-            print "inserting milestone ", ms[key]
+            if VERBOSE:
+                print "inserting milestone ", ms[key]
             c.execute("""INSERT INTO milestone (name, due, completed) VALUES (%s, %s, %s)""",
                       (ms[key].encode('utf-8'), self.convertTime(ms['date_order']), ms['released']))
-        self.db().commit()
+        self.commit()
     
-    def addTicket(self, id, time, changetime, component,
-                  severity, priority, owner, reporter, cc,
-                  version, milestone, status, resolution,
-                  summary, description, keywords):
-        c = self.db().cursor()
+    def _ticketValues(self, time, changetime, component,
+                      severity, priority, owner, reporter, cc,
+                      version, milestone, status, resolution,
+                      summary, description, keywords):
+        # column values in the order of TICKET_SQL_COLUMNS
         if IGNORE_VERSION:
           version=''
-        
+
         desc = description
-	type = 'defect'
- 	if component == 'Features' or severity == 'feature':
-	  type = 'enhancement'
+        type = 'defect'
+        if component == 'Features' or severity == 'feature':
+          type = 'enhancement'
         if PREFORMAT_COMMENTS:
           desc = '{{{\n%s\n}}}' % desc
-	print "inserting ticket %s -- \"%s\"" % (id, summary[0:40].replace("\n", " "))
-        c.execute("""INSERT INTO ticket (type, time, changetime, component,
-                                         severity, priority, owner, reporter, cc,
-                                         version, milestone, status, resolution,
-                                         summary, description, keywords)
-                                 VALUES (%s, %s, %s, %s,
-                                         %s, %s, %s, %s, %s,
-                                         %s, %s, %s, %s,
-                                         %s, %s, %s)""",
-                  (type, self.convertTime(time), self.convertTime(changetime), component.encode('utf-8'),
-                  severity.encode('utf-8'), priority.encode('utf-8'), owner, reporter, cc,
-                  version, milestone.encode('utf-8'), status.lower(), resolution,
-                  summary.decode('utf-8'), desc, keywords.encode('utf-8')))
-        self.db().commit()
+        return (type, self.convertTime(time), self.convertTime(changetime), component.encode('utf-8'),
+                severity.encode('utf-8'), priority.encode('utf-8'), owner, reporter, cc,
+                version, milestone.encode('utf-8'), status.lower(), resolution,
+                summary.decode('utf-8'), desc, keywords.encode('utf-8'))
+
+    def addTicket(self, id, **fields):
+        if VERBOSE:
+            print "inserting ticket %s -- \"%s\"" % (id, fields['summary'][0:40].replace("\n", " "))
+        c = self.execute("""INSERT INTO ticket (%s)
+                                 VALUES (%s)""" % (', '.join(TICKET_SQL_COLUMNS), ', '.join(['%s'] * len(TICKET_SQL_COLUMNS))),
+                         self._ticketValues(**fields))
 
         ## TODO: add database-specific methods to get the last inserted ticket's id...
         ## PostgreSQL:
@@ -449,57 +974,47 @@ class TracDatabase(object):
         # Oh, Trac db abstraction layer already has a function for this...
         return self.db().get_last_id(c,'ticket')
 
+    def updateTicket(self, ticketId, id, **fields):
+        """Overwrite ticket `ticketId` with the current state of bug `id`"""
+        if VERBOSE:
+            print "updating ticket %s -- \"%s\"" % (ticketId, fields['summary'][0:40].replace("\n", " "))
+        values = self._ticketValues(**fields)
+        columns = [(column, value) for column, value in zip(TICKET_SQL_COLUMNS, values)
+                   if column != 'time']
+        self.execute("UPDATE ticket SET %s WHERE id = %%s" % ', '.join(['%s = %%s' % column for column, value in columns]),
+                     tuple([value for column, value in columns]) + (ticketId,))
+
     def convertTime(self,time2):
 	time2 = datetime.fromtimestamp(time2)
 	return long(str(int(time.mktime(time2.timetuple()))) + '000000')
     
     def addTicketComment(self, ticket, time, author, value):
 	#return
-        print " * adding comment \"%s...\"" % value[0:40]
+        if VERBOSE:
+            print " * adding comment \"%s...\"" % value[0:40]
         comment = value
 
         if PREFORMAT_COMMENTS:
           comment = '{{{\n%s\n}}}' % comment
 
-        c = self.db().cursor()
-        c.execute("""INSERT  INTO ticket_change (ticket, time, author, field, oldvalue, newvalue)
-                                 VALUES        (%s, %s, %s, %s, %s, %s)""",
-                  (ticket, self.convertTime(time), author, 'comment', '', comment))
-        self.db().commit()
+        self._queueChange(ticket, time, author, 'comment', '', comment)
 
     def addTicketChange(self, ticket, time, author, field, oldvalue, newvalue):
+        """Add a ticket change, returns the time (in microseconds) it was
+        stored with or None if the time was taken and could not be adjusted.
+
+        The ticket itself is not updated, see `applyTicketChanges`.
+        """
         if (field[0:4]=='doba'): 
-          return
+          return self.convertTime(time)
 
-	if field == 'milestone':
-	  field = 'product_version'
+        field = CHANGE_FIELD_RENAMES.get(field, field)
+
+        if VERBOSE:
+            print " * adding ticket change \"%s\": \"%s\" -> \"%s\" (%s)" % (field, oldvalue[0:20], newvalue[0:20], time)
+
+        return self._queueChange(ticket, time, author, field, oldvalue.encode('utf-8'), newvalue.encode('utf-8'), TIME_ADJUSTMENT_HACK)
 
-        print " * adding ticket change \"%s\": \"%s\" -> \"%s\" (%s)" % (field, oldvalue[0:20], newvalue[0:20], time)
-        c = self.db().cursor()
-	
-	#workaround 'unique' ticket_change warnings POTENTIALLY BAD IDEA ALERT
-	sql = "SELECT * FROM ticket_change WHERE field='%s' AND ticket=%s AND time=%s" % (field, ticket, self.convertTime(time))
-	c.execute(sql)
-	fixtime = c.fetchall()
-	if fixtime:
-	  time = time + 1
-        c.execute("""INSERT  INTO ticket_change (ticket, time, author, field, oldvalue, newvalue)
-                                 VALUES        (%s, %s, %s, %s, %s, %s)""",
-                  (ticket, self.convertTime(time), author, field, oldvalue.encode('utf-8'), newvalue.encode('utf-8')))
-        self.db().commit()
-       
-	#workaround 'unique' ticket warnings POTENTIALLY BAD IDEA ALERT
-        sql = "SELECT * FROM ticket WHERE %s='%s' AND id=%s AND time=%s" % (field, newvalue, ticket, self.convertTime(time))
-        c.execute(sql)
-        fixtime = c.fetchall()
-        if fixtime:
-          time = time + 1
- 
-	# Now actually change the ticket because the ticket wont update itself!
-	sql = "UPDATE ticket SET %s='%s' WHERE id=%s" % (field, newvalue, ticket)
-        c.execute(sql)
-        self.db().commit()        
-        
     # unused in 1.2
     def addAttachment(self, id, attachment, description, author):
         print 'inserting attachment for ticket %s -- %s' % (id, description)
@@ -507,69 +1022,87 @@ class TracDatabase(object):
         self.env.create_attachment(self.db(), 'ticket', str(id), attachment, description.encode('utf-8'),
             author, 'unknown')
         
+    def preloadUsers(self, users):
+        """Set the Mantis `users` (see readUsers) and load the existing
+        Trac sessions"""
+        self.mantisUsers = dict([(int(row['id']), row) for row in users])
+        c = self.db().cursor()
+        c.execute("SELECT sid FROM session WHERE authenticated = 1")
+        self._sessionSids = set([row[0] for row in c.fetchall()])
+        c.execute("SELECT sid, name FROM session_attribute WHERE authenticated = 1")
+        self._sessionAttributes = set([(row[0], row[1]) for row in c.fetchall()])
+        return self.mantisUsers
+
     def getLoginName(self, cursor, userid):
-        if userid not in self.loginNameCache and userid is not None and userid != '':
-	    cursor.execute("SELECT username,email,realname,last_visit FROM mantis_user_table WHERE id = %i" % int(userid))
+        """Return the login name of a Mantis user and queue a session for
+        it, see `flushSessions`.  Unknown users are anonymous ('')."""
+        try:
+            userid = int(userid)
+        except (TypeError, ValueError):
+            return ''
+        if userid in self.loginNameCache:
+            return self.loginNameCache[userid]
+
+        if self.mantisUsers is None:
+            cursor.execute("SELECT id, username, email, realname, last_visit FROM mantis_user_table WHERE id = %d" % userid)
             result = cursor.fetchall()
-
-            if result:
-                loginName = result[0]['username']
-                print 'Adding user %s to sessions table' % loginName
-                c = self.db().cursor()
-
-                # check if user is already in the sessions table
-                c.execute("SELECT sid FROM session WHERE sid = '%s'" % result[0]['username'].encode('utf-8'))
-                r = c.fetchall()
-                
-                # if there was no user sid in the database already
-                if not r:
-                    sessionSql = """INSERT INTO session 
-                            (sid, authenticated, last_visit) 
-                        VALUES (%s, %s, %d)""", (result[0]['username'].encode('utf-8'), '1', self.convertTime(result[0]['last_visit']))
-                    # pre-populate the session table and the realname/email table with user data
-                    try:
-                        c.execute(sessionSql)
-                    except:
-                        print 'failed executing sql: '
-                        print sessionSql
-                        print 'could not insert %s into sessions table: sql error ' % (loginName)
-                    self.db().commit()
-                
-                    # insert the user's real name into session attribute table
-                    try:
-   		        c.execute(
-                        """INSERT INTO session_attribute 
-                            (sid, authenticated, name, value)
-                        VALUES
-                            (%s, %s, %s, %s)""", (result[0]['username'].encode('utf-8'), '1', 'name', result[0]['realname'].encode('utf-8')))
-		    except:
-			print 'failed executing session-attribute sql'
-                    self.db().commit()
-
-                    # insert the user's email into session attribute table
-		    try:
-                        c.execute(
-                        """INSERT INTO session_attribute 
-                            (sid, authenticated, name, value)
-                        VALUES
-                            (%s, %s, %s, %s)""", (result[0]['username'].encode('utf-8'), '1', 'email', result[0]['email'].encode('utf-8')))
-		    except:
-			print 'failed executing session-attribute sql2'
-                    self.db().commit()
-            else:
-                print 'warning: unknown mantis userid %d, recording as anonymous' % userid
-                loginName = ''
-
-            self.loginNameCache[userid] = loginName
-	elif userid is None or userid == '':
-	    self.loginNameCache[userid] = ''
-        return self.loginNameCache[userid]
+            user = result and result[0] or None
+        else:
+            user = self.mantisUsers.get(userid)
+
+        if user:
+            loginName = user['username']
+            sid = loginName.encode('utf-8')
+            # pre-populate the session table and the realname/email table with user data
+            if sid not in self._sessionSids:
+                if VERBOSE:
+                    print 'Adding user %s to sessions table' % loginName
+                self._sessionSids.add(sid)
+                self._sessionRows.append((sid, '1', self.convertTime(user['last_visit'])))
+                attributes = set()
+                for name, value in (('name', user['realname']), ('email', user['email'])):
+                    if (sid, name) not in self._sessionAttributes:
+                        attributes.add((sid, name))
+                        self._sessionAttributeRows.append((sid, '1', name, value.encode('utf-8')))
+                self._sessionAttributes |= attributes
+                self._ticketSessions.append((userid, sid, attributes))
+        else:
+            print 'warning: unknown mantis userid %d, recording as anonymous' % userid
+            loginName = ''
+
+        self.loginNameCache[userid] = loginName
+        return loginName
+
+    def flushSessions(self):
+        """Write the sessions queued by `getLoginName`"""
+        if self._sessionRows:
+            self.executemany("""INSERT INTO session (sid, authenticated, last_visit)
+                                 VALUES (%s, %s, %s)""", self._sessionRows)
+            self._sessionRows = []
+        if self._sessionAttributeRows:
+            self.executemany("""INSERT INTO session_attribute (sid, authenticated, name, value)
+                                 VALUES (%s, %s, %s, %s)""", self._sessionAttributeRows)
+            self._sessionAttributeRows = []
 
     def get_attachments_dir(self,bugid=0):
+        # Trac 1.0 stores the attachments of a ticket in a directory named
+        # after the sha1 of the ticket id
+        path = os.path.join(self.env.path, 'files', 'attachments', 'ticket')
         if bugid > 0:
-            return 'importfiles/%i/' % bugid        
-        else:
-            return 'importfiles/'
+            path_hash = hashlib.sha1(str(bugid)).hexdigest()
+            path = os.path.join(path, path_hash[0:3], path_hash)
+        return path
+
+    def writeAttachment(self, ticketId, attachment):
+        """Queue the file of `attachment` to be written for ticket
+        `ticketId`, see AttachmentWriter"""
+        path = self.attachmentPath(ticketId, attachment['filename'])
+        self._ticketAttachments.append(self.attachmentWriter.add(attachment, path, ticketId))
+
+    def attachmentPath(self, bugid, filename):
+        """Return the path Trac stores attachment `filename` of ticket `bugid` at"""
+        file_hash = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+        return os.path.join(self.get_attachments_dir(bugid), file_hash + os.path.splitext(filename)[1])
 
     def _mkdir(newdir):
         """works the way a good mkdir should :)
@@ -590,6 +1123,62 @@ class TracDatabase(object):
             if tail:
                 os.mkdir(newdir)
 
+class Checkpoint(object):
+    """Mantis bug id -> Trac ticket id map of all committed tickets.
+
+    The Mantis id is stored as the custom field `field` of the ticket by
+    `add`, as part of the ticket, so the map is committed or rolled back
+    together with the ticket and a resumed import never imports a bug
+    twice.
+    """
+    def __init__(self, trac, field=MANTIS_ID_FIELD):
+        self.trac = trac
+        self.field = field
+        self.ticketIds = {}
+
+    def load(self):
+        c = self.trac.db().cursor()
+        c.execute("SELECT ticket, value FROM ticket_custom WHERE name = %s", (self.field,))
+        for ticketid, bugid in c.fetchall():
+            self.ticketIds[int(bugid)] = int(ticketid)
+        return self
+
+    def lastBugId(self):
+        if not self.ticketIds:
+            return None
+        return max(self.ticketIds)
+
+    def add(self, bugid, ticketid):
+        self.trac.execute("INSERT INTO ticket_custom (ticket, name, value) VALUES (%s, %s, %s)",
+                          (ticketid, self.field, str(bugid)))
+
+def parseSince(value):
+    """Parse a --since argument: a unix timestamp, 'YYYY-MM-DD' or
+    'YYYY-MM-DD HH:MM:SS' (local time)"""
+    if value.isdigit():
+        return int(value)
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(value, format)))
+        except ValueError:
+            pass
+    raise ValueError("invalid time '%s'" % value)
+
+def readLastSync(path):
+    if not os.path.exists(path):
+        return None
+    value = open(path).read().strip()
+    if not value:
+        return None
+    return int(value)
+
+def writeLastSync(path, timestamp):
+    f = open(path, 'w')
+    try:
+        f.write('%d\n' % timestamp)
+    finally:
+        f.close()
+
 def productFilter(fieldName, products):
     first = True
     result = ''
@@ -600,8 +1189,774 @@ def productFilter(fieldName, products):
         result += "%s = '%s'" % (fieldName, product)
     return result
 
-def convert(_db, _host, _user, _password, _env, _force, _append):
+def applyTicketChanges(ticket, ticketChanges):
+    """Fold `ticketChanges` into `ticket`, so that the ticket can be
+    inserted with its final state instead of being updated per change"""
+    for ticketChange in ticketChanges:
+        field = ticketChange['field']
+        if field in TICKET_COLUMNS and field not in CHANGE_FIELD_RENAMES:
+            ticket[field] = ticketChange['newvalue']
+
+def idList(ids):
+    return ', '.join(['%d' % int(i) for i in ids])
+
+def keysetRows(cursor, sql, idColumn, idKey='id', chunkSize=STREAM_CHUNK_SIZE, afterId=None):
+    """Yield the rows of `sql` in pages of `chunkSize`, ordered by `idColumn`.
+
+    `sql` must end in a WHERE clause; the paging condition is appended to it.
+    If `afterId` is given, only rows with a greater id are returned.
+    """
+    lastId = afterId
+    while True:
+        page = sql
+        if lastId is not None:
+            page += " AND %s > %d" % (idColumn, lastId)
+        page += " ORDER BY %s LIMIT %d" % (idColumn, chunkSize)
+        cursor.execute(page)
+        rows = cursor.fetchall()
+        for row in rows:
+            yield row
+        if len(rows) < chunkSize:
+            return
+        lastId = int(rows[-1][idKey])
+
+# split a sequence into lists of at most `size` items
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def groupRows(rows, key):
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row[key], []).append(row)
+    return grouped
+
+def copyAttachment(cursor, fileid, path, chunkSize=ATTACHMENT_CHUNK_SIZE):
+    """Copy the content of attachment `fileid` to `path` in windows of
+    `chunkSize` bytes, returns the sha1 hex digest of the content and the
+    number of bytes written.
+
+    The data is written to a temporary file that is renamed when complete,
+    so an interrupted copy leaves no partial attachment behind.
+
+    Each SUBSTRING window makes the server read the whole BLOB again, so a
+    file of n windows costs n full reads.  Streaming does not help here:
+    an unbuffered cursor streams rows, but MySQLdb still receives the
+    content column of a row as one string.  A large `chunkSize` reads most
+    files once at the cost of holding up to `chunkSize` bytes per writer
+    thread in memory; a small one bounds the memory but rereads big files.
+    """
+    tmpPath = path + '.part'
+    written = 0
+    digest = hashlib.sha1()
+    out = open(tmpPath, 'wb')
+    try:
+        while True:
+            cursor.execute("SELECT SUBSTRING(content, %d, %d) AS chunk FROM mantis_bug_file_table WHERE id = %d"
+                           % (written + 1, chunkSize, int(fileid)))
+            rows = cursor.fetchall()
+            chunk = rows and rows[0]['chunk'] or ''
+            out.write(chunk)
+            digest.update(chunk)
+            written += len(chunk)
+            if len(chunk) < chunkSize:
+                break
+        out.close()
+        os.rename(tmpPath, path)
+    except:
+        out.close()
+        os.remove(tmpPath)
+        raise
+    return digest.hexdigest(), written
+
+# Attachment sources.  copy() writes the content of an attachment to a path
+# in the Trac environment and returns a tuple identifying the content,
+# whose last item is its size.
+class DatabaseAttachmentSource(object):
+    def copy(self, cursor, attachment, path):
+        # the digest is computed while the file is written, the content
+        # is read only once
+        digest, size = copyAttachment(cursor, attachment['id'], path)
+        return ('sha1', digest, size)
+
+class DiskAttachmentSource(object):
+    def __init__(self, linkFiles=ATTACHMENT_LINK_FILES):
+        self.linkFiles = linkFiles
+
+    def localPath(self, attachment):
+        # older Mantis versions store the full path in 'diskfile'
+        return os.path.join(attachment['folder'] or '', attachment['diskfile'])
+
+    def key(self, attachment, st):
+        # files with the same inode have the same content
+        return ('inode', st.st_dev, st.st_ino, st.st_size)
+
+    def copy(self, cursor, attachment, path):
+        source = self.localPath(attachment)
+        key = self.key(attachment, os.stat(source))
+        if self.linkFiles:
+            try:
+                os.link(source, path)
+                return key
+            except OSError:
+                pass
+        shutil.copyfile(source, path + '.part')
+        os.rename(path + '.part', path)
+        return key
+
+class FtpMirrorAttachmentSource(DiskAttachmentSource):
+    def __init__(self, mirror=ATTACHMENT_FTP_MIRROR, linkFiles=ATTACHMENT_LINK_FILES):
+        DiskAttachmentSource.__init__(self, linkFiles)
+        self.mirror = mirror
+
+    def localPath(self, attachment):
+        # Mantis uploads the files to the root of the FTP server
+        return os.path.join(self.mirror, os.path.basename(attachment['diskfile']))
+
+ATTACHMENT_SOURCES = {
+    'database' : DatabaseAttachmentSource,
+    'disk' : DiskAttachmentSource,
+    'ftp' : FtpMirrorAttachmentSource,
+}
+
+class AttachmentTask(object):
+    """An attachment file queued on an AttachmentWriter"""
+    def __init__(self, attachment, path, ticket):
+        self.attachment = attachment
+        self.path = path
+        self.ticket = ticket
+        self.key = None
+        self.error = None
+        self.written = False
+        self.cancelled = False
+        self.finished = threading.Event()
+
+class AttachmentWriter(object):
+    """Copy attachments to the Trac attachment tree in background threads.
+
+    Each thread has its own Mantis connection.  An attachment whose content
+    has the same key (see DatabaseAttachmentSource) as an earlier one is
+    replaced by a hard link to it once it is written.  `wait` returns the tasks that failed, so their
+    attachment rows can be removed before the commit, and `discard` removes
+    the files of a ticket that was rolled back.  The queries of the threads
+    are counted in `metrics` when they are closed.
+    """
+    def __init__(self, connectArgs, source, threads=ATTACHMENT_THREADS, metrics=None):
+        self.source = source
+        self.metrics = metrics
+        self._threadMetrics = []
+        self.errors = []
+        self.duplicates = 0
+        self.bytesSaved = 0
+        self.bytesWritten = 0
+        self._index = {}
+        self._lock = threading.Lock()
+        self._connectArgs = connectArgs
+        self._threadCount = max(1, threads)
+        self._queue = Queue.Queue(self._threadCount * 4)
+        self._threads = []
+        self._tasks = []
+
+    def add(self, attachment, path, ticket):
+        """Queue `attachment` of `ticket` to be written to `path`, returns
+        the AttachmentTask"""
+        # the threads are started with the first attachment, after the
+        # --jobs worker processes were forked
+        while len(self._threads) < self._threadCount:
+            thread = threading.Thread(target=self._run, args=(self._connectArgs,))
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+        task = AttachmentTask(attachment, path, ticket)
+        self._tasks.append(task)
+        self._queue.put(task)
+        return task
+
+    def wait(self):
+        """Wait until all queued attachments are written, returns the
+        tasks that failed since the last call"""
+        self._queue.join()
+        failed = [task for task in self._tasks if task.error is not None and not task.cancelled]
+        for task in failed:
+            self.errors.append(" * ERROR: couldn't write attachment '%s' of ticket %s to %s, it was not imported: %s"
+                               % (task.attachment['filename'], task.ticket, task.path, task.error))
+        self._tasks = []
+        return failed
+
+    def discard(self, tasks):
+        """Cancel `tasks` and remove the files they wrote"""
+        for task in tasks:
+            task.cancelled = True
+        for task in tasks:
+            task.finished.wait()
+            # two files of the ticket may have had the same name
+            if task.written and os.path.exists(task.path):
+                os.remove(task.path)
+            # later duplicates of the content must not link to the path
+            with self._lock:
+                if task.key is not None and self._index.get(task.key) == task.path:
+                    del self._index[task.key]
+
+    def close(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        for metrics in self._threadMetrics:
+            self.metrics.merge(metrics)
+        self._threadMetrics = []
+
+    def _run(self, connectArgs):
+        # staged attachments are copied without a Mantis connection
+        con = cursor = None
+        if connectArgs is not None:
+            con = MySQLdb.connect(cursorclass=MySQLdb.cursors.DictCursor, **connectArgs)
+            if self.metrics is not None:
+                # merged by close, the metrics are not thread safe
+                metrics = self.metrics.child('attachments')
+                with self._lock:
+                    self._threadMetrics.append(metrics)
+                con = CountingConnection(con, metrics, 'mantis')
+            cursor = con.cursor()
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    break
+                try:
+                    if not task.cancelled:
+                        self._write(cursor, task)
+                except Exception, e:
+                    task.error = e
+                    # no partly written file is left behind
+                    if os.path.isfile(task.path):
+                        os.remove(task.path)
+            finally:
+                if task is not None:
+                    task.finished.set()
+                self._queue.task_done()
+        if con is not None:
+            con.close()
+
+    def _write(self, cursor, task):
+        attachment, path = task.attachment, task.path
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+
+        key = task.key = self.source.copy(cursor, attachment, path)
+        task.written = True
+
+        # the first file with some content is kept, the others are
+        # replaced by a hard link to it
+        with self._lock:
+            original = self._index.setdefault(key, path)
+        if original != path:
+            try:
+                # files linked from disk may be the same already, rename
+                # would leave both names
+                if not os.path.samefile(original, path):
+                    os.link(original, path + '.link')
+                    os.rename(path + '.link', path)
+            except OSError:
+                # the original was discarded meanwhile, the copy is kept
+                if os.path.exists(path + '.link'):
+                    os.remove(path + '.link')
+            else:
+                with self._lock:
+                    self.duplicates += 1
+                    self.bytesSaved += key[-1]
+                return
+        with self._lock:
+            self.bytesWritten += key[-1]
+
+class ChangesetIndex(object):
+    """source_changeset_attached history rows by bug and user, sorted by
+    date, to find the changeset a bugnote was added for"""
+    def __init__(self, history):
+        self._dates = {}
+        self._rows = {}
+        for row in sorted([row for row in history if row['field_name'] == 'source_changeset_attached'],
+                          key=lambda row: (row['date_modified'], row['id'])):
+            key = (row['bug_id'], row['user_id'])
+            self._dates.setdefault(key, []).append(row['date_modified'])
+            self._rows.setdefault(key, []).append(row)
+
+    def find(self, bugid, userid, time, window=2):
+        """Return the first changeset `userid` attached to bug `bugid` less
+        than `window` seconds before or after `time`, or None"""
+        dates = self._dates.get((bugid, userid))
+        if not dates:
+            return None
+        i = bisect.bisect_right(dates, time - window)
+        if i < len(dates) and dates[i] < time + window:
+            return self._rows[(bugid, userid)][i]
+        return None
+
+def prefetchBugData(cursor, bugs):
+    """Load the child rows of all `bugs` with one query per table.
+
+    Returns a dict mapping each bug id to a dict with the keys 'text',
+    'notes', 'history', 'changesets' (a ChangesetIndex) and
+    'attachments'.  The full history is loaded even when synchronizing,
+    the keywords and the final state of a ticket are derived from it.
+    """
+    bugIds = idList([bug['id'] for bug in bugs])
+    textIds = idList([bug['bug_text_id'] for bug in bugs])
+
+    cursor.execute("SELECT * FROM mantis_bug_text_table WHERE id IN (%s)" % textIds)
+    texts = dict([(row['id'], row) for row in cursor.fetchall()])
+
+    cursor.execute("SELECT * FROM mantis_bugnote_table, mantis_bugnote_text_table WHERE bug_id IN (%s) AND mantis_bugnote_table.bugnote_text_id = mantis_bugnote_text_table.id ORDER BY bug_id, date_submitted" % bugIds)
+    notes = groupRows(cursor.fetchall(), 'bug_id')
+
+    cursor.execute("SELECT * FROM mantis_bug_history_table WHERE bug_id IN (%s) ORDER BY bug_id, date_modified, id" % bugIds)
+    historyRows = cursor.fetchall()
+    history = groupRows(historyRows, 'bug_id')
+    changesets = ChangesetIndex(historyRows)
+
+    cursor.execute("SELECT b.id,b.bug_id,b.title,b.description,b.filename,b.filesize,b.file_type,b.diskfile,b.folder,b.date_added AS date_added, h.user_id FROM mantis_bug_file_table AS b LEFT JOIN mantis_bug_history_table AS h ON (h.type = 9 AND h.old_value = b.filename AND h.bug_id = b.bug_id) WHERE b.bug_id IN (%s) ORDER BY b.bug_id, b.id" % bugIds)
+    attachments = groupRows(cursor.fetchall(), 'bug_id')
+
+    data = {}
+    for bug in bugs:
+        data[bug['id']] = {
+            'text' : texts.get(bug['bug_text_id']),
+            'notes' : notes.get(bug['id'], []),
+            'history' : history.get(bug['id'], []),
+            'changesets' : changesets,
+            'attachments' : attachments.get(bug['id'], []),
+        }
+    return data
+
+def translateBug(bug, rows, userNames):
+    """Translate a Mantis bug and its prefetched `rows` into a Trac ticket.
+
+    Returns a dict with the final 'ticket' fields, its 'comments' and
+    'changes', the 'attachments' to copy, the Mantis 'users' the ticket
+    refers to and the translation 'errors' to report.  Nothing is written, so this can run in a worker
+    process, see `translatedBugs`.
+    """
+    bugid = bug['id']
+    users = set()
+    def loginName(userid):
+        users.add(userid)
+        return userNames(userid)
+
+    ticket = {}
+    keywords = []
+    ticket['id'] = bugid
+    ticket['time'] = bug['date_submitted']
+    ticket['changetime'] = bug['last_updated']
+    ticket['component'] = bug['name']
+    ticket['severity'] = SEVERITY_TRANSLATE[bug['severity']]
+    ticket['priority'] = PRIORITY_TRANSLATE[bug['priority']]
+    ticket['owner'] = loginName(bug['handler_id'])
+    ticket['reporter'] = loginName(bug['reporter_id'])
+    ticket['version'] = bug['version']
+    if IGNORE_VERSION:
+      ticket['version'] = ''
+    ticket['milestone'] = bug['version']
+    if bug['target_version']:
+      ticket['milestone'] = bug['target_version']
+    ticket['summary'] = bug['summary']
+    ticket['status'] = STATUS_TRANSLATE[bug['status']]
+    ticket['cc'] = ''
+    ticket['keywords'] = ''
+
+    # Special case for 'reopened' resolution in mantis -
+    # it maps to a status type in Trac.
+    if (bug['resolution'] == 30):
+        ticket['status'] = 'reopened'
+    ticket['resolution'] = RESOLUTION_TRANSLATE[bug['resolution']]
+
+    # Compose the description from the three text fields in Mantis:
+    # 'description', 'steps_to_reproduce', 'additional_information'
+    longdesc = rows['text']
+
+    # check for a missing bug text row...
+    if longdesc is None:
+        ticket['description'] = ''
+    else:
+        tmpDescr = longdesc['description']
+        if (longdesc['steps_to_reproduce'].strip() != ''):
+           tmpDescr = ('%s\n\n=== Steps to Reproduce ===\n%s') % (tmpDescr, longdesc['steps_to_reproduce'])
+        if (longdesc['additional_information'].strip() != ''):
+           tmpDescr = ('%s\n\n=== Additional Information ===\n%s') % (tmpDescr, longdesc['additional_information'])
+        ticket['description'] = tmpDescr
+
+    #
+    # Collect ticket comments
+    #
+    comments = []
+    bug_notes = rows['notes']
+    for note in bug_notes:
+      #Check for changesets, and add trac changeset links to the comments section where applicable
+      activity = rows['changesets'].find(bugid, note['reporter_id'], note['date_submitted'])
+      # malformed changesets are reported by ActivityTranslator.changeset
+      if activity and len(activity['new_value'].split()) == 3:
+            project, branch, commit = activity['new_value'].split()
+            wikivalue = '%s [/browser/?rev=%s %s] [%s]' % (project, commit, branch, commit)
+            note['note']  = note['note'] + "\n\n" + wikivalue
+      comments.append((note['date_submitted'], loginName(note['reporter_id']), note['note']))
+
+    #
+    # Convert ticket changes
+    #
+    history = BugHistory(loginName, comments)
+    for activity in rows['history']:
+        activityTranslator.translate(activity, history)
+    ticketChanges = history.changes
+    errors = history.errors
+
+    applyTicketChanges(ticket, ticketChanges)
+
+    attachments = rows['attachments']
+    for attachment in attachments:
+        attachment['author'] = loginName(attachment['user_id'])
+
+    return {
+        'id' : bugid,
+        'ticket' : ticket,
+        'comments' : comments,
+        'changes' : ticketChanges,
+        'attachments' : attachments,
+        'users' : users,
+        'errors' : errors,
+    }
+
+def translateOrReport(bug, rows, userNames):
+    """Like `translateBug`, but a bug that cannot be translated yields
+    a record with its 'id' and the 'error' instead of raising, so that
+    the import goes on with the next bug"""
+    try:
+        return translateBug(bug, rows, userNames)
+    except Exception, e:
+        return {'id' : bug['id'], 'error' : '%s: %s' % (e.__class__.__name__, e)}
+
+def translateChunk(cursor, bugs, userNames):
+    data = prefetchBugData(cursor, bugs)
+    return [translateOrReport(bug, data[bug['id']], userNames) for bug in bugs]
+
+# state of a --jobs worker process
+_worker = {}
+
+def _initWorker(connectArgs, userNames, metrics):
+    con = MySQLdb.connect(cursorclass=MySQLdb.cursors.DictCursor, **connectArgs)
+    _worker['cursor'] = CountingConnection(con, metrics, 'mantis').cursor()
+    _worker['userNames'] = userNames
+    _worker['metrics'] = metrics
+
+def _translateChunkInWorker(bugs):
+    records = translateChunk(_worker['cursor'], bugs, _worker['userNames'])
+    return records, _worker['metrics'].take()
+
+def translatedBugs(cursor, bugs, userNames, jobs=1, connectArgs=None, metrics=None):
+    """Yield the translated records of `bugs`, in the order of `bugs`.
+
+    With more than one job, chunks of bugs are prefetched and translated
+    by a pool of worker processes, each with its own Mantis connection.
+    At most two chunks per worker are in flight, so memory stays bounded.
+    The queries of the workers are counted in `metrics` with each chunk.
+    """
+    chunks = chunked(bugs, PREFETCH_CHUNK_SIZE)
+    if jobs <= 1:
+        for chunk in chunks:
+            for record in translateChunk(cursor, chunk, userNames):
+                yield record
+        return
+
+    if metrics is None:
+        metrics = Metrics('mantis2trac', 0)
+    pool = multiprocessing.Pool(jobs, _initWorker, (connectArgs, userNames, metrics.child('worker')))
+    def chunkRecords(result):
+        records, workerMetrics = result.get()
+        metrics.merge(workerMetrics)
+        return records
+    try:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_translateChunkInWorker, (chunk,)))
+            if len(pending) >= 2 * jobs:
+                for record in chunkRecords(pending.popleft()):
+                    yield record
+        while pending:
+            for record in chunkRecords(pending.popleft()):
+                yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def readProjects(cursor):
+    sql =  "SELECT id, name FROM mantis_project_table"
+    if PRODUCTS:
+        sql += " WHERE %s" % productFilter('name', PRODUCTS)
+    cursor.execute(sql)
+    return cursor.fetchall()
+
+def readUsers(cursor):
+    cursor.execute("SELECT id, username, email, realname, last_visit FROM mantis_user_table")
+    return cursor.fetchall()
+
+def readComponents(cursor, projectIds):
+    sql = "SELECT DISTINCT name as category, user_id as owner FROM mantis_category_table, mantis_bug_table WHERE user_id=user_id GROUP BY category"
+    if PRODUCTS:
+       sql += " WHERE %s" % productFilter('project_id', projectIds)
+    if VERBOSE:
+        print "sql: %s" % sql
+    cursor.execute(sql)
+    return cursor.fetchall()
+
+def readVersions(cursor, projectIds):
+    sql = "SELECT DISTINCTROW version FROM mantis_project_version_table"
+    if PRODUCTS:
+       sql += " WHERE %s" % productFilter('project_id', projectIds)
+    cursor.execute(sql)
+    return cursor.fetchall()
+
+def readMilestones(cursor, projectIds):
+    sql = "SELECT version, date_order, released, obsolete FROM mantis_project_version_table GROUP BY version"
+    if PRODUCTS:
+       sql += " WHERE %s" % productFilter('project_id', projectIds)
+    cursor.execute(sql)
+    return cursor.fetchall()
+
+def bugConditions(projectIds, since=None):
+    sql = "FROM mantis_bug_table, mantis_category_table "
+    sql += "WHERE mantis_bug_table.category_id=mantis_category_table.id"
+    if PRODUCTS:
+       sql += " AND (%s)" % productFilter('mantis_bug_table.project_id', projectIds)
+    if since is not None:
+       # the start of the last import: bugs updated in that second may
+       # not have been read yet, the rows imported before are skipped
+       sql += " AND mantis_bug_table.last_updated >= %d" % since
+    return sql
+
+def countBugs(cursor, projectIds, since=None, afterId=None):
+    sql = "SELECT COUNT(*) AS count " + bugConditions(projectIds, since)
+    if afterId is not None:
+       sql += " AND mantis_bug_table.id > %d" % afterId
+    cursor.execute(sql)
+    return int(cursor.fetchall()[0]['count'])
+
+def readBugs(cursor, projectIds, since=None, afterId=None):
+    """Yield the bugs to import, page by page"""
+    sql = "SELECT mantis_bug_table.id, date_submitted, last_updated, mantis_category_table.name, severity, priority, handler_id, reporter_id, version, target_version, summary, mantis_bug_table.status, resolution, bug_text_id "
+    sql += bugConditions(projectIds, since)
+    return keysetRows(cursor, sql, 'mantis_bug_table.id', afterId=afterId)
+
+class Staging(object):
+    """Mantis data extracted by --extract, to be loaded by --load.
+
+    The directory holds one newline-delimited JSON file per query
+    ('projects', 'users', 'components', 'versions', 'milestones'), the
+    bugs with their text, notes, history and attachment rows in
+    'bugs.ndjson' (in id order), the attachment contents in 'blobs', named
+    after their sha1, and 'manifest.json', which is written last.
+    """
+    FORMAT = 1
+
+    def __init__(self, path):
+        self.path = path
+
+    def create(self):
+        if os.path.exists(os.path.join(self.path, 'manifest.json')):
+            os.remove(os.path.join(self.path, 'manifest.json'))
+        if not os.path.isdir(os.path.join(self.path, 'blobs')):
+            os.makedirs(os.path.join(self.path, 'blobs'))
+        return self
+
+    def writeManifest(self, manifest):
+        manifest['format'] = self.FORMAT
+        f = open(os.path.join(self.path, 'manifest.json'), 'w')
+        try:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    def readManifest(self):
+        path = os.path.join(self.path, 'manifest.json')
+        if not os.path.exists(path):
+            raise Exception("%s is not a complete extraction, manifest.json is missing" % self.path)
+        manifest = json.load(open(path))
+        if manifest.get('format') != self.FORMAT:
+            raise Exception("unsupported extraction format %s in %s" % (manifest.get('format'), self.path))
+        return manifest
+
+    def open(self, name, mode='r'):
+        return open(os.path.join(self.path, name + '.ndjson'), mode)
+
+    def writeRows(self, name, rows):
+        f = self.open(name, 'w')
+        try:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+        finally:
+            f.close()
+        return rows
+
+    def iterRows(self, name):
+        f = self.open(name)
+        try:
+            for line in f:
+                yield json.loads(line)
+        finally:
+            f.close()
+
+    def rows(self, name):
+        return list(self.iterRows(name))
+
+    def blobPath(self, digest):
+        return os.path.join(self.path, 'blobs', digest[0:2], digest)
+
+    def addBlob(self, source, cursor, attachment):
+        """Copy the content of `attachment` from `source`, returns its sha1"""
+        tmpPath = os.path.join(self.path, 'blobs', 'attachment-%d' % int(attachment['id']))
+        key = source.copy(cursor, attachment, tmpPath)
+        if key[0] == 'sha1':
+            digest = key[1]
+        else:
+            digest = hashlib.sha1()
+            f = open(tmpPath, 'rb')
+            try:
+                while True:
+                    data = f.read(ATTACHMENT_CHUNK_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+            finally:
+                f.close()
+            digest = digest.hexdigest()
+        path = self.blobPath(digest)
+        if os.path.exists(path):
+            os.remove(tmpPath)
+        else:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(tmpPath, path)
+        return digest
+
+    def translatedBugs(self, userNames, afterId=None):
+        """Yield the translated records of the extracted bugs, see
+        `translatedBugs`"""
+        for line in self.iterRows('bugs'):
+            bug = line['bug']
+            if afterId is not None and bug['id'] <= afterId:
+                continue
+            line['changesets'] = ChangesetIndex(line['history'])
+            yield translateOrReport(bug, line, userNames)
+
+class StagedAttachmentSource(DiskAttachmentSource):
+    """Attachments in the blob directory of a Staging"""
+    def __init__(self, staging, linkFiles=ATTACHMENT_LINK_FILES):
+        DiskAttachmentSource.__init__(self, linkFiles)
+        self.staging = staging
+
+    def localPath(self, attachment):
+        return self.staging.blobPath(attachment['blob'])
+
+    def key(self, attachment, st):
+        # blobs are named by the sha1 of their content
+        return ('sha1', attachment['blob'], st.st_size)
+
+def extract(_db, _host, _user, _password, _env, path, _since=None):
+    """Extract the bugs to import from Mantis to the directory `path`,
+    see Staging"""
+    metrics = Metrics('mantis2trac', PROGRESS_INTERVAL)
+    if PROFILE_QUERIES:
+        metrics.profile = QueryProfile(SLOW_QUERY_SECONDS, PROFILE_TOP)
+    metrics.phase('connect')
+    print "Mantis MySQL('%s':'%s':'%s':'%s'): connecting..." % (_db, _host, _user, _password)
+    mysql_con = MySQLdb.connect(cursorclass=MySQLdb.cursors.DictCursor, host=_host, user=_user,
+                                passwd=_password, db=_db, compress=1, use_unicode=1)
+    mysql_con = CountingConnection(mysql_con, metrics, 'mantis')
+    mysql_cur = mysql_con.cursor()
+    staging = Staging(path).create()
+    started = int(time.time())
+
+    if _since == 'last':
+        lastSyncFile = LAST_SYNC_FILE
+        if lastSyncFile is None:
+            lastSyncFile = os.path.join(_env, 'mantis2trac.lastsync')
+        _since = readLastSync(lastSyncFile)
+        if _since is None:
+            print "No earlier import recorded in %s, extracting all bugs" % lastSyncFile
+    if _since is not None:
+        print "Extracting bugs updated since %s" % datetime.fromtimestamp(_since)
+
+    print
+    print "Extracting projects, users, components, versions and milestones..."
+    metrics.phase('projects')
+    projectIds = dict([(row['id'], row['id']) for row in staging.writeRows('projects', readProjects(mysql_cur))])
+    staging.writeRows('users', readUsers(mysql_cur))
+    staging.writeRows('components', readComponents(mysql_cur, projectIds))
+    staging.writeRows('versions', readVersions(mysql_cur, projectIds))
+    staging.writeRows('milestones', readMilestones(mysql_cur, projectIds))
+
+    print
+    print "Extracting bugs..."
+    metrics.phase('bugs')
+    bugCount = countBugs(mysql_cur, projectIds, _since)
+    metrics.expect(bugCount)
+    source = ATTACHMENT_SOURCES[ATTACHMENT_SOURCE]()
+    totalBugs = totalAttachments = 0
+    f = staging.open('bugs', 'w')
+    try:
+        for chunk in chunked(readBugs(mysql_cur, projectIds, _since), PREFETCH_CHUNK_SIZE):
+            data = prefetchBugData(mysql_cur, chunk)
+            for bug in chunk:
+                rows = data[bug['id']]
+                del rows['changesets']
+                rows['bug'] = bug
+                for attachment in rows['attachments']:
+                    attachment['blob'] = staging.addBlob(source, mysql_cur, attachment)
+                    metrics.count('attachment_bytes', int(attachment['filesize']))
+                    totalAttachments += 1
+                f.write(json.dumps(rows) + '\n')
+                totalBugs += 1
+                metrics.progress()
+    finally:
+        f.close()
+    metrics.endPhase()
+
+    staging.writeManifest({
+        'database': _db,
+        'started': started,
+        'since': _since,
+        'products': PRODUCTS,
+        'bugs': totalBugs,
+        'mantis_version': MANTIS_VERSION,
+    })
+    metrics.count('bugs', totalBugs)
+    metrics.count('attachments', totalAttachments)
+
+    print
+    print "Total bugs extracted:   %d" % totalBugs
+    print "Total attachments:      %d" % totalAttachments
+    print
+    print "Wall time per phase:"
+    for line in metrics.summary():
+        print line
+    if METRICS_REPORT:
+        metrics.writeReport(METRICS_REPORT)
+        print "Metrics report written to %s" % METRICS_REPORT
+    print
+
+def convert(_db, _host, _user, _password, _env, _force, _append, _resume=False, _since=None, _load=None):
     activityFields = FieldTranslator()
+    metrics = Metrics('mantis2trac', PROGRESS_INTERVAL)
+    if PROFILE_QUERIES:
+        metrics.profile = QueryProfile(SLOW_QUERY_SECONDS, PROFILE_TOP)
+    metrics.phase('connect')
 
     # account for older versions of mantis
     if MANTIS_VERSION == '0.19':
@@ -609,389 +1964,270 @@ def convert(_db, _host, _user, _password, _env, _force, _append):
         activityFields['removed'] = 'oldvalue'
         activityFields['added'] = 'newvalue'
 
-    # init Mantis environment
-    print "Mantis MySQL('%s':'%s':'%s':'%s'): connecting..." % (_db, _host, _user, _password)
-    mysql_con = MySQLdb.connect(host=_host, 
-                user=_user, passwd=_password, db=_db, compress=1, 
-                cursorclass=MySQLdb.cursors.DictCursor, use_unicode=1)
-    mysql_cur = mysql_con.cursor()
+    # init Mantis environment, or the data extracted from it
+    staging = None
+    if _load is not None:
+        staging = Staging(_load)
+        manifest = staging.readManifest()
+        print "Loading Mantis data extracted from '%s' at %s from %s" % (manifest['database'], datetime.fromtimestamp(manifest['started']), _load)
+        connectArgs = None
+        mysql_cur = None
+    else:
+        print "Mantis MySQL('%s':'%s':'%s':'%s'): connecting..." % (_db, _host, _user, _password)
+        connectArgs = dict(host=_host, user=_user, passwd=_password, db=_db,
+                           compress=1, use_unicode=1)
+        mysql_con = MySQLdb.connect(cursorclass=MySQLdb.cursors.DictCursor, **connectArgs)
+        mysql_con = CountingConnection(mysql_con, metrics, 'mantis')
+        mysql_cur = mysql_con.cursor()
+
+    def mantisRows(name, read, *args):
+        # rows of a Mantis query, or the extracted copy of them
+        if staging is not None:
+            return staging.rows(name)
+        return read(mysql_cur, *args)
 
     # init Trac environment
     print "Trac database('%s'): connecting..." % (_env)
-    trac = TracDatabase(_env, _append)
+    trac = TracDatabase(_env, _append, COMMIT_EVERY_TICKETS, COMMIT_EVERY_SECONDS, metrics, DRY_RUN)
+    if DRY_RUN:
+        print "Dry run: nothing is written to the Trac environment"
+    # Mantis bug id -> Trac ticket id of the tickets imported before
+    checkpoint = Checkpoint(trac).load()
+
+    lastSyncFile = LAST_SYNC_FILE
+    if lastSyncFile is None:
+        lastSyncFile = os.path.join(_env, 'mantis2trac.lastsync')
+    syncStarted = int(time.time())
+    if staging is not None:
+        # the extraction decides which bugs are synchronized
+        syncStarted = manifest['started']
+        _since = manifest['since']
+    elif _since == 'last':
+        _since = readLastSync(lastSyncFile)
+        if _since is None:
+            print "No earlier import recorded in %s, importing all bugs" % lastSyncFile
+    if _since is not None:
+        print "Synchronizing bugs updated since %s (%d tickets known)" % (datetime.fromtimestamp(_since), len(checkpoint.ticketIds))
+        _resume = False
+
+    resumeAfter = None
+    if _resume:
+        resumeAfter = checkpoint.lastBugId()
+        if resumeAfter is None:
+            print "No tickets imported before, starting a new import"
+            _resume = False
+        else:
+            print "Resuming after Mantis bug %d (%d tickets already imported)" % (resumeAfter, len(checkpoint.ticketIds))
 
     # force mode...
-    if _force == 1:
+    if _force == 1 and not _resume and _since is None:
         print "cleaning all tickets..."
+        metrics.phase('clean')
         c = trac.db().cursor()
 	sql = """DELETE FROM ticket_change"""
         c.execute(sql)
-        trac.db().commit()
+        trac.commit()
 	sql = """DELETE FROM ticket"""
         c.execute(sql)
-        trac.db().commit()
+        trac.commit()
 	sql = """DELETE FROM ticket_custom"""
         c.execute(sql)
-        trac.db().commit()
+        trac.commit()
 	sql = """DELETE FROM attachment"""
         c.execute(sql)
-        os.system('rm -rf %s' % trac.get_attachments_dir())
-        os.mkdir(trac.get_attachments_dir())
-        trac.db().commit()
+        if not DRY_RUN:
+            os.system('rm -rf %s' % trac.get_attachments_dir())
+            os.makedirs(trac.get_attachments_dir())
+        trac.commit()
 
     print
     print '0. Finding project IDs...'
-    sql =  "SELECT id, name FROM mantis_project_table"
-    if PRODUCTS:
-        sql += " WHERE %s" % productFilter('name', PRODUCTS)
-    mysql_cur.execute(sql)
-    project_list = mysql_cur.fetchall()
+    metrics.phase('0. project ids')
+    project_list = mantisRows('projects', readProjects)
     project_dict = dict()
     for project_id in project_list:
         print "Mantis project name '%s' has project ID %s" % (project_id['name'], project_id['id'])
         project_dict[project_id['id']] = project_id['id']
-        
-    print
-    print "1. import severities..."
-    trac.setSeverityList(SEVERITY_LIST)
-
-    print
-    print "2. import components..."
-    sql = "SELECT DISTINCT name as category, user_id as owner FROM mantis_category_table, mantis_bug_table WHERE user_id=user_id GROUP BY category"
-    if PRODUCTS:
-       sql += " WHERE %s" % productFilter('project_id', project_dict)
-    print "sql: %s" % sql
-    mysql_cur.execute(sql)
-    components = mysql_cur.fetchall()
-    for component in components:
-        component['owner'] = trac.getLoginName(mysql_cur, component['owner'])
-    trac.setComponentList(components, 'category')
-    
-    print
-    print "3. import priorities..."
-    trac.setPriorityList(PRIORITY_LIST)
-
-    print
-    print "4. import versions..."
-    sql = "SELECT DISTINCTROW version FROM mantis_project_version_table"
-    if PRODUCTS:
-       sql += " WHERE %s" % productFilter('project_id', project_dict)
-    mysql_cur.execute(sql)
-    versions = mysql_cur.fetchall()
-    trac.setVersionList(versions, 'version')
 
-    print
-    print "5. import milestones..."
-    sql = "SELECT version, date_order, released, obsolete FROM mantis_project_version_table GROUP BY version"
-    if PRODUCTS:
-       sql += " WHERE %s" % productFilter('project_id', project_dict)
-    mysql_cur.execute(sql)
-    milestones = mysql_cur.fetchall()
-    for milestone in milestones:
-      if milestone['obsolete'] != 0 or milestone['released'] != 0:
-         milestone['released'] = trac.convertTime(milestone['date_order'])
-      else:
-         milestone['released'] = None
-    trac.setMilestoneList(milestones, 'version')
+    trac.preloadUsers(mantisRows('users', readUsers))
+        
+    if _resume or _since is not None:
+        print
+        print "1.-5. skipped, the enums and components were imported before"
+    else:
+        print
+        print "1. import severities..."
+        metrics.phase('1. severities')
+        trac.setSeverityList(SEVERITY_LIST)
+
+        print
+        print "2. import components..."
+        metrics.phase('2. components')
+        components = mantisRows('components', readComponents, project_dict)
+        for component in components:
+            component['owner'] = trac.getLoginName(mysql_cur, component['owner'])
+        trac.setComponentList(components, 'category')
+
+        print
+        print "3. import priorities..."
+        metrics.phase('3. priorities')
+        trac.setPriorityList(PRIORITY_LIST)
+
+        print
+        print "4. import versions..."
+        metrics.phase('4. versions')
+        versions = mantisRows('versions', readVersions, project_dict)
+        trac.setVersionList(versions, 'version')
+
+        print
+        print "5. import milestones..."
+        metrics.phase('5. milestones')
+        milestones = mantisRows('milestones', readMilestones, project_dict)
+        for milestone in milestones:
+          if milestone['obsolete'] != 0 or milestone['released'] != 0:
+             milestone['released'] = trac.convertTime(milestone['date_order'])
+          else:
+             milestone['released'] = None
+        trac.setMilestoneList(milestones, 'version')
 
     print
     print '6. retrieving bugs...'
-    sql = "SELECT mantis_bug_table.id, date_submitted, last_updated, mantis_category_table.name, severity, priority, handler_id, reporter_id, version, target_version, summary, mantis_bug_table.status, resolution, bug_text_id FROM mantis_bug_table, mantis_category_table "
-    sql += "WHERE mantis_bug_table.category_id=mantis_category_table.id "
-    sql += "GROUP BY mantis_bug_table.id "
-    if PRODUCTS:
-       sql += " WHERE %s" % productFilter('project_id', project_dict)
-    sql += " ORDER BY id"
-    mysql_cur.execute(sql)
-    bugs = mysql_cur.fetchall()
+    metrics.phase('6. retrieve bugs')
+    if staging is not None:
+        bugCount = manifest['bugs']
+    else:
+        # the number of bugs is only needed for the progress ETA
+        bugCount = countBugs(mysql_cur, project_dict, _since, resumeAfter)
+        # bugs are read page by page while they are imported
+        bugs = readBugs(mysql_cur, project_dict, _since, resumeAfter)
+    print "%d bugs to import" % bugCount
     
     print
     print "7. import bugs and bug activity..."
+    metrics.phase('7. import bugs')
+    metrics.expect(bugCount)
+    userNames = UserNames(trac.mantisUsers)
+    totalTickets = 0
     totalComments = 0
     totalTicketChanges = 0
     totalAttachments = 0
     errors = []
     timeAdjustmentHacks = []
-    for bug in bugs:
-        bugid = bug['id']
-
-        ticket = {}
-        keywords = []
-        ticket['id'] = bugid
-        ticket['time'] = bug['date_submitted']
-        ticket['changetime'] = bug['last_updated']
-        ticket['component'] = bug['name']
-        ticket['severity'] = SEVERITY_TRANSLATE[bug['severity']]
-        ticket['priority'] = PRIORITY_TRANSLATE[bug['priority']]
-        ticket['owner'] = trac.getLoginName(mysql_cur, bug['handler_id'])
-        ticket['reporter'] = trac.getLoginName(mysql_cur, bug['reporter_id'])
-        ticket['version'] = bug['version']
-        if IGNORE_VERSION:
-          ticket['version'] = ''
-        ticket['milestone'] = bug['version']
-	if bug['target_version']:
-          ticket['milestone'] = bug['target_version']
-        ticket['summary'] = bug['summary']
-        ticket['status'] = STATUS_TRANSLATE[bug['status']]
-        ticket['cc'] = ''
-        ticket['keywords'] = ''
-
-        # Special case for 'reopened' resolution in mantis - 
-        # it maps to a status type in Trac.
-        if (bug['resolution'] == 30):
-            ticket['status'] = 'reopened'
-        ticket['resolution'] = RESOLUTION_TRANSLATE[bug['resolution']]
-        
-        # Compose the description from the three text fields in Mantis:
-        # 'description', 'steps_to_reproduce', 'additional_information'
-        mysql_cur.execute("SELECT * FROM mantis_bug_text_table WHERE id = %s" % bug['bug_text_id']) 
-        longdescs = list(mysql_cur.fetchall())
-
-        # check for empty 'longdescs[0]' field...
-        if len(longdescs) == 0:
-            ticket['description'] = ''
-        else:
-            tmpDescr = longdescs[0]['description']
-            if (longdescs[0]['steps_to_reproduce'].strip() != ''):
-               tmpDescr = ('%s\n\n=== Steps to Reproduce ===\n%s') % (tmpDescr, longdescs[0]['steps_to_reproduce'])
-            if (longdescs[0]['additional_information'].strip() != ''):
-               tmpDescr = ('%s\n\n=== Additional Information ===\n%s') % (tmpDescr, longdescs[0]['additional_information'])
-            ticket['description'] = tmpDescr
-            del longdescs[0]
-
-        # Add the ticket to the Trac database
-        new_id = trac.addTicket(**ticket)
-        print "ticket %s has id %s" % (bugid, new_id)
-
-        #
-        # Add ticket comments
-        #
-        mysql_cur.execute("SELECT * FROM mantis_bugnote_table, mantis_bugnote_text_table WHERE bug_id = %s AND mantis_bugnote_table.bugnote_text_id = mantis_bugnote_text_table.id ORDER BY date_submitted" % bugid)
-        bug_notes = mysql_cur.fetchall()
-        totalComments += len(bug_notes)
-        for note in bug_notes:
-          #Check for changesets, and add trac changeset links to the comments section where applicable
-	  mysql_cur.execute("SELECT * FROM mantis_bug_history_table WHERE bug_id=%s AND date_modified > %s AND date_modified < %s AND field_name='source_changeset_attached' AND user_id=%s " % (bugid, note['date_submitted']-2, note['date_submitted']+2, note['reporter_id']))
-          activity = mysql_cur.fetchall()
-          if activity:
-		project, branch, commit = activity[0]['new_value'].split()
-		wikivalue = '%s [/browser/?rev=%s %s] [%s]' % (project, commit, branch, commit)
-		note['note']  = note['note'] + "\n\n" + wikivalue
-          trac.addTicketComment(new_id, note['date_submitted'], trac.getLoginName(mysql_cur, note['reporter_id']), note['note'])
-
-        #
-        # Convert ticket changes
-        #
-	mysql_cur.execute("SELECT * FROM mantis_bug_history_table WHERE bug_id=%s ORDER BY date_modified, id" % bugid)
-        bugs_activity = mysql_cur.fetchall()
-        resolution = ''
-        ticketChanges = []
-        keywords = []
-        for activity in bugs_activity:
-            field_name = activity['field_name'].lower()
-            # Convert Mantis field names...
-            # The following fields are the same in Mantis and Trac:
-            #  - 'status'
-            #  - 'priority'
-            #  - 'summary'
-            #  - 'resolution'
-            #  - 'severity'
-            #  - 'version'
-            #
-            # Ignore the following changes:
-            #  - project_id
-            #  - reproducibility
-            #  - view_state
-            #  - os
-            #  - os_build
-            #  - duplicate_id
-            #
-            # Convert Mantis -> Trac:
-            #  - 'handler_id' -> 'owner'
-            #  - 'fixed_in_version' -> 'milestone'
-            #  - 'category' -> 'component'
-            #  - 'version' -> 'milestone'
-            
-            ticketChange = {}
-            ticketChange['ticket'] = new_id
-            ticketChange['oldvalue'] = activity['old_value']
-            ticketChange['newvalue'] = activity['new_value']
-            ticketChange['time'] = activity['date_modified']
-            ticketChange['author'] = trac.getLoginName(mysql_cur, activity['user_id'])
-            ticketChange['field'] = field_name
-
-            add_keywords = []
-            remove_keywords = []
-
-	    try:
-		activity['old_value'] = int(activity['old_value'])
-	    except ValueError:
-		activity['old_value'] = activity['old_value'].upper()
-           
-	    try:
-                activity['new_value'] = int(activity['new_value'])
-            except ValueError:
-                activity['new_value'] = activity['new_value'].upper()
- 
-            if field_name == 'handler_id':
-                ticketChange['field'] = 'owner'
-                ticketChange['oldvalue'] = trac.getLoginName(mysql_cur, activity['old_value'])
-                ticketChange['newvalue'] = trac.getLoginName(mysql_cur, activity['new_value'])
-            #elif field_name == 'fixed_in_version':
-                #ticketChange['field'] = 'milestone'
-            elif field_name == 'name':
-                ticketChange['field'] = 'component'
-            elif field_name == 'version':
-                ticketChange['field'] = 'milestone'
-            elif field_name == 'status':
-		try:
-                    ticketChange['oldvalue'] = STATUS_TRANSLATE[activity['old_value']]
-		except:
-		    if activity['old_value'] in STATUS_TRANSLATE:
-		        key = [k for k, v in STATUS_KEYWORDS.iteritems() if activity['old_value'] in v]
-		        ticketChange['oldvalue'] = STATUS_TRANSLATE[key[0]]
-		try:
-                    ticketChange['newvalue'] = STATUS_TRANSLATE[activity['new_value']]
-		except:
-		    if activity['new_value'] in STATUS_TRANSLATE:
-		        key = [k for k, v in STATUS_KEYWORDS.iteritems() if activity['new_value'] in v]
-		        ticketChange['newvalue'] = STATUS_TRANSLATE[key[0]]
-                if activity['old_value'] in STATUS_KEYWORDS:
-                    remove_keywords.append(STATUS_KEYWORDS[activity['old_value']])
-                if activity['new_value'] in STATUS_KEYWORDS:
-                    add_keywords.append(STATUS_KEYWORDS[activity['new_value']])
-            elif field_name == 'priority':
-                ticketChange['oldvalue'] = PRIORITY_TRANSLATE[activity['old_value']]
-                ticketChange['newvalue'] = PRIORITY_TRANSLATE[activity['new_value']]
-            elif field_name == 'resolution':
-                ticketChange['oldvalue'] = RESOLUTION_TRANSLATE[activity['old_value']]
-                ticketChange['newvalue'] = RESOLUTION_TRANSLATE[activity['new_value']]
-            elif field_name == 'severity':
-                ticketChange['oldvalue'] = SEVERITY_TRANSLATE[activity['old_value']]
-                ticketChange['newvalue'] = SEVERITY_TRANSLATE[activity['new_value']]
-	    elif field_name == 'source_changeset_attached':
-		try:
-		  project, branch, commit = ticketChange['newvalue'].split()
-                  wikivalue = '%s [/browser/?rev=%s %s] [%s]' % (project, commit, branch, commit)
-		  trac.addTicketComment( ticketChange['ticket'], ticketChange['time'], ticketChange['author'], wikivalue )
-		except:
-		  print
-            if add_keywords or remove_keywords:
-                # ensure removed ones are in old
-                old_keywords = keywords + [kw for kw in remove_keywords if kw not in keywords]
-                # remove from new
-                keywords = [kw for kw in keywords if kw not in remove_keywords]
-                # add to new
-                keywords += [kw for kw in add_keywords if kw not in keywords]
-                if old_keywords != keywords:
-                    ticketChangeKw = ticketChange.copy()
-                    ticketChangeKw['field'] = "keywords"
-                    ticketChangeKw['oldvalue'] = ' '.join(old_keywords)
-                    ticketChangeKw['newvalue'] = ' '.join(keywords)
-                    ticketChanges.append(ticketChangeKw)
-                                
-            if field_name in IGNORED_ACTIVITY_FIELDS:
-                continue
-
-            # skip changes that have no effect (think translation!)
-            if ticketChange['oldvalue'] == ticketChange['newvalue']:
-                continue
-                
-            ticketChanges.append (ticketChange)
-
-        totalTicketChanges += len(ticketChanges)
-        for ticketChange in ticketChanges:
-            try:
-                trac.addTicketChange (**ticketChange)
-            except:
-                if TIME_ADJUSTMENT_HACK:
-                    originalTime = ticketChange['time']
-                    ticketChange['time'] += 1
-                    try:
-                        trac.addTicketChange(**ticketChange)
-                        noticeStr = " ~ Successfully adjusted time for ticket(#%s) change \"%s\": \"%s\" -> \"%s\" (%s)" % (bugid, ticketChange['field'], ticketChange['oldvalue'], ticketChange['newvalue'], ticketChange['time'])
-                        noticeStr += "\n   Original time: %s" % originalTime
-                        timeAdjustmentHacks.append(noticeStr)
-                    except:
-                        errorStr =  " * ERROR: unable to add ticket(#%s) change \"%s\": \"%s\" -> \"%s\" (%s)" % (bugid, ticketChange['field'], ticketChange['oldvalue'], ticketChange['newvalue'], ticketChange['time'])
-                        errorStr += "\n          The bug id, field name, and time must be unique"
-                        errors.append(errorStr)
-                        print errorStr
-                else:
+    totalUpdated = 0
+    if staging is not None:
+        attachmentSource = StagedAttachmentSource(staging)
+        records = staging.translatedBugs(userNames, resumeAfter)
+    else:
+        attachmentSource = ATTACHMENT_SOURCES[ATTACHMENT_SOURCE]()
+        records = translatedBugs(mysql_cur, bugs, userNames, JOBS, connectArgs, metrics)
+    attachmentWriter = AttachmentWriter(connectArgs, attachmentSource, ATTACHMENT_THREADS, metrics)
+    trac.attachmentWriter = attachmentWriter
+    for record in records:
+        bugid = record['id']
+        if 'error' in record:
+            errorStr = " * ERROR: couldn't translate bug %s: %s" % (bugid, record['error'])
+            errors.append(errorStr)
+            print errorStr
+            metrics.progress()
+            continue
+        for error in record['errors']:
+            errorStr = " * ERROR: bug %s: %s" % (bugid, error)
+            errors.append(errorStr)
+            print errorStr
+        trac.beginTicket()
+        try:
+            # create the sessions of all users the ticket refers to
+            for userid in record['users']:
+                trac.getLoginName(mysql_cur, userid)
+
+            # Add the ticket to the Trac database, in its final state.
+            # Tickets imported before are updated when synchronizing.
+            new_id = checkpoint.ticketIds.get(bugid)
+            updated = _since is not None and new_id is not None
+            if updated:
+                trac.skipImported(new_id)
+                trac.updateTicket(new_id, **record['ticket'])
+            else:
+                new_id = trac.addTicket(**record['ticket'])
+                if VERBOSE:
+                    print "ticket %s has id %s" % (bugid, new_id)
+                checkpoint.add(bugid, new_id)
+
+            totalComments += len(record['comments'])
+            for commentTime, author, comment in record['comments']:
+                trac.addTicketComment(new_id, commentTime, author, comment)
+
+            ticketChanges = record['changes']
+            totalTicketChanges += len(ticketChanges)
+            for ticketChange in ticketChanges:
+                ticketChange['ticket'] = new_id
+                usedTime = trac.addTicketChange(**ticketChange)
+                if usedTime is None:
                     errorStr =  " * ERROR: unable to add ticket(#%s) change \"%s\": \"%s\" -> \"%s\" (%s)" % (bugid, ticketChange['field'], ticketChange['oldvalue'], ticketChange['newvalue'], ticketChange['time'])
                     errorStr += "\n          The bug id, field name, and time must be unique"
                     errors.append(errorStr)
                     print errorStr
-                
-
-        #
-        # Add ticket file attachments
-        #
-        attachment_sql = "SELECT b.id,b.bug_id,b.title,b.description,b.filename,b.filesize,b.file_type,b.date_added AS date_added, b.content, h.user_id FROM mantis_bug_file_table AS b LEFT JOIN mantis_bug_history_table AS h ON (h.type = 9 AND h.old_value = b.filename AND h.bug_id = b.bug_id) WHERE b.bug_id = %s" % bugid
-        mysql_cur.execute(attachment_sql)
-        attachments = mysql_cur.fetchall()
-        for attachment in attachments:
-	    print attachment['user_id']
-            author = trac.getLoginName(mysql_cur, attachment['user_id'])
-
-            # Old attachment stuff that never worked...
-            # attachmentFile = open(attachment['diskfile'], 'r')
-            # attachmentData = attachmentFile.read()
-            # tracAttachment = Attachment(attachment['filename'], attachmentData)
-            # trac.addAttachment(bugid, tracAttachment, attachment['description'], author)
+                elif usedTime != trac.convertTime(ticketChange['time']):
+                    noticeStr = " ~ Successfully adjusted time for ticket(#%s) change \"%s\": \"%s\" -> \"%s\" (%s)" % (bugid, ticketChange['field'], ticketChange['oldvalue'], ticketChange['newvalue'], usedTime)
+                    noticeStr += "\n   Original time: %s" % trac.convertTime(ticketChange['time'])
+                    timeAdjustmentHacks.append(noticeStr)
 
-            try:
-                try:
-                    if(os.path.isdir(trac.get_attachments_dir(new_id)) == False):
-                        try:
-                            os.mkdir(trac.get_attachments_dir(new_id))
-                        except:
-                            errorStr = " * ERROR: couldnt create attachment directory in filesystem at %s" % trac.get_attachments_dir(new_id)
-                            errors.append(errorStr)
-                            print errorStr
-                    # trac stores the files with the special characters like spaces in the filename encoded to the url 
-                    # equivalents, so we have to urllib.quote() the filename we're saving. 
-                    attachmentFile = open(trac.get_attachments_dir(new_id) + quote(attachment['filename']),'wb')
-                    attachmentFile.write(attachment['content'])
-                    attachmentFile.close()
-                except:
-                    errorStr = " * ERROR: couldnt dump attachment data into filesystem at %s" % trac.get_attachments_dir(new_id) + attachment['filename']
-                    errors.append(errorStr)
-                    print errorStr
+            #
+            # Add ticket file attachments
+            #
+            for attachment in record['attachments']:
+                if trac.attachmentImported(attachment['filename']):
+                    continue
+                author = attachment['author']
+
+                # Old attachment stuff that never worked...
+                # attachmentFile = open(attachment['diskfile'], 'r')
+                # attachmentData = attachmentFile.read()
+                # tracAttachment = Attachment(attachment['filename'], attachmentData)
+                # trac.addAttachment(bugid, tracAttachment, attachment['description'], author)
+
+                # trac stores the files under the sha1 of the ticket id and
+                # the file name
+                if DRY_RUN:
+                    metrics.count('attachment_bytes_discarded', attachment['filesize'])
                 else:
-                    attach_sql = """INSERT INTO attachment (type,id,filename,size,time,description,author,ipnr) VALUES ('ticket',%s,'%s',%i,%i,'%s','%s','127.0.0.1')""" % (new_id,attachment['filename'].encode('utf-8'),attachment['filesize'],trac.convertTime(attachment['date_added']),attachment['description'].encode('utf-8'),author)
-                    try:
-                        c = trac.db().cursor()
-                        c.execute(attach_sql)
-                        trac.db().commit()
-                    except:
-                        errorStr = " * ERROR: couldnt insert attachment data into database with %s" % attach_sql
-                        errors.append(errorStr)
-                        print errorStr
-                    else:
-                        print 'inserting attachment for ticket %s -- %s, added by %s' % (bugid, attachment['description'], author)
-
-                        totalAttachments += 1
-			hash      = hashlib.sha1()
-		        hash.update(str(new_id).encode('utf-8'))
-			path_hash = hash.hexdigest()
-		        hash      = hashlib.sha1()
-			hash.update(attachment['filename'].encode('utf-8'))
-			file_hash = hash.hexdigest()
-		        old_path  = 'importfiles/%s/%s' % (new_id, quote(attachment['filename']))
-		        new_path  = TRAC_ENV + '/files/attachments/ticket/'
-			new_path += '%s/%s/' % (path_hash[0:3], path_hash)
-			try:
-			  os.makedirs(new_path)
-			except:
-			  print
-			new_path += file_hash
-			new_path += os.path.splitext(attachment['filename'])[1]
-			os.rename(old_path, new_path) 
-            except:
-                errorStr = " * ERROR: couldn't migrate attachment %s" % attachment['filename']
-                errors.append(errorStr)
-                print errorStr
+                    trac.writeAttachment(new_id, attachment)
+
+                # a failing attachment rolls back the whole ticket
+                trac.execute("""INSERT INTO attachment (type,id,filename,size,time,description,author,ipnr) VALUES ('ticket',%s,%s,%s,%s,%s,%s,'127.0.0.1')""",
+                             (new_id, attachment['filename'].encode('utf-8'), attachment['filesize'], trac.convertTime(attachment['date_added']),
+                              attachment['description'].encode('utf-8'), author))
+                if VERBOSE:
+                    print 'inserting attachment for ticket %s -- %s, added by %s' % (bugid, attachment['description'], author)
+                totalAttachments += 1
+            trac.endTicket()
+        # KeyboardInterrupt and SystemExit end the import, the batch is
+        # not committed and can be imported again with --resume
+        except Exception, e:
+            trac.abortTicket()
+            errorStr = " * ERROR: couldn't import bug %s, the ticket was rolled back: %s" % (bugid, e)
+            errors.append(errorStr)
+            print errorStr
+            metrics.progress()
+            continue
+        trac.commitIfDue()
+        totalTickets += 1
+        if updated:
+            totalUpdated += 1
+        metrics.progress()
+    trac.commit()
+    metrics.phase('attachments')
+    attachmentWriter.close()
+    errors.extend(attachmentWriter.errors)
+    metrics.endPhase()
+    metrics.count('tickets', totalTickets)
+    metrics.count('tickets_updated', totalUpdated)
+    metrics.count('comments', totalComments)
+    metrics.count('changes', totalTicketChanges)
+    metrics.count('attachments', totalAttachments)
+    metrics.count('attachment_bytes', attachmentWriter.bytesWritten)
+    metrics.count('attachment_bytes_linked', attachmentWriter.bytesSaved)
+    metrics.count('errors', len(errors))
 
     print
     if TIME_ADJUSTMENT_HACK:
@@ -1003,11 +2239,32 @@ def convert(_db, _host, _user, _password, _env, _force, _append):
             print error
     else: 
         print "Success!"
+        if not DRY_RUN:
+            writeLastSync(lastSyncFile, syncStarted)
     print
-    print "Total tickets imported: %d" % len(bugs)
+    print "Total tickets imported: %d" % totalTickets
+    if _since is not None:
+        print "  of which updated:     %d" % totalUpdated
     print "Total ticket comments:  %d" % totalComments
     print "Total ticket changes:   %d" % totalTicketChanges
     print "Total attachments:      %d" % totalAttachments
+    print "  hard linked:          %d (%d bytes saved)" % (attachmentWriter.duplicates, attachmentWriter.bytesSaved)
+    print "Commits:                %d (%s)" % (trac.commitCount, trac.commitPolicy())
+    if DRY_RUN:
+        print "Dry run, discarded:     %d bytes, %d bytes of attachments" % (metrics.counters.get('trac.bytes_discarded', 0),
+                                                                            metrics.counters.get('attachment_bytes_discarded', 0))
+    print
+    print "Wall time per phase:"
+    for line in metrics.summary():
+        print line
+    if metrics.profile is not None:
+        print
+        print "Statements taking the most time (%d slower than %s seconds):" % (metrics.profile.slowQueries, SLOW_QUERY_SECONDS)
+        for line in metrics.profile.summary():
+            print line
+    if METRICS_REPORT:
+        metrics.writeReport(METRICS_REPORT)
+        print "Metrics report written to %s" % METRICS_REPORT
     print
 
 def usage():
@@ -1024,19 +2281,35 @@ def usage():
     print "  -c | --clean                     - Remove current Trac tickets before importing"
     print "  -a | --append                    - Append bugs to existing project"
     print "  --products <product1,product2>   - List of products to import from mantis"
+    print "  --since <time>|last              - Only import bugs updated since a unix time, a"
+    print "                                     YYYY-MM-DD[ HH:MM:SS] date or the last import"
+    print "  --resume                         - Continue an interrupted import, see MANTIS_ID_FIELD"
+    print "  --attachments <source>           - Read attachments from the 'database', 'disk' or 'ftp' mirror (default %s)" % ATTACHMENT_SOURCE
+    print "  --jobs <n>                       - Translate bugs in n worker processes (default %d)" % JOBS
+    print "  --commit-every <n>               - Commit the Trac database every n tickets (default %d)" % COMMIT_EVERY_TICKETS
+    print "  --commit-seconds <t>             - ... or every t seconds, 0 to disable (default %d)" % COMMIT_EVERY_SECONDS
+    print "  --report <file>                  - Write phase times and counters as JSON to file"
+    print "  --profile                        - Time every statement and list the slowest ones"
+    print "  --dry-run                        - Read and translate all bugs without writing to Trac"
+    print "  --extract <dir>                  - Only extract the Mantis data to dir"
+    print "  --load <dir>                     - Import the Mantis data extracted to dir"
+    print "  -v | --verbose                   - Print every imported ticket, comment and change"
     print "  --help | help                    - This help info"
     print
     print "Note:   If you want the ticket attachments to be converted, you MUST run the script"
     print "        as a user who has write permissions to the trac env attachments directory."
-    print "Note 2: Attachment conversion only works for attachments stored directly in the mantis"
-    print "        database at this point."
+    print "Note 2: Attachments are read from the mantis database by default, use --attachments"
+    print "        disk|ftp for attachments stored on disk or on an FTP server (see ATTACHMENT_SOURCE)."
     print
     print "Additional configuration options can be defined directly in the script."
     print
     sys.exit(0)
 
 def main():
-    global MANTIS_DB, MANTIS_HOST, MANTIS_USER, MANTIS_PASSWORD, TRAC_ENV, TRAC_CLEAN, PRODUCTS
+    global MANTIS_DB, MANTIS_HOST, MANTIS_USER, MANTIS_PASSWORD, TRAC_ENV, TRAC_CLEAN, TRAC_APPEND, PRODUCTS
+    global COMMIT_EVERY_TICKETS, COMMIT_EVERY_SECONDS, JOBS, TRAC_RESUME, SINCE
+    global ATTACHMENT_SOURCE, VERBOSE, METRICS_REPORT, PROFILE_QUERIES, DRY_RUN
+    global EXTRACT_DIR, LOAD_DIR
     if len (sys.argv) > 1:
         if sys.argv[1] in ['--help','help'] or len(sys.argv) < 4:
             usage()
@@ -1064,6 +2337,47 @@ def main():
             elif sys.argv[iter] in ['--products'] and iter+1 < len(sys.argv):
                 PRODUCTS = sys.argv[iter+1].split(',')
                 iter = iter + 1
+            elif sys.argv[iter] in ['--since'] and iter+1 < len(sys.argv):
+                if sys.argv[iter+1] == 'last':
+                    SINCE = 'last'
+                else:
+                    try:
+                        SINCE = parseSince(sys.argv[iter+1])
+                    except ValueError, e:
+                        print e
+                        usage()
+                iter = iter + 1
+            elif sys.argv[iter] in ['--attachments'] and iter+1 < len(sys.argv):
+                ATTACHMENT_SOURCE = sys.argv[iter+1]
+                if ATTACHMENT_SOURCE not in ATTACHMENT_SOURCES:
+                    usage()
+                iter = iter + 1
+            elif sys.argv[iter] in ['--resume']:
+                TRAC_RESUME = True
+            elif sys.argv[iter] in ['--jobs'] and iter+1 < len(sys.argv):
+                JOBS = int(sys.argv[iter+1])
+                iter = iter + 1
+            elif sys.argv[iter] in ['--commit-every'] and iter+1 < len(sys.argv):
+                COMMIT_EVERY_TICKETS = int(sys.argv[iter+1])
+                iter = iter + 1
+            elif sys.argv[iter] in ['--commit-seconds'] and iter+1 < len(sys.argv):
+                COMMIT_EVERY_SECONDS = float(sys.argv[iter+1])
+                iter = iter + 1
+            elif sys.argv[iter] in ['--report'] and iter+1 < len(sys.argv):
+                METRICS_REPORT = sys.argv[iter+1]
+                iter = iter + 1
+            elif sys.argv[iter] in ['--profile']:
+                PROFILE_QUERIES = True
+            elif sys.argv[iter] in ['--dry-run']:
+                DRY_RUN = True
+            elif sys.argv[iter] in ['--extract'] and iter+1 < len(sys.argv):
+                EXTRACT_DIR = sys.argv[iter+1]
+                iter = iter + 1
+            elif sys.argv[iter] in ['--load'] and iter+1 < len(sys.argv):
+                LOAD_DIR = sys.argv[iter+1]
+                iter = iter + 1
+            elif sys.argv[iter] in ['-v', '--verbose']:
+                VERBOSE = True
             else:
                 print "Error: unknown parameter: " + sys.argv[iter]
                 sys.exit(0)
@@ -1071,7 +2385,10 @@ def main():
     else:
         usage()
         
-    convert(MANTIS_DB, MANTIS_HOST, MANTIS_USER, MANTIS_PASSWORD, TRAC_ENV, TRAC_CLEAN, TRAC_APPEND)
+    if EXTRACT_DIR:
+        extract(MANTIS_DB, MANTIS_HOST, MANTIS_USER, MANTIS_PASSWORD, TRAC_ENV, EXTRACT_DIR, SINCE)
+    else:
+        convert(MANTIS_DB, MANTIS_HOST, MANTIS_USER, MANTIS_PASSWORD, TRAC_ENV, TRAC_CLEAN, TRAC_APPEND, TRAC_RESUME, SINCE, LOAD_DIR)
 
 if __name__ == '__main__':
     main()
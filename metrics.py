@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""
+Run metrics for the converters.
+
+Records the wall time of each phase of a conversion and counters for the
+rows read and written, queries, commits and bytes moved.  While a phase
+runs, a progress line with the rate and an ETA is printed every
+PROGRESS_INTERVAL seconds; at the end the metrics can be written as a
+JSON report.
+
+Database connections are wrapped with CountingConnection to count their
+queries, rows and commits (and with NullConnection for dry runs):
+
+  metrics = Metrics('mantis2trac')
+  con = CountingConnection(MySQLdb.connect(...), metrics, 'mantis')
+  metrics.phase('7. import bugs')
+  metrics.expect(bugCount)
+  for bug in bugs:
+      ...
+      metrics.progress()
+  metrics.writeReport('report.json')
+
+If a QueryProfile is set as `metrics.profile`, the wrapped cursors also
+time every statement.  Statements are grouped by their text with the
+literals replaced, and a statement slower than SLOW_QUERY_SECONDS is
+printed as soon as it finished.
+
+Threads and worker processes count into Metrics of their own, which are
+added to the main one with `merge` (see `take` for workers that keep
+running).
+"""
+import re
+import time
+import json
+
+# Seconds between two progress lines, 0 disables them
+PROGRESS_INTERVAL = 10
+
+# Statements taking longer than this many seconds are printed while
+# profiling
+SLOW_QUERY_SECONDS = 1.0
+
+# Number of statements listed in the profile report
+PROFILE_TOP = 20
+
+def formatSeconds(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+def isQuery(sql):
+    return sql.lstrip()[:6].upper() in ('SELECT', 'SHOW')
+
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_WHITE_SPACE = re.compile(r"\s+")
+_VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_REPEATED_GROUP = re.compile(r"(\([^()]*\))(?:\s*,\s*\1)+")
+
+def normalizeSql(sql):
+    """Replace the literals of `sql` with '?' and collapse lists and white
+    space, so statements that only differ in their values are grouped"""
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _WHITE_SPACE.sub(' ', sql).strip()
+    sql = _VALUE_LIST.sub('(?, ...)', sql)
+    return _REPEATED_GROUP.sub(r'\1, ...', sql)
+
+class QueryProfile(object):
+    """Execution count, time and rows of every statement, by database and
+    normalized statement text"""
+    def __init__(self, slowSeconds=SLOW_QUERY_SECONDS, top=PROFILE_TOP):
+        self.slowSeconds = slowSeconds
+        self.top = top
+        self.slowQueries = 0
+        # (database, statement) -> [count, seconds, rows, max seconds, slow]
+        self._statements = {}
+        self._normalized = {}
+
+    def key(self, database, sql):
+        statement = self._normalized.get(sql)
+        if statement is None:
+            statement = normalizeSql(sql)
+            # statements with inlined values would fill the cache
+            if len(self._normalized) < 10000:
+                self._normalized[sql] = statement
+        return (database, statement)
+
+    def record(self, key, seconds, rows=0, executed=True):
+        """Add an execution (or a fetch, if not `executed`) of the
+        statement `key` taking `seconds` and returning `rows`"""
+        entry = self._statements.get(key)
+        if entry is None:
+            entry = self._statements[key] = [0, 0.0, 0, 0.0, 0]
+        if executed:
+            entry[0] += 1
+            entry[3] = max(entry[3], seconds)
+        entry[1] += seconds
+        entry[2] += rows
+        if self.slowSeconds and seconds >= self.slowSeconds:
+            entry[4] += 1
+            self.slowQueries += 1
+            print "slow %s (%s, %.3f s): %s" % (executed and 'query' or 'fetch', key[0], seconds, key[1][:200])
+
+    def merge(self, other):
+        """Add the statements of QueryProfile `other`"""
+        for key, (count, seconds, rows, maxSeconds, slow) in other._statements.items():
+            entry = self._statements.get(key)
+            if entry is None:
+                entry = self._statements[key] = [0, 0.0, 0, 0.0, 0]
+            entry[0] += count
+            entry[1] += seconds
+            entry[2] += rows
+            entry[3] = max(entry[3], maxSeconds)
+            entry[4] += slow
+        self.slowQueries += other.slowQueries
+
+    def report(self):
+        """The `top` statements with the largest total time"""
+        statements = []
+        for (database, statement), (count, seconds, rows, maxSeconds, slow) in self._statements.items():
+            statements.append({'database': database, 'statement': statement, 'count': count,
+                               'seconds': round(seconds, 3), 'max_seconds': round(maxSeconds, 3),
+                               'rows': rows, 'slow': slow})
+        statements.sort(key=lambda statement: -statement['seconds'])
+        return statements[:self.top]
+
+    def summary(self):
+        lines = ["  %10s %10s %10s %6s  %s" % ('seconds', 'count', 'rows', 'slow', 'statement')]
+        for statement in self.report():
+            lines.append("  %10.3f %10d %10d %6d  %s: %s" % (statement['seconds'], statement['count'], statement['rows'],
+                                                             statement['slow'], statement['database'], statement['statement'][:100]))
+        return lines
+
+class Metrics(object):
+    def __init__(self, name, progressInterval=PROGRESS_INTERVAL):
+        self.name = name
+        self.progressInterval = progressInterval
+        self.started = time.time()
+        self.counters = {}
+        # QueryProfile filled by the wrapped cursors, None disables profiling
+        self.profile = None
+        # finished phases, in order
+        self.phases = []
+        self._phase = None
+        self._phaseStarted = None
+        self._total = None
+        self._done = 0
+        self._lastProgress = 0
+
+    def phase(self, name):
+        """End the current phase and start phase `name`"""
+        self.endPhase()
+        self._phase = name
+        self._phaseStarted = time.time()
+        self._lastProgress = self._phaseStarted
+        self._total = None
+        self._done = 0
+
+    def endPhase(self):
+        if self._phase is not None:
+            self.phases.append(self._phaseReport(time.time()))
+            self._phase = None
+
+    def _phaseReport(self, now):
+        return {'name': self._phase, 'seconds': round(now - self._phaseStarted, 3), 'items': self._done}
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def child(self, name):
+        """New Metrics for a thread or worker process, which profile the
+        statements if these do"""
+        child = Metrics(name, 0)
+        if self.profile is not None:
+            child.profile = QueryProfile(self.profile.slowSeconds, self.profile.top)
+        return child
+
+    def merge(self, other):
+        """Add the counters and the statement profile of Metrics `other`"""
+        for counter, n in other.counters.items():
+            self.count(counter, n)
+        if self.profile is not None and other.profile is not None:
+            self.profile.merge(other.profile)
+
+    def take(self):
+        """Move the counters and profiled statements collected so far
+        into new Metrics and return them, to be sent to `merge`"""
+        taken = self.child(self.name)
+        taken.counters, self.counters = self.counters, {}
+        if self.profile is not None:
+            taken.profile._statements, self.profile._statements = self.profile._statements, {}
+            taken.profile.slowQueries, self.profile.slowQueries = self.profile.slowQueries, 0
+        return taken
+
+    def expect(self, total):
+        """Set the number of items of the current phase, used for the ETA"""
+        self._total = total
+
+    def progress(self, n=1):
+        """Mark `n` items of the current phase as done, prints a progress
+        line if the last one is older than `progressInterval` seconds"""
+        self._done += n
+        if self.progressInterval:
+            now = time.time()
+            if now - self._lastProgress >= self.progressInterval:
+                self._lastProgress = now
+                print self.progressLine(now)
+
+    def progressLine(self, now=None):
+        if now is None:
+            now = time.time()
+        elapsed = now - self._phaseStarted
+        rate = elapsed > 0 and self._done / elapsed or 0.0
+        line = "[%s] %s: %d" % (self.name, self._phase, self._done)
+        if self._total:
+            line += "/%d (%.1f%%)" % (self._total, 100.0 * self._done / self._total)
+        line += ", %.1f/s, elapsed %s" % (rate, formatSeconds(elapsed))
+        if self._total and rate > 0:
+            line += ", ETA %s" % formatSeconds(max(0, self._total - self._done) / rate)
+        return line
+
+    def report(self):
+        now = time.time()
+        phases = list(self.phases)
+        if self._phase is not None:
+            phases.append(self._phaseReport(now))
+        report = {
+            'name': self.name,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'seconds': round(now - self.started, 3),
+            'phases': phases,
+            'counters': dict(self.counters),
+        }
+        if self.profile is not None:
+            report['queries'] = self.profile.report()
+        return report
+
+    def summary(self):
+        """Lines with the wall time of each phase"""
+        report = self.report()
+        lines = []
+        for phase in report['phases']:
+            lines.append("  %-36s %10.1f s %10d items" % (phase['name'], phase['seconds'], phase['items']))
+        lines.append("  %-36s %10.1f s" % ('total', report['seconds']))
+        return lines
+
+    def writeReport(self, path):
+        f = open(path, 'w')
+        try:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+            f.write('\n')
+        finally:
+            f.close()
+
+# cursor wrapper counting the queries and the rows read and written, and
+# timing them if the metrics have a profile; everything else is passed to
+# the wrapped cursor
+class CountingCursor(object):
+    def __init__(self, cursor, metrics, prefix):
+        self._cursor = cursor
+        self._metrics = metrics
+        self._prefix = prefix
+        # profile key of the last statement, fetched rows are added to it
+        self._statement = None
+
+    def _count(self, counter, n=1):
+        self._metrics.count('%s.%s' % (self._prefix, counter), n)
+
+    def _written(self, sql):
+        if isQuery(sql) or self._cursor.rowcount <= 0:
+            return 0
+        self._count('rows_written', self._cursor.rowcount)
+        return self._cursor.rowcount
+
+    def _read(self, rows, started):
+        self._count('rows_read', rows)
+        if started is not None and self._statement is not None:
+            self._metrics.profile.record(self._statement, time.time() - started, rows, False)
+
+    def _started(self):
+        if self._metrics.profile is None:
+            return None
+        return time.time()
+
+    def execute(self, sql, params=None):
+        self._count('queries')
+        started = self._started()
+        if params is None:
+            result = self._cursor.execute(sql)
+        else:
+            result = self._cursor.execute(sql, params)
+        rows = self._written(sql)
+        if started is not None:
+            self._statement = self._metrics.profile.key(self._prefix, sql)
+            self._metrics.profile.record(self._statement, time.time() - started, rows)
+        return result
+
+    def executemany(self, sql, seq):
+        self._count('queries')
+        started = self._started()
+        result = self._cursor.executemany(sql, seq)
+        rows = self._written(sql)
+        if started is not None:
+            self._statement = self._metrics.profile.key(self._prefix, sql)
+            self._metrics.profile.record(self._statement, time.time() - started, rows)
+        return result
+
+    def fetchone(self):
+        started = self._started()
+        row = self._cursor.fetchone()
+        self._read(row is not None and 1 or 0, started)
+        return row
+
+    def fetchmany(self, *args):
+        started = self._started()
+        rows = self._cursor.fetchmany(*args)
+        self._read(len(rows), started)
+        return rows
+
+    def fetchall(self):
+        started = self._started()
+        rows = self._cursor.fetchall()
+        self._read(len(rows), started)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._read(1, None)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+# connection wrapper handing out CountingCursors and counting commits
+class CountingConnection(object):
+    def __init__(self, connection, metrics, prefix):
+        self._connection = connection
+        self._metrics = metrics
+        self._prefix = prefix
+
+    def cursor(self, *args):
+        return CountingCursor(self._connection.cursor(*args), self._metrics, self._prefix)
+
+    def commit(self):
+        self._metrics.count('%s.commits' % self._prefix)
+        return self._connection.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+_ROW_SEPARATOR = re.compile(r"\)\s*,\s*\(")
+
+def writtenRows(sql):
+    """Number of rows an INSERT, REPLACE or UPDATE statement writes
+    (VALUES lists count once per row), 0 for other statements"""
+    verb = sql.lstrip()[:7].upper()
+    if verb.startswith('INSERT') or verb.startswith('REPLACE'):
+        values = sql.upper().rfind('VALUES')
+        if values < 0:
+            return 1
+        return 1 + len(_ROW_SEPARATOR.findall(sql, values))
+    if verb.startswith('UPDATE'):
+        return 1
+    return 0
+
+def valueBytes(sql, params):
+    """Approximate size of the values written by a statement"""
+    if params is None:
+        return len(sql)
+    if isinstance(params, dict):
+        params = params.values()
+    elif not isinstance(params, (list, tuple)):
+        # MySQLdb takes a single value as well
+        params = (params,)
+    size = 0
+    for value in params:
+        if isinstance(value, basestring):
+            size += len(value)
+        elif value is not None:
+            size += 8
+    return size
+
+# cursor of a NullConnection: queries are run on the real cursor, all
+# other statements are discarded
+class NullCursor(object):
+    def __init__(self, connection, cursor):
+        self._connection = connection
+        self._cursor = cursor
+        self._discarded = False
+        self._rowcount = -1
+        self._lastrowid = None
+
+    def _get_rowcount(self):
+        if self._discarded:
+            return self._rowcount
+        return self._cursor.rowcount
+    rowcount = property(_get_rowcount)
+
+    def _get_lastrowid(self):
+        if self._discarded:
+            return self._lastrowid
+        return self._cursor.lastrowid
+    lastrowid = property(_get_lastrowid)
+
+    def execute(self, sql, params=None):
+        if isQuery(sql):
+            self._discarded = False
+            if params is None:
+                return self._cursor.execute(sql)
+            return self._cursor.execute(sql, params)
+        self._discarded = True
+        self._rowcount = writtenRows(sql)
+        if self._rowcount:
+            self._lastrowid = self._connection.nextId(self._rowcount)
+        self._connection.discard(valueBytes(sql, params))
+
+    def executemany(self, sql, seq):
+        self._discarded = True
+        self._rowcount = 0
+        size = 0
+        for params in seq:
+            self._rowcount += writtenRows(sql)
+            size += valueBytes(sql, params)
+        if self._rowcount:
+            self._lastrowid = self._connection.nextId(self._rowcount)
+        self._connection.discard(size)
+
+    def fetchone(self):
+        if self._discarded:
+            return None
+        return self._cursor.fetchone()
+
+    def fetchmany(self, *args):
+        if self._discarded:
+            return []
+        return self._cursor.fetchmany(*args)
+
+    def fetchall(self):
+        if self._discarded:
+            return []
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        if self._discarded:
+            return iter([])
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class NullConnection(object):
+    """Connection for dry runs: SELECT statements read the real database,
+    everything else is discarded.  Inserted rows get made up ids, starting
+    after `firstId`, and the size of the discarded values is counted as
+    '<prefix>.bytes_discarded'."""
+    def __init__(self, connection, metrics, prefix, firstId=1000000000):
+        self._connection = connection
+        self._metrics = metrics
+        self._prefix = prefix
+        self._lastId = firstId
+
+    def nextId(self, rows=1):
+        # MySQL reports the id of the first row of a multi-row INSERT
+        self._lastId += rows
+        return self._lastId - rows + 1
+
+    def discard(self, size):
+        self._metrics.count('%s.bytes_discarded' % self._prefix, size)
+
+    def cursor(self, *args):
+        return NullCursor(self, self._connection.cursor(*args))
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def get_last_id(self, cursor, table, column='id'):
+        # Trac's database API; the id of the last discarded INSERT
+        return cursor.lastrowid
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
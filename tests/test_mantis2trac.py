@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the history translation, the staging directory and the batched
+ticket import of mantis2trac on a sqlite backed Trac environment.  Needs Trac and MySQLdb
+(mantis2trac imports it), but no MySQL server.
+
+  python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import hashlib
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+try:
+    import mantis2trac
+    from metrics import Metrics
+    from trac.env import Environment
+except ImportError, e:
+    mantis2trac = None
+    missing = str(e)
+
+USERS = [
+    {'id': 1, 'username': u'alice', 'email': u'alice@example.com', 'realname': u'Alice', 'last_visit': 1400000000},
+    {'id': 2, 'username': u'bob', 'email': u'bob@example.com', 'realname': u'Bob', 'last_visit': 1400000000},
+]
+
+def ticketFields(n, reporter=u'alice'):
+    return {
+        'id': n, 'time': 1400000000 + n, 'changetime': 1400000100 + n,
+        'component': u'core', 'severity': u'minor', 'priority': u'normal',
+        'owner': u'', 'reporter': reporter, 'cc': '', 'version': u'', 'milestone': u'',
+        'status': u'new', 'resolution': '', 'summary': 'summary %d' % n,
+        'description': 'description %d' % n, 'keywords': u'',
+    }
+
+@unittest.skipIf(mantis2trac is None, "mantis2trac cannot be imported: %s" % (mantis2trac is None and missing))
+class TracDatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mantis2trac')
+        self.path = os.path.join(self.dir, 'env')
+        Environment(self.path, create=True, options=[('trac', 'database', 'sqlite:db/trac.db')])
+        self.trac = self.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, commitTickets=100, metrics=None):
+        trac = mantis2trac.TracDatabase(self.path, True, commitTickets, 0, metrics)
+        trac.preloadUsers(USERS)
+        return trac
+
+    def importTicket(self, n, changes=(), reporterId=1):
+        """Import ticket `n` the way convert does, returns its id or None
+        if it was rolled back"""
+        self.trac.beginTicket()
+        try:
+            ticketId = self.trac.addTicket(**ticketFields(n, self.trac.getLoginName(None, reporterId)))
+            self.trac.addTicketComment(ticketId, 1400000200 + n, u'alice', u'comment %d' % n)
+            for field, time in changes:
+                self.trac.execute("INSERT INTO ticket_change (ticket, time, author, field, oldvalue, newvalue) VALUES (%s, %s, 'alice', %s, '', 'x')",
+                                  (ticketId, time, field))
+            self.trac.endTicket()
+        except Exception:
+            self.trac.abortTicket()
+            return None
+        self.trac.commitIfDue()
+        return ticketId
+
+    def rows(self, sql):
+        # Trac hands out the same connection again, this one only sees
+        # what was committed
+        con = sqlite3.connect(os.path.join(self.path, 'db', 'trac.db'))
+        try:
+            return con.execute(sql).fetchall()
+        finally:
+            con.close()
+
+    def testCommit(self):
+        for n in (1, 2):
+            self.importTicket(n)
+        self.trac.commit()
+        self.assertEqual([(1, u'summary 1'), (2, u'summary 2')], self.rows("SELECT id, summary FROM ticket ORDER BY id"))
+        self.assertEqual([(1, u'comment 1'), (2, u'comment 2')],
+                         self.rows("SELECT ticket, newvalue FROM ticket_change WHERE field = 'comment' ORDER BY ticket"))
+        self.assertEqual([(u'alice',)], self.rows("SELECT sid FROM session"))
+
+    def testUncommittedBatchIsLost(self):
+        self.importTicket(1)
+        self.trac.commit()
+        self.importTicket(2)
+        self.trac.db().rollback()
+        self.assertEqual([(1,)], self.rows("SELECT id FROM ticket"))
+
+    def testAbortKeepsTheBatch(self):
+        self.assertEqual(1, self.importTicket(1))
+        # the second change collides with a comment of the ticket
+        self.assertEqual(None, self.importTicket(2, [('status', 1400000300), ('comment', 1400000202000000)]))
+        # the id of the rolled back ticket is given to the next one
+        self.assertEqual(2, self.importTicket(3))
+        self.trac.commit()
+        self.assertEqual([(1, u'summary 1'), (2, u'summary 3')], self.rows("SELECT id, summary FROM ticket ORDER BY id"))
+        self.assertEqual([(1, u'comment 1'), (2, u'comment 3')],
+                         self.rows("SELECT ticket, newvalue FROM ticket_change ORDER BY ticket"))
+
+    def testCommitEvery(self):
+        self.trac = self.open(commitTickets=2)
+        for n in (1, 2, 3):
+            self.importTicket(n)
+        self.assertEqual(1, self.trac.commitCount)
+        self.assertEqual([(1,), (2,)], self.rows("SELECT id FROM ticket ORDER BY id"))
+
+    def testAbortRequeuesSessions(self):
+        self.importTicket(1)
+        self.assertEqual(None, self.importTicket(2, [('status', 1), ('status', 1)], reporterId=2))
+        self.importTicket(3, reporterId=2)
+        self.trac.commit()
+        self.assertEqual([(u'alice',), (u'bob',)], self.rows("SELECT sid FROM session ORDER BY sid"))
+        self.assertEqual([(u'bob', u'email', u'bob@example.com'), (u'bob', u'name', u'Bob')],
+                         self.rows("SELECT sid, name, value FROM session_attribute WHERE sid = 'bob' ORDER BY name"))
+
+    def testOneStatementPerTicket(self):
+        metrics = Metrics('test', 0)
+        self.trac = self.open(metrics=metrics)
+        self.trac.beginTicket()
+        ticketId = self.trac.addTicket(**ticketFields(1))
+        for n in range(3):
+            self.trac.addTicketComment(ticketId, 1400000200, u'alice', u'comment %d' % n)
+        queries = metrics.counters['trac.queries']
+        self.trac.endTicket()
+        self.assertEqual(1, metrics.counters['trac.queries'] - queries)
+        self.trac.commit()
+        # the comments at the same second are moved by a microsecond
+        self.assertEqual([(1400000200000000,), (1400000200000001,), (1400000200000002,)],
+                         self.rows("SELECT time FROM ticket_change ORDER BY time"))
+
+    def testCheckpoint(self):
+        checkpoint = mantis2trac.Checkpoint(self.trac)
+        for bugid, changes in ((11, ()), (12, [('status', 1), ('status', 1)]), (13, ())):
+            self.trac.beginTicket()
+            try:
+                ticketId = self.trac.addTicket(**ticketFields(bugid))
+                checkpoint.add(bugid, ticketId)
+                for field, time in changes:
+                    self.trac.execute("INSERT INTO ticket_change (ticket, time, author, field, oldvalue, newvalue) VALUES (%s, %s, 'alice', %s, '', 'x')",
+                                      (ticketId, time, field))
+                self.trac.endTicket()
+            except Exception:
+                self.trac.abortTicket()
+        self.trac.commit()
+        checkpoint = mantis2trac.Checkpoint(self.trac).load()
+        self.assertEqual({11: 1, 13: 2}, checkpoint.ticketIds)
+        self.assertEqual(13, checkpoint.lastBugId())
+
+def activity(field, old, new, time=1400000300, userid=1):
+    return {'field_name': field, 'old_value': old, 'new_value': new, 'date_modified': time, 'user_id': userid}
+
+@unittest.skipIf(mantis2trac is None, "mantis2trac cannot be imported: %s" % (mantis2trac is None and missing))
+class ActivityTranslatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.history = mantis2trac.BugHistory(lambda userid: {1: u'alice', 2: u'bob'}.get(userid, ''), [])
+
+    def translate(self, *activities, **kwargs):
+        translator = kwargs.get('translator') or mantis2trac.ActivityTranslator()
+        for row in activities:
+            translator.translate(row, self.history)
+        return [(change['field'], change['oldvalue'], change['newvalue']) for change in self.history.changes]
+
+    def testFields(self):
+        changes = self.translate(activity('handler_id', '1', '2'), activity('name', u'core', u'ui'),
+                                 activity('version', u'1.0', u'1.1'), activity('priority', '20', '40'),
+                                 activity('severity', '50', '60'), activity('resolution', '10', '20'),
+                                 activity('Summary', u'old', u'new'))
+        self.assertEqual([('owner', u'alice', u'bob'), ('component', u'core', u'ui'), ('milestone', u'1.0', u'1.1'),
+                          ('priority', 'low', 'high'), ('severity', 'minor', 'major'), ('resolution', '', 'fixed'),
+                          ('summary', u'old', u'new')], changes)
+        self.assertEqual([u'alice'] * 7, [change['author'] for change in self.history.changes])
+        self.assertEqual([], self.history.errors)
+
+    def testStatusKeywords(self):
+        changes = self.translate(activity('status', '10', '20'), activity('status', '20', '80', time=1400000400))
+        self.assertEqual([('keywords', '', 'FEEDBACK'), ('status', 'new', 'assigned'),
+                          ('keywords', 'FEEDBACK', 'RESOLVED'), ('status', 'assigned', 'closed')], changes)
+
+    def testIgnoredFields(self):
+        # the values of ignored fields are not looked at
+        self.assertEqual([], self.translate(activity('', 'x', 'y'), activity('os', 'x', 'y'),
+                                            activity('View_State', '10', '50'), activity('project_id', 'x', 'y')))
+        self.assertEqual([], self.history.errors)
+
+    def testUnchangedValuesAreSkipped(self):
+        # 'open' and 'reopened' both translate to no resolution
+        self.assertEqual([], self.translate(activity('priority', '30', '30'), activity('resolution', '10', '30')))
+
+    def testChangeset(self):
+        changes = self.translate(activity('source_changeset_attached', '', 'proj master abc123'),
+                                 activity('source_changeset_attached', '', 'abc123', time=1400000400))
+        self.assertEqual(2, len(changes))
+        self.assertEqual([(1400000300, u'alice', 'proj [/browser/?rev=abc123 master] [abc123]')], self.history.comments)
+        self.assertEqual(1, len(self.history.errors))
+
+    def testExtraTranslators(self):
+        translator = mantis2trac.ActivityTranslator(extra={'Fixed_In_Version': 'milestone',
+                                                           'platform': lambda ticketChange, history: None})
+        self.assertEqual([('milestone', u'1.0', u'1.1')],
+                         self.translate(activity('fixed_in_version', u'1.0', u'1.1'), activity('platform', 'a', 'b'),
+                                        translator=translator))
+
+    def testUnknownValueSkipsTheChange(self):
+        changes = self.translate(activity('priority', '30', '99'), activity('severity', '50', 'x'),
+                                 activity('priority', '30', '40', time=1400000400))
+        self.assertEqual([('priority', 'normal', 'high')], changes)
+        self.assertEqual(2, len(self.history.errors))
+        self.assertTrue('unknown priority value' in self.history.errors[0])
+        self.assertTrue('unknown severity value' in self.history.errors[1])
+
+    def testUnknownValueKeepsTheBug(self):
+        bug = {'id': 7, 'date_submitted': 1400000000, 'last_updated': 1400000500, 'name': u'core',
+               'severity': 50, 'priority': 30, 'handler_id': 0, 'reporter_id': 1, 'version': u'',
+               'target_version': u'', 'summary': u'summary', 'status': 10, 'resolution': 10, 'bug_text_id': 7}
+        rows = {'text': None, 'notes': [], 'changesets': mantis2trac.ChangesetIndex([]), 'attachments': [],
+                'history': [activity('resolution', '10', '99'), activity('priority', '20', '30')]}
+        record = mantis2trac.translateOrReport(bug, rows, lambda userid: u'alice')
+        self.assertFalse('error' in record)
+        self.assertEqual([('priority', 'low', 'normal')],
+                         [(change['field'], change['oldvalue'], change['newvalue']) for change in record['changes']])
+        self.assertEqual(1, len(record['errors']))
+
+def historyRow(id, bugid, userid, time, field='source_changeset_attached', value='proj master abc123'):
+    return {'id': id, 'bug_id': bugid, 'user_id': userid, 'date_modified': time, 'field_name': field, 'new_value': value}
+
+@unittest.skipIf(mantis2trac is None, "mantis2trac cannot be imported: %s" % (mantis2trac is None and missing))
+class ChangesetIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = mantis2trac.ChangesetIndex([
+            historyRow(1, 7, 1, 1400000100),
+            historyRow(2, 7, 1, 1400000100, field='status', value='80'),
+            historyRow(3, 8, 2, 1400000200),
+        ])
+
+    def find(self, bugid, userid, time):
+        row = self.index.find(bugid, userid, time)
+        return row and row['id']
+
+    def testWindow(self):
+        # less than two seconds before or after the bugnote
+        for time in (1400000099, 1400000100, 1400000101):
+            self.assertEqual(1, self.find(7, 1, time))
+        self.assertEqual(None, self.find(7, 1, 1400000098))
+        self.assertEqual(None, self.find(7, 1, 1400000102))
+
+    def testBugAndUser(self):
+        self.assertEqual(None, self.find(7, 2, 1400000100))
+        self.assertEqual(None, self.find(8, 1, 1400000200))
+        self.assertEqual(3, self.find(8, 2, 1400000200))
+        self.assertEqual(None, self.find(9, 1, 1400000100))
+
+    def testFirstChangesetInTheWindow(self):
+        index = mantis2trac.ChangesetIndex([historyRow(5, 7, 1, 1400000101), historyRow(4, 7, 1, 1400000101),
+                                            historyRow(6, 7, 1, 1400000099)])
+        self.assertEqual(6, index.find(7, 1, 1400000100)['id'])
+        self.assertEqual(4, index.find(7, 1, 1400000102)['id'])
+
+@unittest.skipIf(mantis2trac is None, "mantis2trac cannot be imported: %s" % (mantis2trac is None and missing))
+class StagingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mantis2trac')
+        self.staging = mantis2trac.Staging(os.path.join(self.dir, 'staging')).create()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def attachment(self, id, name, content):
+        f = open(os.path.join(self.dir, name), 'wb')
+        f.write(content)
+        f.close()
+        return {'id': id, 'folder': self.dir, 'diskfile': name}
+
+    def testRows(self):
+        users = [{'id': 1, 'username': u'j\xfcrgen', 'realname': u'J\xfcrgen \u65e5', 'last_visit': 1400000000},
+                 {'id': 2, 'username': u'bob', 'realname': None, 'last_visit': 0}]
+        self.staging.writeRows('users', users)
+        self.assertEqual(users, self.staging.rows('users'))
+        self.assertEqual(2, len(open(os.path.join(self.staging.path, 'users.ndjson')).readlines()))
+
+    def testManifest(self):
+        self.assertRaises(Exception, self.staging.readManifest)
+        self.staging.writeManifest({'bugs': 2})
+        self.assertEqual({'bugs': 2, 'format': mantis2trac.Staging.FORMAT}, self.staging.readManifest())
+        # an extraction is incomplete until its manifest is written again
+        self.staging.create()
+        self.assertRaises(Exception, self.staging.readManifest)
+
+    def testBlobs(self):
+        source = mantis2trac.DiskAttachmentSource(linkFiles=False)
+        digests = [self.staging.addBlob(source, None, self.attachment(id, name, content))
+                   for id, name, content in ((1, 'a.txt', 'same'), (2, 'b.txt', 'other'), (3, 'c.txt', 'same'))]
+        self.assertEqual([hashlib.sha1('same').hexdigest(), hashlib.sha1('other').hexdigest()], digests[:2])
+        self.assertEqual(digests[0], digests[2])
+        blobs = [os.path.join(root, name) for root, dirs, names in os.walk(os.path.join(self.staging.path, 'blobs'))
+                 for name in names]
+        self.assertEqual(sorted([self.staging.blobPath(digest) for digest in digests[:2]]), sorted(blobs))
+        self.assertEqual('same', open(self.staging.blobPath(digests[0]), 'rb').read())
+
+        # loaded back, the content is identified by its sha1
+        staged = mantis2trac.StagedAttachmentSource(self.staging, linkFiles=False)
+        path = os.path.join(self.dir, 'copy.txt')
+        self.assertEqual(('sha1', digests[0], 4), staged.copy(None, {'blob': digests[0]}, path))
+        self.assertEqual('same', open(path, 'rb').read())
+
+    def testTranslatedBugs(self):
+        lines = []
+        for bugid in (3, 4):
+            bug = {'id': bugid, 'date_submitted': 1400000000, 'last_updated': 1400000500, 'name': u'core',
+                   'severity': 50, 'priority': 30, 'handler_id': 0, 'reporter_id': 1, 'version': u'',
+                   'target_version': u'', 'summary': u'summary %d' % bugid, 'status': 10, 'resolution': 10,
+                   'bug_text_id': bugid}
+            lines.append({'bug': bug, 'text': None, 'notes': [], 'attachments': [],
+                          'history': [dict(historyRow(bugid, bugid, 1, 1400000100, field='priority', value='40'), old_value='30')]})
+        self.staging.writeRows('bugs', lines)
+        records = list(self.staging.translatedBugs(lambda userid: u'alice'))
+        self.assertEqual([(3, u'summary 3', 'high'), (4, u'summary 4', 'high')],
+                         [(record['id'], record['ticket']['summary'], record['ticket']['priority']) for record in records])
+        self.assertEqual([4], [record['id'] for record in self.staging.translatedBugs(lambda userid: u'alice', afterId=3)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the statement counting, profiling and dry run connections of
+metrics.py, on sqlite3 connections.
+
+  python -m unittest discover tests
+"""
+import os
+import sys
+import sqlite3
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from metrics import Metrics, QueryProfile, CountingConnection, NullConnection, normalizeSql, writtenRows, valueBytes
+
+def memoryDatabase():
+    con = sqlite3.connect(':memory:')
+    con.execute("CREATE TABLE bug (id INTEGER PRIMARY KEY, summary TEXT)")
+    return con
+
+class NormalizeSqlTestCase(unittest.TestCase):
+    def testLiterals(self):
+        self.assertEqual("SELECT * FROM bug WHERE id = ? AND summary = ?",
+                         normalizeSql("SELECT * FROM bug WHERE id = 12 AND summary = 'it''s \\'quoted\\''"))
+        self.assertEqual("SELECT ? FROM bug_2", normalizeSql("SELECT 1.5 FROM bug_2"))
+
+    def testWhiteSpace(self):
+        self.assertEqual("SELECT id FROM bug WHERE id = ?", normalizeSql("  SELECT id\n\tFROM   bug\n WHERE id = 3 "))
+
+    def testLists(self):
+        self.assertEqual("SELECT * FROM bug WHERE id IN (?, ...)", normalizeSql("SELECT * FROM bug WHERE id IN (1, 2, 3)"))
+        self.assertEqual(normalizeSql("SELECT * FROM bug WHERE id IN (1, 2)"),
+                         normalizeSql("SELECT * FROM bug WHERE id IN (4, 5, 6, 7)"))
+        self.assertEqual("INSERT INTO bug (id, summary) VALUES (?, ...), ...",
+                         normalizeSql("INSERT INTO bug (id, summary) VALUES (1, 'a'), (2, 'b'), (3, 'c')"))
+
+class CountingConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics('test', 0)
+        self.con = CountingConnection(memoryDatabase(), self.metrics, 'db')
+
+    def testCounters(self):
+        cursor = self.con.cursor()
+        cursor.execute("INSERT INTO bug (id, summary) VALUES (1, 'a')")
+        cursor.executemany("INSERT INTO bug (id, summary) VALUES (?, ?)", [(2, 'b'), (3, 'c')])
+        self.con.commit()
+        cursor.execute("SELECT * FROM bug")
+        self.assertEqual(1, len([cursor.fetchone()]))
+        self.assertEqual(2, len(cursor.fetchall()))
+        cursor.execute("SELECT * FROM bug WHERE id > ?", (1,))
+        self.assertEqual(2, len(list(cursor)))
+        self.assertEqual({'db.queries': 4, 'db.rows_written': 3, 'db.rows_read': 5, 'db.commits': 1}, self.metrics.counters)
+
+    def testPassThrough(self):
+        cursor = self.con.cursor()
+        cursor.execute("INSERT INTO bug (summary) VALUES ('a')")
+        self.assertEqual(1, cursor.lastrowid)
+        self.con.rollback()
+        self.assertEqual(0, self.metrics.counters.get('db.commits', 0))
+
+    def testProfile(self):
+        self.metrics.profile = QueryProfile(0, 10)
+        cursor = self.con.cursor()
+        for n in range(3):
+            cursor.execute("INSERT INTO bug (id, summary) VALUES (%d, 'bug %d')" % (n, n))
+        cursor.execute("SELECT * FROM bug WHERE id < 2")
+        cursor.fetchall()
+        statements = dict([(statement['statement'], statement) for statement in self.metrics.profile.report()])
+        self.assertEqual(['INSERT INTO bug (id, summary) VALUES (?, ...)', 'SELECT * FROM bug WHERE id < ?'], sorted(statements))
+        insert = statements['INSERT INTO bug (id, summary) VALUES (?, ...)']
+        self.assertEqual(('db', 3, 3), (insert['database'], insert['count'], insert['rows']))
+        # the fetched rows count for the query, the fetch is no execution
+        select = statements['SELECT * FROM bug WHERE id < ?']
+        self.assertEqual((1, 2), (select['count'], select['rows']))
+
+    def testMerge(self):
+        self.metrics.profile = QueryProfile(0, 10)
+        child = self.metrics.child('thread')
+        CountingConnection(memoryDatabase(), child, 'db').cursor().execute("SELECT 1")
+        self.con.cursor().execute("SELECT 2")
+        self.metrics.merge(child)
+        self.assertEqual(2, self.metrics.counters['db.queries'])
+        self.assertEqual([2], [statement['count'] for statement in self.metrics.profile.report()])
+
+class NullConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics('test', 0)
+        self.database = memoryDatabase()
+        self.database.execute("INSERT INTO bug (id, summary) VALUES (1, 'existing')")
+        # the way the converters stack them for --dry-run
+        self.con = CountingConnection(NullConnection(self.database, self.metrics, 'db', firstId=1000), self.metrics, 'db')
+
+    def testQueriesReadTheDatabase(self):
+        cursor = self.con.cursor()
+        cursor.execute("SELECT summary FROM bug WHERE id = ?", (1,))
+        self.assertEqual([(u'existing',)], cursor.fetchall())
+
+    def testWritesAreDiscarded(self):
+        cursor = self.con.cursor()
+        cursor.execute("INSERT INTO bug (id, summary) VALUES (?, ?)", (2, 'abc'))
+        self.assertEqual([], cursor.fetchall())
+        cursor.execute("UPDATE bug SET summary = 'changed'")
+        cursor.executemany("INSERT INTO bug (id, summary) VALUES (?, ?)", [(3, 'b'), (4, 'cd')])
+        self.con.commit()
+        self.assertEqual([(1, u'existing')], self.database.execute("SELECT id, summary FROM bug").fetchall())
+        self.assertEqual(4, self.metrics.counters['db.rows_written'])
+        self.assertEqual(1, self.metrics.counters['db.commits'])
+        # 8 bytes per number, the length of strings and of statements
+        # without parameters
+        self.assertEqual(11 + len("UPDATE bug SET summary = 'changed'") + 19, self.metrics.counters['db.bytes_discarded'])
+
+    def testIds(self):
+        cursor = self.con.cursor()
+        cursor.execute("INSERT INTO bug (summary) VALUES ('a')")
+        self.assertEqual((1, 1001), (cursor.rowcount, cursor.lastrowid))
+        # the id of the first row, like MySQL
+        cursor.execute("INSERT INTO bug (summary) VALUES ('b'), ('c')")
+        self.assertEqual((2, 1002), (cursor.rowcount, cursor.lastrowid))
+        cursor.executemany("INSERT INTO bug (summary) VALUES (?)", [('d',), ('e',), ('f',)])
+        self.assertEqual((3, 1004), (cursor.rowcount, cursor.lastrowid))
+        cursor.execute("SELECT COUNT(*) FROM bug")
+        self.assertEqual([(1,)], cursor.fetchall())
+
+    def testWrittenRows(self):
+        self.assertEqual(1, writtenRows("INSERT INTO bug (summary) VALUES (%s)"))
+        self.assertEqual(3, writtenRows("insert into bug (id, summary) values (1, 'a'), (2, 'b') , (3, 'c')"))
+        self.assertEqual(1, writtenRows("REPLACE INTO bug SELECT * FROM other"))
+        self.assertEqual(1, writtenRows("UPDATE bug SET summary = ''"))
+        self.assertEqual(0, writtenRows("DELETE FROM bug"))
+
+    def testValueBytes(self):
+        self.assertEqual(len("DELETE FROM bug"), valueBytes("DELETE FROM bug", None))
+        self.assertEqual(8 + 5, valueBytes("", (1, u'abcde', None)))
+        self.assertEqual(3, valueBytes("", 'abc'))
+        self.assertEqual(8 + 2, valueBytes("", {'id': 1, 'summary': 'ab'}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,7 +5,7 @@ Import Trac bugs into a Mantis database.
 
 Requires:  Trac 1.0.1 or newer from http://trac.edgewall.com/
            Mantis 1.2.18 from http://www.mantisbt.org/
-           Python 2.4 from http://www.python.org/
+           Python 2.6 from http://www.python.org/
            MySQL >= 3.23 from http://www.mysql.org/
 
 Steffen Mecke <stm2@users.sourceforge.net>
@@ -67,6 +67,50 @@ PROJECT = "Magellan 2"
 NN_NAME = "N. N."
 NN_EMAIL = "noreply@localhost"
 
+# Print every created project, category and bug.  A line per bug slows
+# down large imports noticeably.  Can also be set on the command line
+# (--verbose).
+VERBOSE = False
+
+# If set, a JSON report with the wall time of every phase and counters of
+# the queries, rows, commits and bytes is written to this file (--report)
+METRICS_REPORT = None
+
+# Time every statement on the Trac and Mantis databases and list the
+# PROFILE_TOP statements taking the most time at the end (--profile).
+# Statements slower than SLOW_QUERY_SECONDS are printed when they finish.
+PROFILE_QUERIES = False
+PROFILE_TOP = 20
+SLOW_QUERY_SECONDS = 1.0
+
+# Bugs and their texts are written in batches of this size.  Their ids,
+# and those of the bug note texts and new users, are assigned by the
+# script, counting up from the largest id in use.  The Mantis tables are
+# locked (LOCK TABLES, see IMPORT_TABLES) while the import runs, so no
+# other client can take these ids in the meantime.
+BUG_BATCH_SIZE = 500
+
+# The ticket changes are read for this many tickets at a time.
+CHANGE_CHUNK_SIZE = 500
+
+# Bug notes and history entries are written once this many history
+# entries are queued, or when the last write is this many seconds ago.
+HISTORY_BATCH_SIZE = 1000
+HISTORY_FLUSH_SECONDS = 10
+
+# All Trac users are looked up, and the missing ones created, before the
+# tickets are imported, this many users per statement.
+USER_BATCH_SIZE = 1000
+
+# Ticket keywords become Mantis tags.  The existing tags are loaded once;
+# new tags and the tags of the bugs are written in batches of this size.
+TAG_BATCH_SIZE = 500
+
+# Read and convert all tickets, but do not write anything to the Mantis
+# database (--dry-run).  Queries on Mantis are still run, all other
+# statements are discarded and only counted; inserted rows get made up ids.
+DRY_RUN = False
+
 ###########################################################################
 ### You probably don't need to change any configuration past this line. ###
 ###########################################################################
@@ -206,15 +250,26 @@ PRIORITY_TRANSLATE = {
 }
 
 PRIORITY_TRAC_MANTIS = {
+    'none' : 10,
     'trivial' : 20,
     'minor' : 20,
     'low' : 20,
     'normal' : 30,
     'high' : 40,
     'major' : 50,
-    'critical' : 60
+    'urgent' : 50,
+    'critical' : 60,
+    'blocker' : 60,
+    'immediate' : 60
 }
 
+# Tables locked during the import.  MySQL only lets a session that holds
+# table locks use the tables it locked.
+IMPORT_TABLES = ['mantis_project_table', 'mantis_user_table', 'mantis_category_table',
+                 'mantis_bug_table', 'mantis_bug_text_table', 'mantis_bugnote_table',
+                 'mantis_bugnote_text_table', 'mantis_bug_history_table', 'mantis_tag_table',
+                 'mantis_bug_tag_table']
+
 EDIT_TYPES_NONE = 0
 EDIT_TYPES_NOTE_ADDED = 2
 
@@ -227,38 +282,49 @@ import re
 import sys
 import string
 import StringIO
+import itertools
 
 import MySQLdb
 import MySQLdb.cursors
 from trac.env import Environment
 
+from metrics import Metrics, QueryProfile, CountingConnection, NullConnection
+
 if not hasattr(sys, 'setdefaultencoding'):
     reload(sys)
 
 sys.setdefaultencoding('utf-8')
 
 class TracDatabase(object):
-    def __init__(self, project_name, path, db, host, user, password, append):
+    def __init__(self, project_name, path, db, host, user, password, append, metrics=None, dryRun=False):
         self.env = Environment(path)
         self._append = append
+        self.dryRun = dryRun
 
         self._tracdb = self.env.get_db_cnx()
         self._tracdb.autocommit = False
-        self._trac_cursor = self._tracdb.cursor()
         self._mantis_con = MySQLdb.connect(host=host, 
                 user=user, passwd=password, db=db, compress=1, 
                 cursorclass=MySQLdb.cursors.DictCursor, use_unicode=1)
+        if dryRun:
+            self._mantis_con = NullConnection(self._mantis_con, metrics, 'mantis')
+        if metrics is not None:
+            self._tracdb = CountingConnection(self._tracdb, metrics, 'trac')
+            self._mantis_con = CountingConnection(self._mantis_con, metrics, 'mantis')
+        self._trac_cursor = self._tracdb.cursor()
         self._mantis_cursor = self._mantis_con.cursor()
 
         sql = "SELECT id FROM mantis_project_table WHERE name = %s" % (project_name)
-        print sql
+        if VERBOSE:
+            print sql
         self.mantisCursor().execute("SELECT id FROM mantis_project_table WHERE name = %s", (project_name))
         result = self.mantisCursor().fetchall()
         if len(result) > 1:
             raise Exception("Ambiguous project name %s" % project_name)
         elif len(result) == 0:
             sql = """INSERT INTO mantis_project_table (name) VALUES (%s)""" % (project_name)
-            print sql
+            if VERBOSE:
+                print sql
             self.mantisCursor().execute("""INSERT INTO mantis_project_table (name) VALUES (%s)""" , (project_name))
             self.mantisCommit()
             self._project_id = int(self.mantisCursor().lastrowid)
@@ -267,7 +333,22 @@ class TracDatabase(object):
 
         self._bug_map = {}
         self._user_map = {}
+        # cookie strings in use, see preloadUsers
+        self._cookies = None
         self._category_map = {}
+        # tag ids by lower case name (tag names are compared case
+        # insensitively by MySQL), see preloadTags
+        self._tag_map = None
+        self._new_tags = []
+        self._bug_tags = []
+        # next free id by table, see nextId
+        self._next_id = {}
+        self._bug_texts = []
+        self._bugs = []
+        self._note_texts = []
+        self._notes = []
+        self._history = []
+        self._history_flushed = time.time()
         
     def projectId(self):
         return self._project_id
@@ -295,6 +376,8 @@ class TracDatabase(object):
         self.mantisCommit()
 
     def assertNoTickets(self):
+        if self.dryRun:
+            return
         if not self._append and self.hasTickets():
           raise Exception("Will not modify database with existing tickets!")
           return
@@ -319,37 +402,56 @@ class TracDatabase(object):
     def bugId(self, tracId):
         return self._bug_map[tracId]
 
+    def tracTickets(self):
+        return self._bug_map.keys()
+
     def userId(self, username):
         if username == '' or username is None:
             return 0
         if username not in self._user_map:
-            sql = """SELECT id, username FROM mantis_user_table WHERE username = %s""" % (username)
-            print sql
-            self.mantisCursor().execute("""SELECT id, username FROM mantis_user_table WHERE username = %s""" , (username))
-            result = self.mantisCursor().fetchall()
-            print result
-            if result:
-                self._user_map[username] = int(result[0]['id'])
-            else:
-                result = ((1))
-                while result:
-                    cookie = self.generateCookie(64)
-                    print cookie
-                    self.mantisCursor().execute("""SELECT cookie_string FROM mantis_user_table WHERE cookie_string = %s""" , (cookie))
-                    result = self.mantisCursor().fetchall()
-
-                sql = """INSERT INTO mantis_user_table (username, realname, email, password, cookie_string) VALUES (%s, %s, %s, Md5(%s), %s) """ % (username, NN_NAME, NN_EMAIL, self.generatePassword(16), cookie)
-                print sql
-                self.mantisCursor().execute("""INSERT INTO mantis_user_table (username, realname, email, password, cookie_string) VALUES (%s, %s, %s, MD5(%s), %s) """ , (username, NN_NAME, NN_EMAIL, str(self.generatePassword(16)), str(cookie)))
-                self.mantisCommit()
-                self._user_map[username] = int(self.mantisCursor().lastrowid)
-
+            self.preloadUsers([username])
         return self._user_map[username]
+
+    def preloadUsers(self, usernames):
+        """Look up the ids of the given Mantis users, creating the missing
+        ones.  Usernames are compared case insensitively, like MySQL does."""
+        usernames = [username for username in set(usernames) if username and username not in self._user_map]
+        c = self.mantisCursor()
+        found = {}
+        for i in range(0, len(usernames), USER_BATCH_SIZE):
+            chunk = usernames[i:i + USER_BATCH_SIZE]
+            c.execute("SELECT id, username FROM mantis_user_table WHERE username IN (%s)" % ', '.join(['%s'] * len(chunk)),
+                      tuple(chunk))
+            for row in c.fetchall():
+                found[row['username'].lower()] = int(row['id'])
+
+        users = []
+        for username in sorted(usernames):
+            if username.lower() not in found:
+                if self._cookies is None:
+                    c.execute("SELECT cookie_string FROM mantis_user_table")
+                    self._cookies = set([row['cookie_string'] for row in c.fetchall()])
+                cookie = self.generateCookie(64)
+                while cookie in self._cookies:
+                    cookie = self.generateCookie(64)
+                self._cookies.add(cookie)
+                found[username.lower()] = self.nextId('mantis_user_table')
+                users.append((found[username.lower()], username, NN_NAME, NN_EMAIL, hashlib.md5(self.generatePassword(16)).hexdigest(), cookie))
+            self._user_map[username] = found[username.lower()]
+
+        for i in range(0, len(users), USER_BATCH_SIZE):
+            if VERBOSE:
+                print "Adding %d users" % len(users[i:i + USER_BATCH_SIZE])
+            c.executemany("""INSERT INTO mantis_user_table (id, username, realname, email, password, cookie_string)
+                  VALUES (%s, %s, %s, %s, %s, %s)""", users[i:i + USER_BATCH_SIZE])
+        if users:
+            self.mantisCommit()
         
     def categoryId(self, category):
         if category not in self._category_map:
             sql = """SELECT id FROM mantis_category_table WHERE name = %s AND project_id = '%d'""" % (category, int(self.projectId()))
-            print sql
+            if VERBOSE:
+                print sql
             self.mantisCursor().execute("""SELECT id FROM mantis_category_table WHERE name = %s AND project_id = %s""" , (category, self.projectId()))
             result = self.mantisCursor().fetchall()
             if result:
@@ -357,7 +459,8 @@ class TracDatabase(object):
             else:
                 sql = """INSERT INTO mantis_category_table 
                   (project_id, name) VALUES (%s, %s) """ % (self.projectId(), category)
-                print sql
+                if VERBOSE:
+                    print sql
                 self.mantisCursor().execute("""INSERT INTO mantis_category_table 
                   (project_id, name) VALUES (%s, %s) """ , (self.projectId(), category))
                 self.mantisCommit()
@@ -365,6 +468,127 @@ class TracDatabase(object):
 
         return self._category_map[category]
         
+    def lockTables(self):
+        """Lock the Mantis tables the import writes to, so the ids handed
+        out by `nextId` stay free until the rows are written"""
+        self.mantisCursor().execute("LOCK TABLES %s" % ', '.join(['%s WRITE' % table for table in IMPORT_TABLES]))
+
+    def unlockTables(self):
+        self.mantisCursor().execute("UNLOCK TABLES")
+
+    def nextId(self, table):
+        """Reserve the next id of `table`, see `lockTables`"""
+        if table not in self._next_id:
+            self.mantisCursor().execute("SELECT MAX(id) AS id FROM %s" % table)
+            self._next_id[table] = int(self.mantisCursor().fetchall()[0]['id'] or 0) + 1
+        self._next_id[table] += 1
+        return self._next_id[table] - 1
+
+    def addBug(self, description, bug):
+        """Queue a Mantis bug with the given description.  `bug` holds the
+        values of the mantis_bug_table columns after bug_text_id in the
+        INSERT of `flushBugs`.  Returns the id of the new bug."""
+        textId = self.nextId('mantis_bug_text_table')
+        bugId = self.nextId('mantis_bug_table')
+        self._bug_texts.append((textId, description, '', ''))
+        self._bugs.append((bugId, textId) + tuple(bug))
+        if len(self._bugs) >= BUG_BATCH_SIZE:
+            self.flushBugs()
+        return bugId
+
+    def flushBugs(self):
+        """Write the queued bugs and their texts"""
+        if not self._bugs:
+            return
+        # MySQLdb turns these into multi-row INSERTs, as long as the
+        # VALUES list only holds placeholders and stays on one line
+        self.mantisCursor().executemany("""INSERT INTO mantis_bug_text_table (id, description, steps_to_reproduce, additional_information)
+              VALUES (%s, %s, %s, %s)""", self._bug_texts)
+        self.mantisCursor().executemany("""INSERT INTO mantis_bug_table
+              (id, bug_text_id, project_id, reporter_id, handler_id,
+               priority, severity, status, resolution,
+               version, target_version, summary,
+               category_id, date_submitted, last_updated)
+              VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""", self._bugs)
+        self.mantisCommit()
+        self._bug_texts = []
+        self._bugs = []
+
+    def addNote(self, bugId, userId, date, note):
+        """Queue a bug note and its history entry"""
+        noteId = self.nextId('mantis_bugnote_text_table')
+        self._note_texts.append((noteId, note))
+        self._notes.append((bugId, userId, noteId, date, date))
+        self.addHistory(userId, bugId, "", noteId, "", EDIT_TYPES_NOTE_ADDED, date)
+
+    def addHistory(self, userId, bugId, field, oldValue, newValue, type, date):
+        """Queue a bug history entry"""
+        self._history.append((userId, bugId, field, oldValue, newValue, type, date))
+        if len(self._history) >= HISTORY_BATCH_SIZE or time.time() - self._history_flushed >= HISTORY_FLUSH_SECONDS:
+            self.flushHistory()
+
+    def flushHistory(self):
+        """Write the queued bug notes and history entries"""
+        c = self.mantisCursor()
+        if self._notes:
+            c.executemany("""INSERT INTO mantis_bugnote_text_table (id, note)
+                  VALUES (%s, %s)""", self._note_texts)
+            c.executemany("""INSERT INTO mantis_bugnote_table (bug_id, reporter_id, bugnote_text_id, last_modified, date_submitted)
+                  VALUES (%s, %s, %s, %s, %s)""", self._notes)
+        if self._history:
+            c.executemany("""INSERT INTO mantis_bug_history_table (user_id, bug_id, field_name, old_value, new_value, type, date_modified)
+                  VALUES (%s, %s, %s, %s, %s, %s, %s)""", self._history)
+        self.mantisCommit()
+        self._note_texts = []
+        self._notes = []
+        self._history = []
+        self._history_flushed = time.time()
+
+    def preloadTags(self):
+        """Load the ids of all existing Mantis tags"""
+        self.mantisCursor().execute("SELECT id, name FROM mantis_tag_table")
+        self._tag_map = dict([(row['name'].lower(), int(row['id'])) for row in self.mantisCursor().fetchall()])
+
+    def addBugTag(self, bugId, keyword, userId, time):
+        """Tag Mantis bug `bugId` with `keyword`, creating the tag if needed.
+        The rows are written by `flushTags`."""
+        if self._tag_map is None:
+            self.preloadTags()
+        key = keyword.lower()
+        if key not in self._tag_map:
+            self._tag_map[key] = None
+            self._new_tags.append((userId, keyword, time, time))
+        self._bug_tags.append((bugId, key, userId, time))
+        if len(self._bug_tags) >= TAG_BATCH_SIZE:
+            self.flushTags()
+
+    def flushTags(self):
+        """Write the new tags and the pending bug tags"""
+        self.flushBugs()
+        c = self.mantisCursor()
+        for i in range(0, len(self._new_tags), TAG_BATCH_SIZE):
+            tags = self._new_tags[i:i + TAG_BATCH_SIZE]
+            # MySQLdb sends this as a single multi-row INSERT
+            c.executemany("""INSERT INTO mantis_tag_table (user_id, name, date_created, date_updated)
+                  VALUES (%s, %s, %s, %s)""", tags)
+            firstId = c.lastrowid
+            c.execute("SELECT id, name FROM mantis_tag_table WHERE name IN (%s)" % ', '.join(['%s'] * len(tags)),
+                      tuple([tag[1] for tag in tags]))
+            for row in c.fetchall():
+                self._tag_map[row['name'].lower()] = int(row['id'])
+            # tags that can not be read back (in a dry run) get the ids
+            # MySQL assigns to the rows of a multi-row INSERT
+            for j, tag in enumerate(tags):
+                if self._tag_map[tag[1].lower()] is None:
+                    self._tag_map[tag[1].lower()] = firstId + j
+        self._new_tags = []
+
+        if self._bug_tags:
+            c.executemany("""INSERT INTO mantis_bug_tag_table (bug_id, tag_id, user_id, date_attached)
+                  VALUES (%s, %s, %s, %s)""", [(bugId, self._tag_map[key], userId, time) for bugId, key, userId, time in self._bug_tags])
+            self._bug_tags = []
+        self.mantisCommit()
+
     def convertMantisTime(self,time2):
 	time2 = datetime.fromtimestamp(time2)
 	return long(str(int(time.mktime(time2.timetuple()))) + '000000')
@@ -374,31 +598,20 @@ class TracDatabase(object):
 	return time2
 
 
+def ticketChanges(db, tickets, chunkSize=CHANGE_CHUNK_SIZE):
+    """Yield (ticket, changes) for the given ticket ids in ascending order,
+    with the changes of each ticket ordered by time.  Only the changes of
+    `chunkSize` tickets are held in memory at a time."""
+    tickets = sorted(tickets)
+    for i in range(0, len(tickets), chunkSize):
+        chunk = tickets[i:i + chunkSize]
+        db.tracCursor().execute("""SELECT ticket, time, author, field, oldvalue, newvalue FROM ticket_change
+              WHERE ticket >= %s AND ticket <= %s ORDER BY ticket, time""", (chunk[0], chunk[-1]))
+        for ticket, changes in itertools.groupby(db.tracCursor().fetchall(), lambda change: change[0]):
+            yield ticket, list(changes)
+
 def commentConvert(db, change_ticket, change_time, change_author, change_field, change_oldvalue, change_newvalue):
-    sql = """INSERT INTO mantis_bugnote_text_table 
-          (note) VALUES (%s)""" % change_newvalue
-    print sql
-    db.mantisCursor().execute("""INSERT INTO mantis_bugnote_text_table 
-          (note) VALUES (%s)""" , (change_newvalue.encode('iso-8859-1','replace')))
-    note_id = db.mantisCursor().lastrowid
-
-    sql = """INSERT INTO mantis_bugnote_table
-          (bug_id, reporter_id, bugnote_text_id, last_modified, date_submitted)
-          VALUES (%s, %s, %s, %s, %s)""" % (db.bugId(change_ticket), db.userId(change_author), note_id, db.convertTracTime(change_time), db.convertTracTime(change_time) )
-    print sql
-    db.mantisCursor().execute("""INSERT INTO mantis_bugnote_table
-          (bug_id, reporter_id, bugnote_text_id, last_modified, date_submitted)
-          VALUES (%s, %s, %s, %s, %s)""" , (db.bugId(change_ticket), db.userId(change_author), note_id, db.convertTracTime(change_time), db.convertTracTime(change_time) ))
-    db.mantisCommit()
-
-    sql = """INSERT INTO mantis_bug_history_table
-          (user_id, bug_id, field_name, old_value, new_value, type, date_modified)
-          VALUES (%s, %s, %s, %s, %s, %d, %s)""" % (db.userId(change_author), db.bugId(change_ticket), "", note_id, "", EDIT_TYPES_NOTE_ADDED, db.convertTracTime(change_time))
-    print sql
-    db.mantisCursor().execute("""INSERT INTO mantis_bug_history_table
-          (user_id, bug_id, field_name, old_value, new_value, type, date_modified)
-          VALUES (%s, %s, %s, %s, %s, %s, %s)""" , (db.userId(change_author), db.bugId(change_ticket), "", note_id, "", EDIT_TYPES_NOTE_ADDED, db.convertTracTime(change_time)))
-    db.mantisCommit()
+    db.addNote(db.bugId(change_ticket), db.userId(change_author), db.convertTracTime(change_time), change_newvalue.encode('iso-8859-1','replace'))
 
 
 def changeConvert(db, change_ticket, change_time, change_author, field_name, old_value, new_value, type):
@@ -407,45 +620,28 @@ def changeConvert(db, change_ticket, change_time, change_author, field_name, old
     if new_value is None:
         new_value = ""
 
-    sql = """INSERT INTO mantis_bug_history_table
-          (user_id, bug_id, field_name, old_value, new_value, type, date_modified)
-          VALUES (%s, %s, %s, %s, %s, %s, %s)""" % (db.userId(change_author), db.bugId(change_ticket), field_name, old_value, new_value, type, db.convertTracTime(change_time))
-    print sql
-    db.mantisCursor().execute("""INSERT INTO mantis_bug_history_table
-          (user_id, bug_id, field_name, old_value, new_value, type, date_modified)
-          VALUES (%s, %s, %s, %s, %s, %s, %s)""" , (db.userId(change_author), db.bugId(change_ticket), field_name, old_value, new_value, type, db.convertTracTime(change_time)))
-    db.mantisCommit()
+    db.addHistory(db.userId(change_author), db.bugId(change_ticket), field_name, old_value, new_value, type, db.convertTracTime(change_time))
     
 
 
-def convert(project_name, _db, _host, _user, _password, _env, _force, _append):
-    print "Trac database('%s'): connecting..." % (_env)
-    print "Mantis MySQL('%s':'%s':'%s':'%s'): connecting..." % (_db, _host, _user, _password)
-    db = TracDatabase(project_name, _env, _db, _host, _user, _password, _append)
-
-    # force mode...
-    if _force == 1:
-        print "cleaning all tickets..."
-        db.clean('mantis_bugnote_table')
-        db.clean('mantis_bugnote_text_table')
-        db.clean('mantis_bug_file_table')
-        db.clean('mantis_bug_history_table')
-        db.clean('mantis_bug_monitor_table')
-        db.clean('mantis_bug_relationship_table')
-        db.clean('mantis_bug_revision_table')
-        db.clean('mantis_bug_table')
-        db.clean('mantis_bug_text_table')
-        db.clean('mantis_bug_tag_table')
-        db.clean('mantis_tag_table')
-
-
-    db.assertNoTickets()
-
+def importTickets(db, metrics):
+    """Import the users, tickets and ticket changes of the Trac
+    environment, with the Mantis tables locked, see `convert`"""
     # custom fields?
     # categories?
 
+    print
+    print "Resolving users..."
+    metrics.phase('users')
+    db.tracCursor().execute("""SELECT owner FROM ticket UNION SELECT reporter FROM ticket
+          UNION SELECT author FROM ticket_change
+          UNION SELECT oldvalue FROM ticket_change WHERE field IN ('owner', 'reporter')
+          UNION SELECT newvalue FROM ticket_change WHERE field IN ('owner', 'reporter')""")
+    db.preloadUsers([row[0] for row in db.tracCursor().fetchall()])
+
     print
     print "Importing bugs..." 
+    metrics.phase('bugs')
 
     sql = "SELECT * FROM ticket"
     db.tracCursor().execute(sql)
@@ -456,121 +652,133 @@ def convert(project_name, _db, _host, _user, _password, _env, _force, _append):
 
         # currently ignoring: bug_cc
 
-        print "Inserting bug %d: %s..." % (bug_id, bug_summary)
+        if VERBOSE:
+            print "Inserting bug %d: %s..." % (bug_id, bug_summary)
         if len(bug_description) == 0:
             bug_description = "--"
 
-        sql = """INSERT INTO mantis_bug_text_table (description, steps_to_reproduce, additional_information) VALUES (%s, '', '')""" % (bug_description)
-        # print sql
-        db.mantisCursor().execute("""INSERT INTO mantis_bug_text_table (description, steps_to_reproduce, additional_information) VALUES (%s, '', '')""" , (bug_description.encode('iso-8859-1','replace')))
-        db.mantisCommit()
-        bug_description_id = db.mantisCursor().lastrowid
-
         if 'feature' in bug_type:
             severity = SEVERITY_TRAC_MANTIS['feature']
         else:
             severity = SEVERITY_TRAC_MANTIS[bug_severity]
 
-        sql = """INSERT INTO mantis_bug_table
-        (project_id, reporter_id, handler_id, 
-         priority, severity, status, resolution, 
-         version, target_version, 
-         bug_text_id, summary,
-         category_id, date_submitted, last_updated) 
-        VALUES (%d, %d, %d, 
-         %d, %d, %d, %d,
-         %s, %s,
-         %d, %s,
-         %d, %d, %d)""" % (db.projectId(), db.userId(bug_reporter), db.userId(bug_owner),     PRIORITY_TRAC_MANTIS[bug_priority], severity, STATUS_TRAC_MANTIS[bug_status], RESOLUTION_TRAC_MANTIS[bug_resolution],     bug_version, bug_milestone,     bug_description_id, bug_summary,    db.categoryId(bug_component), db.convertTracTime(bug_time), db.convertTracTime(bug_changetime))
-        # print sql;
-        db.mantisCursor().execute("""INSERT INTO mantis_bug_table
-        (project_id, reporter_id, handler_id, 
-         priority, severity, status, resolution, 
-         version, target_version, 
-         bug_text_id, summary,
-         category_id, date_submitted, last_updated) 
-        VALUES (%s, %s, %s,
-         %s, %s, %s, %s,
-         %s, %s,
-         %s, %s,
-         %s, %s, %s)""" , (db.projectId(), db.userId(bug_reporter), db.userId(bug_owner),     PRIORITY_TRAC_MANTIS[bug_priority], severity, STATUS_TRAC_MANTIS[bug_status], RESOLUTION_TRAC_MANTIS[bug_resolution],     bug_version, bug_milestone,     bug_description_id, bug_summary,    db.categoryId(bug_component), db.convertTracTime(bug_time), db.convertTracTime(bug_changetime)))
-        db.mantisCommit()
-        bug_new_id = db.mantisCursor().lastrowid
+        bug_new_id = db.addBug(bug_description.encode('iso-8859-1','replace'),
+            (db.projectId(), db.userId(bug_reporter), db.userId(bug_owner),
+             PRIORITY_TRAC_MANTIS[bug_priority], severity, STATUS_TRAC_MANTIS[bug_status], RESOLUTION_TRAC_MANTIS[bug_resolution],
+             bug_version, bug_milestone, bug_summary,
+             db.categoryId(bug_component), db.convertTracTime(bug_time), db.convertTracTime(bug_changetime)))
         db.newBugId(bug_id, bug_new_id)
         
-        for keyword in bug_keywords.split(" "):
-            if keyword == "":
+        tagged = set()
+        for keyword in (bug_keywords or "").split(" "):
+            if keyword == "" or keyword.lower() in tagged:
                 continue
-            sql = """SELECT id FROM mantis_tag_table WHERE name = '%s'""" % (keyword)
-            print sql
-            db.mantisCursor().execute("""SELECT id FROM mantis_tag_table WHERE name = %s""" , (keyword))
-            foundKeywords = db.mantisCursor().fetchall()
-            if len(foundKeywords) > 0:
-                keyword_id = foundKeywords[0]['id']
-                print "found %s" % keyword_id
-            else:
-                sql = """INSERT INTO mantis_tag_table (user_id, name, date_created, date_updated)
-                      VALUES (%s, %s, %s, %s)""" % (db.userId(bug_reporter), keyword, db.convertTracTime(bug_time), db.convertTracTime(bug_time))
-                print sql
-                db.mantisCursor().execute("""INSERT INTO mantis_tag_table (user_id, name, date_created, date_updated)
-                      VALUES (%s, %s, %s, %s)""" , (db.userId(bug_reporter), keyword, db.convertTracTime(bug_time), db.convertTracTime(bug_time)))
-                db.mantisCommit()
-                keyword_id = db.mantisCursor().lastrowid
-            
-            sql = """INSERT INTO mantis_bug_tag_table VALUES (%d, %d, %d, %s)""" % (bug_id, keyword_id, db.userId(bug_reporter), db.convertTracTime(bug_time))
-            print sql
-            db.mantisCursor().execute("""INSERT INTO mantis_bug_tag_table VALUES (%s, %s, %s, %s)""", (bug_id, keyword_id, db.userId(bug_reporter), db.convertTracTime(bug_time)))
-            db.mantisCommit()
-            
+            tagged.add(keyword.lower())
+            db.addBugTag(bug_new_id, keyword, db.userId(bug_reporter), db.convertTracTime(bug_time))
+        metrics.progress()
+
+    metrics.phase('tags')
+    db.flushTags()
 
     print
     print "Importing bug histories..."
-    sql = "SELECT * FROM ticket_change"
-    db.tracCursor().execute(sql)
+    metrics.phase('changes')
+    for ticket, changes in ticketChanges(db, db.tracTickets()):
+        for change_ticket, change_time, change_author, change_field, change_oldvalue, change_newvalue in changes:
 
-    changes = db.tracCursor().fetchall()
+            # ignored fields: description, cc, keywords, reporter
+            if change_field == 'comment':
+                commentConvert(db, change_ticket, change_time, change_author, change_field, change_oldvalue, change_newvalue)
 
-    for change_ticket, change_time, change_author, change_field, change_oldvalue, change_newvalue in changes:
-        
-        # ignored fields: description, cc, keywords, reporter
-        if change_field == 'comment':
-            commentConvert(db, change_ticket, change_time, change_author, change_field, change_oldvalue, change_newvalue)
-
-        if change_field == 'resolution':
-            changeConvert(db, change_ticket, change_time, change_author, "resolution", RESOLUTION_TRAC_MANTIS[change_oldvalue], RESOLUTION_TRAC_MANTIS[change_newvalue], EDIT_TYPES_NONE)
+            if change_field == 'resolution':
+                changeConvert(db, change_ticket, change_time, change_author, "resolution", RESOLUTION_TRAC_MANTIS[change_oldvalue], RESOLUTION_TRAC_MANTIS[change_newvalue], EDIT_TYPES_NONE)
 
-        if change_field == 'status':
-            changeConvert(db, change_ticket, change_time, change_author, "status", STATUS_TRAC_MANTIS[change_oldvalue], STATUS_TRAC_MANTIS[change_newvalue], EDIT_TYPES_NONE)
+            if change_field == 'status':
+                changeConvert(db, change_ticket, change_time, change_author, "status", STATUS_TRAC_MANTIS[change_oldvalue], STATUS_TRAC_MANTIS[change_newvalue], EDIT_TYPES_NONE)
             
-        if change_field == 'owner':
-            changeConvert(db, change_ticket, change_time, change_author, "handler_id", db.userId(change_oldvalue), db.userId(change_newvalue), EDIT_TYPES_NONE)
+            if change_field == 'owner':
+                changeConvert(db, change_ticket, change_time, change_author, "handler_id", db.userId(change_oldvalue), db.userId(change_newvalue), EDIT_TYPES_NONE)
 
-        if change_field == 'reporter':
-           changeConvert(db, change_ticket, change_time, change_author, "reporter_id", db.userId(change_oldvalue), db.userId(change_newvalue), EDIT_TYPES_NONE)
+            if change_field == 'reporter':
+               changeConvert(db, change_ticket, change_time, change_author, "reporter_id", db.userId(change_oldvalue), db.userId(change_newvalue), EDIT_TYPES_NONE)
 
-        if change_field == 'priority':
-            changeConvert(db, change_ticket, change_time, change_author, "priority", PRIORITY_TRAC_MANTIS[change_oldvalue], PRIORITY_TRAC_MANTIS[change_newvalue], EDIT_TYPES_NONE)
+            if change_field == 'priority':
+                changeConvert(db, change_ticket, change_time, change_author, "priority", PRIORITY_TRAC_MANTIS[change_oldvalue], PRIORITY_TRAC_MANTIS[change_newvalue], EDIT_TYPES_NONE)
             
-        if change_field == 'milestone':
-            changeConvert(db, change_ticket, change_time, change_author, "target_version", change_oldvalue, change_newvalue, EDIT_TYPES_NONE)
+            if change_field == 'milestone':
+                changeConvert(db, change_ticket, change_time, change_author, "target_version", change_oldvalue, change_newvalue, EDIT_TYPES_NONE)
+
+            if change_field == 'summary':
+                changeConvert(db, change_ticket, change_time, change_author, "summary", change_oldvalue, change_newvalue, EDIT_TYPES_NONE)
 
-        if change_field == 'summary':
-            changeConvert(db, change_ticket, change_time, change_author, "summary", change_oldvalue, change_newvalue, EDIT_TYPES_NONE)
+            if change_field == 'version':
+                changeConvert(db, change_ticket, change_time, change_author, "version", change_oldvalue, change_newvalue, EDIT_TYPES_NONE)
 
-        if change_field == 'version':
-            changeConvert(db, change_ticket, change_time, change_author, "version", change_oldvalue, change_newvalue, EDIT_TYPES_NONE)
+            if change_field == 'fixed_in_version':
+                changeConvert(db, change_ticket, change_time, change_author, "fixed_in_version", change_oldvalue, change_newvalue, EDIT_TYPES_NONE)
 
-        if change_field == 'fixed_in_version':
-            changeConvert(db, change_ticket, change_time, change_author, "fixed_in_version", change_oldvalue, change_newvalue, EDIT_TYPES_NONE)
+            if change_field == 'severity':
+                changeConvert(db, change_ticket, change_time, change_author, "severity", SEVERITY_TRAC_MANTIS[change_oldvalue], SEVERITY_TRAC_MANTIS[change_newvalue], EDIT_TYPES_NONE)
 
-        if change_field == 'severity':
-            changeConvert(db, change_ticket, change_time, change_author, "severity", SEVERITY_TRAC_MANTIS[change_oldvalue], SEVERITY_TRAC_MANTIS[change_newvalue], EDIT_TYPES_NONE)
+        metrics.progress()
 
+    db.flushHistory()
+
+def convert(project_name, _db, _host, _user, _password, _env, _force, _append):
+    print "Trac database('%s'): connecting..." % (_env)
+    print "Mantis MySQL('%s':'%s':'%s':'%s'): connecting..." % (_db, _host, _user, _password)
+    metrics = Metrics('trac2mantis', 0)
+    if PROFILE_QUERIES:
+        metrics.profile = QueryProfile(SLOW_QUERY_SECONDS, PROFILE_TOP)
+    metrics.phase('connect')
+    db = TracDatabase(project_name, _env, _db, _host, _user, _password, _append, metrics, DRY_RUN)
+    if DRY_RUN:
+        print "Dry run: nothing is written to %s" % _db
+
+    # force mode...
+    if _force == 1:
+        print "cleaning all tickets..."
+        metrics.phase('clean')
+        db.clean('mantis_bugnote_table')
+        db.clean('mantis_bugnote_text_table')
+        db.clean('mantis_bug_file_table')
+        db.clean('mantis_bug_history_table')
+        db.clean('mantis_bug_monitor_table')
+        db.clean('mantis_bug_relationship_table')
+        db.clean('mantis_bug_revision_table')
+        db.clean('mantis_bug_table')
+        db.clean('mantis_bug_text_table')
+        db.clean('mantis_bug_tag_table')
+        db.clean('mantis_tag_table')
+
+
+    db.assertNoTickets()
+    # the tables stay locked until all tickets are imported, Mantis
+    # cannot write bugs, notes or users in the meantime
+    db.lockTables()
+    try:
+        importTickets(db, metrics)
+    finally:
+        db.unlockTables()
+    metrics.endPhase()
 
     # print
     # print "Importing attachments..."
 
-    
+    print
+    if DRY_RUN:
+        print "Dry run, discarded %d rows, %d bytes" % (metrics.counters.get('mantis.rows_written', 0), metrics.counters.get('mantis.bytes_discarded', 0))
+    print "Wall time per phase:"
+    for line in metrics.summary():
+        print line
+    if metrics.profile is not None:
+        print
+        print "Statements taking the most time (%d slower than %s seconds):" % (metrics.profile.slowQueries, SLOW_QUERY_SECONDS)
+        for line in metrics.profile.summary():
+            print line
+    if METRICS_REPORT:
+        metrics.writeReport(METRICS_REPORT)
+        print "Metrics report written to %s" % METRICS_REPORT
 
 
 def usage():
@@ -586,16 +794,24 @@ def usage():
     print "  -p | --passwd <MySQL password>   - Mantis database user password"
     print "  -c | --clean                     - Remove current Trac tickets before importing"
     print "  -a | --append                    - Append bugs to existing project"
+    print "  --report <file>                  - Write phase times and counters as JSON to file"
+    print "  --profile                        - Time every statement and list the slowest ones"
+    print "  --dry-run                        - Read and convert all tickets without writing to Mantis"
+    print "  -v | --verbose                   - Print every created category and bug"
     print "  --help | help                    - This help info"
     print
     print "Note: Attachment conversion does not work at this point."
     print
+    print "Note: the Mantis tables are locked for writing during the whole import, so"
+    print "nobody can report or edit bugs in Mantis until it is finished."
+    print
     print "Additional configuration options can be defined directly in the script."
     print
     sys.exit(0)
 
 def main():
     global MANTIS_DB, MANTIS_HOST, MANTIS_USER, MANTIS_PASSWORD, TRAC_ENV, MANTIS_CLEAN, MANTIS_APPEND, PROJECT
+    global VERBOSE, METRICS_REPORT, PROFILE_QUERIES, DRY_RUN
     if len (sys.argv) > 1:
         if sys.argv[1] in ['--help','help'] or len(sys.argv) < 4:
             usage()
@@ -620,6 +836,15 @@ def main():
                 MANTIS_CLEAN = 1
             elif sys.argv[iter] in ['-a', '--append']:
                 MANTIS_APPEND = 1
+            elif sys.argv[iter] in ['--report'] and iter+1 < len(sys.argv):
+                METRICS_REPORT = sys.argv[iter+1]
+                iter = iter + 1
+            elif sys.argv[iter] in ['--profile']:
+                PROFILE_QUERIES = True
+            elif sys.argv[iter] in ['--dry-run']:
+                DRY_RUN = True
+            elif sys.argv[iter] in ['-v', '--verbose']:
+                VERBOSE = True
             else:
                 print "Error: unknown parameter: " + sys.argv[iter]
                 sys.exit(0)